@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import os
+import cv2
+
+from opts import opts
+from detectors.detector_factory import detector_factory
+from detectors.stream import StreamPipeline, read_frames, video_ext
+from utils.debugger import Debugger
+
+time_stats = ['tot', 'load', 'pre', 'net', 'dec', 'post', 'merge']
+
+
+def demo_stream(opt, detector):
+  pipeline = StreamPipeline(detector, opt.stream_workers, opt.stream_queue)
+  for frame, results, times in pipeline.run(read_frames(opt.demo)):
+    if opt.debug >= 1:
+      debugger = Debugger(dataset=opt.dataset, ipynb=(opt.debug == 3),
+                          theme=opt.debugger_theme)
+      detector.show_results(debugger, frame, results)
+    print(' | '.join('{} {:.3f}s'.format(stat, times[stat])
+                     for stat in pipeline.stages))
+    if cv2.waitKey(1) == 27:
+      break
+  stats = pipeline.stats()
+  print('{:.2f} fps'.format(stats.pop('fps')))
+  for stage in pipeline.stages:
+    if stage in stats:
+      print('{:8s} mean {mean:.4f}s  p50 {p50:.4f}s  p95 {p95:.4f}s  '
+            'max {max:.4f}s'.format(stage, **stats[stage]))
+
+
+def demo(opt):
+  os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpus_str
+  opt.debug = max(opt.debug, 1)
+  Detector = detector_factory[opt.task]
+  detector = Detector(opt)
+
+  if opt.demo == 'webcam' or opt.demo.isdigit() or \
+      opt.demo[opt.demo.rfind('.') + 1:].lower() in video_ext:
+    detector.pause = False
+  if opt.stream:
+    demo_stream(opt, detector)
+    return
+  for frame in read_frames(opt.demo):
+    ret = detector.run(frame)
+    print(' | '.join('{} {:.3f}s'.format(stat, ret[stat])
+                     for stat in time_stats))
+    if cv2.waitKey(1) == 27:
+      break
+
+
+if __name__ == '__main__':
+  opt = opts().init()
+  demo(opt)
@@ -0,0 +1,247 @@
+'''
+Array-backed replacement for the pycocotools lookups of the sample classes.
+
+The annotation json is parsed once and every image / annotation field with a
+regular shape (numbers, fixed-length number lists, strings) is stored as one
+contiguous array, with the annotations grouped per image behind an offset
+array. The arrays are cached as .npy files in <annot_path>.index/ and opened
+with mmap, so DataLoader workers share the same pages instead of each holding
+its own pycocotools dicts. Irregular fields (e.g. segmentation polygons) are
+dropped; load_coco() still gives the full pycocotools object for evaluation.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+_VERSION = 2
+
+
+def _column(records, key):
+  values = [record[key] for record in records]
+  if all(isinstance(v, str) for v in values):
+    return np.array(values, dtype=np.str_)
+  try:
+    column = np.array(values)
+  except ValueError:
+    return None
+  if column.dtype.kind not in 'biuf' or len(column) != len(values):
+    return None
+  if column.dtype.kind == 'f':
+    column = column.astype(np.float64)
+  return column
+
+
+def _lookup(sorted_ids, order, ids):
+  # rows of ids, KeyError for an unknown id as in pycocotools
+  ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+  pos = np.searchsorted(sorted_ids, ids)
+  found = pos < len(sorted_ids)
+  found[found] = sorted_ids[pos[found]] == ids[found]
+  if not found.all():
+    raise KeyError(ids[~found][0].item())
+  return order[pos]
+
+
+def _columns(records):
+  keys = set(records[0].keys()) if records else set()
+  for record in records:
+    keys &= set(record.keys())
+  columns = {}
+  for key in sorted(keys):
+    column = _column(records, key)
+    if column is not None:
+      columns[key] = column
+  return columns
+
+
+class AnnotationIndex(object):
+  def __init__(self, annot_path, arrays):
+    self.annot_path = annot_path
+    self._set_arrays(arrays)
+    self._coco = None
+
+  def _set_arrays(self, arrays):
+    self.arrays = arrays
+    self.img_fields = [k[4:] for k in arrays if k.startswith('img.')]
+    self.ann_fields = [k[4:] for k in arrays if k.startswith('ann.')]
+    self._img_ids = arrays['img.id']
+    self._img_order = arrays['img_order']
+    self._img_ids_sorted = arrays['img_ids_sorted']
+    self._ann_ids = arrays['ann.id']
+    self._ann_order = arrays['ann_order']
+    self._ann_ids_sorted = arrays['ann_ids_sorted']
+    self._ann_offsets = arrays['ann_offsets']
+
+  @staticmethod
+  def build(annot_path):
+    with open(annot_path) as f:
+      dataset = json.load(f)
+    images = dataset['images']
+    anns = dataset.get('annotations', [])
+    img_ids = np.array([img['id'] for img in images], dtype=np.int64)
+    order = np.argsort(img_ids, kind='mergesort')
+    img_row = order[np.searchsorted(
+      img_ids[order], [ann['image_id'] for ann in anns])] \
+      if anns else np.zeros(0, dtype=np.int64)
+    # annotations grouped by image, in file order within an image
+    ann_order = np.argsort(img_row, kind='mergesort')
+    anns = [anns[i] for i in ann_order]
+    arrays = {'ann_offsets': np.searchsorted(
+      img_row[ann_order], np.arange(len(images) + 1)).astype(np.int64)}
+    for key, column in _columns(images).items():
+      arrays['img.' + key] = column
+    for key, column in _columns(anns).items():
+      arrays['ann.' + key] = column
+    if 'ann.id' not in arrays:
+      arrays['ann.id'] = np.arange(len(anns), dtype=np.int64)
+    # id -> row lookups, sorted once here and shared through the cache
+    for prefix in ['img', 'ann']:
+      ids = arrays[prefix + '.id']
+      order = np.argsort(ids, kind='mergesort')
+      arrays[prefix + '_order'] = order
+      arrays[prefix + '_ids_sorted'] = ids[order]
+    return AnnotationIndex(annot_path, arrays)
+
+  def save(self, path):
+    '''
+    Writes the cache to a temporary folder next to path and renames it into
+    place, so concurrent processes (one per rank on the first distributed
+    run) never mmap a file another one is still writing. A stale cache is
+    moved aside first; a current one written by another process wins.
+    '''
+    parent = os.path.dirname(os.path.abspath(path))
+    name = os.path.basename(path)
+    tmp = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+    try:
+      for key, array in self.arrays.items():
+        np.save(os.path.join(tmp, key + '.npy'), array)
+      with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'version': _VERSION,
+                   'source': _source_stamp(self.annot_path),
+                   'arrays': sorted(self.arrays)}, f)
+      stale = None
+      if os.path.exists(path) and _meta(self.annot_path, path) is None:
+        # the readers of the old files keep their mmaps after the rename
+        stale = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+        try:
+          os.rename(path, os.path.join(stale, 'old'))
+        except OSError:
+          pass
+      try:
+        os.rename(tmp, path)
+      except OSError:
+        if _meta(self.annot_path, path) is None:
+          raise
+        # another process cached it first
+      if stale is not None:
+        shutil.rmtree(stale, ignore_errors=True)
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+
+  @staticmethod
+  def open(annot_path, path):
+    '''The cached index at path, None when it is missing or stale.'''
+    meta = _meta(annot_path, path)
+    if meta is None:
+      return None
+    arrays = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r')
+              for key in meta['arrays']}
+    return AnnotationIndex(annot_path, arrays)
+
+  @staticmethod
+  def load(annot_path, cache=True):
+    '''
+    The index of annot_path, read from <annot_path>.index/ when it is up to
+    date, otherwise built and (if the folder is writable) cached there.
+    '''
+    path = annot_path + '.index'
+    if cache:
+      index = AnnotationIndex.open(annot_path, path)
+      if index is not None:
+        return index
+    print('building annotation index of {}'.format(annot_path))
+    index = AnnotationIndex.build(annot_path)
+    if cache:
+      try:
+        index.save(path)
+        index = AnnotationIndex.open(annot_path, path) or index
+      except (IOError, OSError):
+        print('cannot cache the annotation index at {}'.format(path))
+    return index
+
+  def __getstate__(self):
+    # spawned workers re-open the mmaps instead of pickling the arrays
+    state = self.__dict__.copy()
+    state['_coco'] = None
+    if isinstance(self._img_ids, np.memmap):
+      for key in ['arrays', '_img_ids', '_img_order', '_img_ids_sorted',
+                  '_ann_ids', '_ann_order', '_ann_ids_sorted',
+                  '_ann_offsets']:
+        del state[key]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if 'arrays' not in state:
+      index = AnnotationIndex.open(self.annot_path, self.annot_path + '.index')
+      if index is None:
+        # the cache went stale or away since the parent opened it
+        index = AnnotationIndex.build(self.annot_path)
+      self._set_arrays(index.arrays)
+
+  def load_coco(self):
+    '''The full pycocotools COCO of the annotation file (for evaluation).'''
+    if self._coco is None:
+      import pycocotools.coco as coco
+      self._coco = coco.COCO(self.annot_path)
+    return self._coco
+
+  def _img_rows(self, ids):
+    return _lookup(self._img_ids_sorted, self._img_order, ids)
+
+  def _record(self, prefix, fields, row):
+    return {key: self.arrays[prefix + key][row].tolist() for key in fields}
+
+  # pycocotools.coco.COCO compatible subset used by the datasets
+  def getImgIds(self):
+    return self._img_ids.tolist()
+
+  def loadImgs(self, ids=[]):
+    return [self._record('img.', self.img_fields, row)
+            for row in self._img_rows(ids)]
+
+  def getAnnIds(self, imgIds=[]):
+    ids = []
+    for row in self._img_rows(imgIds):
+      ids += self._ann_ids[
+        self._ann_offsets[row]:self._ann_offsets[row + 1]].tolist()
+    return ids
+
+  def loadAnns(self, ids=[]):
+    rows = _lookup(self._ann_ids_sorted, self._ann_order, ids)
+    return [self._record('ann.', self.ann_fields, row) for row in rows]
+
+
+def _meta(annot_path, path):
+  try:
+    with open(os.path.join(path, 'meta.json')) as f:
+      meta = json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+  if meta['version'] != _VERSION or \
+      meta['source'] != _source_stamp(annot_path):
+    return None
+  return meta
+
+
+def _source_stamp(annot_path):
+  stat = os.stat(annot_path)
+  return [stat.st_size, int(stat.st_mtime)]
@@ -2,7 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pycocotools.coco as coco
 from pycocotools.cocoeval import COCOeval
 import numpy as np
 import json
@@ -10,6 +9,8 @@ import os
 
 import torch.utils.data as data
 
+from ..annotation_index import AnnotationIndex
+
 class COCO(data.Dataset):
   num_classes = 80
   default_resolution = [512, 512]
@@ -77,7 +78,7 @@ class COCO(data.Dataset):
     self.opt = opt
 
     print('==> initializing coco 2017 {} data.'.format(split))
-    self.coco = coco.COCO(self.annot_path)
+    self.coco = AnnotationIndex.load(self.annot_path)
     self.images = self.coco.getImgIds()
     self.num_samples = len(self.images)
 
@@ -122,8 +123,9 @@ class COCO(data.Dataset):
     # detections  = self.convert_eval_format(results)
     # json.dump(detections, open(result_json, "w"))
     self.save_results(results, save_dir)
-    coco_dets = self.coco.loadRes('{}/results.json'.format(save_dir))
-    coco_eval = COCOeval(self.coco, coco_dets, "bbox")
+    coco_gt = self.coco.load_coco()
+    coco_dets = coco_gt.loadRes('{}/results.json'.format(save_dir))
+    coco_eval = COCOeval(coco_gt, coco_dets, "bbox")
     coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
@@ -2,7 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pycocotools.coco as coco
 from pycocotools.cocoeval import COCOeval
 import numpy as np
 import json
@@ -10,6 +9,8 @@ import os
 
 import torch.utils.data as data
 
+from ..annotation_index import AnnotationIndex
+
 class COCOHP(data.Dataset):
   num_classes = 1
   num_joints = 17
@@ -52,7 +53,7 @@ class COCOHP(data.Dataset):
     self.opt = opt
 
     print('==> initializing coco 2017 {} data.'.format(split))
-    self.coco = coco.COCO(self.annot_path)
+    self.coco = AnnotationIndex.load(self.annot_path)
     image_ids = self.coco.getImgIds()
 
     if split == 'train':
@@ -109,12 +110,13 @@ class COCOHP(data.Dataset):
     # detections  = convert_eval_format(all_boxes)
     # json.dump(detections, open(result_json, "w"))
     self.save_results(results, save_dir)
-    coco_dets = self.coco.loadRes('{}/results.json'.format(save_dir))
-    coco_eval = COCOeval(self.coco, coco_dets, "keypoints")
+    coco_gt = self.coco.load_coco()
+    coco_dets = coco_gt.loadRes('{}/results.json'.format(save_dir))
+    coco_eval = COCOeval(coco_gt, coco_dets, "keypoints")
     coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
-    coco_eval = COCOeval(self.coco, coco_dets, "bbox")
+    coco_eval = COCOeval(coco_gt, coco_dets, "bbox")
     coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
\ No newline at end of file
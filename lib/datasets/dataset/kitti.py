@@ -3,7 +3,6 @@ from __future__ import division
 from __future__ import print_function
 
 import torch.utils.data as data
-import pycocotools.coco as coco
 import numpy as np
 import torch
 import json
@@ -13,6 +12,8 @@ import math
 
 import torch.utils.data as data
 
+from ..annotation_index import AnnotationIndex
+
 
 class KITTI(data.Dataset):
   num_classes = 3
@@ -50,7 +51,7 @@ class KITTI(data.Dataset):
     self.alpha_in_degree = False
 
     print('==> initializing kitti {}, {} data.'.format(opt.kitti_split, split))
-    self.coco = coco.COCO(self.annot_path)
+    self.coco = AnnotationIndex.load(self.annot_path)
     self.images = self.coco.getImgIds()
     self.num_samples = len(self.images)
 
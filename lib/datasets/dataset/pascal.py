@@ -2,7 +2,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pycocotools.coco as coco
 import numpy as np
 import torch
 import json
@@ -10,6 +9,8 @@ import os
 
 import torch.utils.data as data
 
+from ..annotation_index import AnnotationIndex
+
 class PascalVOC(data.Dataset):
   num_classes = 20
   default_resolution = [384, 384]
@@ -45,7 +46,7 @@ class PascalVOC(data.Dataset):
     self.opt = opt
 
     print('==> initializing pascal {} data.'.format(_ann_name[split]))
-    self.coco = coco.COCO(self.annot_path)
+    self.coco = AnnotationIndex.load(self.annot_path)
     self.images = sorted(self.coco.getImgIds())
     self.num_samples = len(self.images)
 
@@ -11,6 +11,7 @@ from .dataset.coco import COCO
 from .dataset.pascal import PascalVOC
 from .dataset.kitti import KITTI
 from .dataset.coco_hp import COCOHP
+from .image_shards import ImageSource
 
 
 dataset_factory = {
@@ -29,7 +30,7 @@ _sample_factory = {
 
 
 def get_dataset(dataset, task):
-  class Dataset(dataset_factory[dataset], _sample_factory[task]):
+  class Dataset(dataset_factory[dataset], _sample_factory[task], ImageSource):
     pass
   return Dataset
   
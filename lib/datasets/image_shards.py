@@ -0,0 +1,118 @@
+'''
+Memory-mapped image shards: decoded uint8 images stored back to back in
+fixed-size shard files with a json offset index, so data loaders read
+zero-copy views instead of decoding a JPEG for every sample.
+
+  <shard_dir>/index.json     {'shards': [file names],
+                              'images': {key: [shard, offset, h, w, c]}}
+  <shard_dir>/shard_000.bin  raw HWC uint8 pixels
+
+Keys are image paths relative to the dataset's img_dir (the file_name of
+the annotation file). tools/pack_image_shards.py writes the shards.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+def shard_dir(opt, split):
+  root = opt.image_shards or os.path.join(opt.data_dir, 'shards', opt.dataset)
+  return os.path.join(root, split)
+
+
+class ImageShardWriter(object):
+  def __init__(self, path, shard_bytes=1 << 30):
+    if not os.path.exists(path):
+      os.makedirs(path)
+    self.path = path
+    self.shard_bytes = shard_bytes
+    self.shards = []
+    self.images = {}
+    self._file = None
+    self._offset = 0
+
+  def _next_shard(self):
+    if self._file is not None:
+      self._file.close()
+    name = 'shard_{:03d}.bin'.format(len(self.shards))
+    self.shards.append(name)
+    self._file = open(os.path.join(self.path, name), 'wb')
+    self._offset = 0
+
+  def add(self, key, img):
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    if img.ndim == 2:
+      img = img[:, :, None]
+    if self._file is None or \
+        (self._offset > 0 and self._offset + img.nbytes > self.shard_bytes):
+      self._next_shard()
+    self._file.write(img.tobytes())
+    self.images[key] = [len(self.shards) - 1, self._offset] + list(img.shape)
+    self._offset += img.nbytes
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    with open(os.path.join(self.path, 'index.json'), 'w') as f:
+      json.dump({'shards': self.shards, 'images': self.images}, f)
+
+
+class ImageShards(object):
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'index.json')) as f:
+      index = json.load(f)
+    self.shards = index['shards']
+    self.images = index['images']
+    self._maps = {}
+
+  def __contains__(self, key):
+    return key in self.images
+
+  def __len__(self):
+    return len(self.images)
+
+  def __getstate__(self):
+    # dataloader workers re-open the maps instead of pickling the pixels
+    state = self.__dict__.copy()
+    state['_maps'] = {}
+    return state
+
+  def _map(self, shard):
+    if shard not in self._maps:
+      self._maps[shard] = np.memmap(
+        os.path.join(self.path, self.shards[shard]), dtype=np.uint8, mode='r')
+    return self._maps[shard]
+
+  def read(self, key):
+    '''Read-only HWC uint8 view of the image, no copy.'''
+    shard, offset, h, w, c = self.images[key]
+    data = self._map(shard)[offset:offset + h * w * c]
+    return np.asarray(data).reshape(h, w, c)
+
+
+class ImageSource(object):
+  '''
+  Mixed into every dataset by get_dataset. _read_image returns a view from
+  the image shards when --image_backend shard is set (images missing from
+  the shards fall back to the file) and cv2.imread otherwise.
+  '''
+  _image_shards = None
+
+  def _read_image(self, img_path):
+    if self.opt.image_backend != 'shard':
+      return cv2.imread(img_path)
+    if self._image_shards is None:
+      self._image_shards = ImageShards(shard_dir(self.opt, self.split))
+    key = os.path.relpath(img_path, self.img_dir)
+    if key not in self._image_shards:
+      return cv2.imread(img_path)
+    return self._image_shards.read(key)
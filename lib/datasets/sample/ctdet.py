@@ -11,7 +11,9 @@ import os
 from utils.image import flip, color_aug
 from utils.image import get_affine_transform, affine_transform
 from utils.image import gaussian_radius, draw_umich_gaussian, draw_msra_gaussian
-from utils.image import draw_dense_reg
+from utils.image import draw_dense_reg, GaussianRenderer
+from utils.batch_aug import letterbox, canvas_size, canvas_transform
+from utils.batch_aug import sample_color
 import math
 
 class CTDetDataset(data.Dataset):
@@ -34,7 +36,7 @@ class CTDetDataset(data.Dataset):
     anns = self.coco.loadAnns(ids=ann_ids)
     num_objs = min(len(anns), self.max_objs)
 
-    img = cv2.imread(img_path)
+    img = self._read_image(img_path)
 
     height, width = img.shape[0], img.shape[1]
     c = np.array([img.shape[1] / 2., img.shape[0] / 2.], dtype=np.float32)
@@ -67,16 +69,29 @@ class CTDetDataset(data.Dataset):
         c[0] =  width - c[0] - 1
         
 
-    trans_input = get_affine_transform(
-      c, s, 0, [input_w, input_h])
-    inp = cv2.warpAffine(img, trans_input, 
-                         (input_w, input_h),
-                         flags=cv2.INTER_LINEAR)
-    inp = (inp.astype(np.float32) / 255.)
-    if self.split == 'train' and not self.opt.no_color_aug:
-      color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
-    inp = (inp - self.mean) / self.std
-    inp = inp.transpose(2, 0, 1)
+    batch_aug = self.split == 'train' and self.opt.batch_aug and \
+                not self.opt.keep_res
+    if batch_aug:
+      # the warp runs on the batch as well, see utils.batch_aug
+      inp, kx, ky = letterbox(img, canvas_size(self.opt))
+      aug_trans = canvas_transform(c, s, [input_w, input_h], kx, ky)
+    else:
+      trans_input = get_affine_transform(
+        c, s, 0, [input_w, input_h])
+      inp = cv2.warpAffine(img, trans_input, 
+                           (input_w, input_h),
+                           flags=cv2.INTER_LINEAR)
+    aug_color = None
+    if batch_aug or self.opt.uint8_input:
+      # the image stays uint8 HWC, BatchAugment finishes it per batch
+      if self.split == 'train' and not self.opt.no_color_aug:
+        aug_color = sample_color(self._data_rng, self._eig_val, self._eig_vec)
+    else:
+      inp = (inp.astype(np.float32) / 255.)
+      if self.split == 'train' and not self.opt.no_color_aug:
+        color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
+      inp = (inp - self.mean) / self.std
+      inp = inp.transpose(2, 0, 1)
 
     output_h = input_h // self.opt.down_ratio
     output_w = input_w // self.opt.down_ratio
@@ -94,6 +109,10 @@ class CTDetDataset(data.Dataset):
     
     draw_gaussian = draw_msra_gaussian if self.opt.mse_loss else \
                     draw_umich_gaussian
+    renderer = GaussianRenderer(self.opt.mse_loss)
+    if self.opt.dense_wh:
+      # max over the classes of the gaussians drawn so far
+      hm_max = np.zeros((output_h, output_w), dtype=np.float32)
 
     gt_det = []
     for k in range(num_objs):
@@ -114,7 +133,7 @@ class CTDetDataset(data.Dataset):
         ct = np.array(
           [(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2], dtype=np.float32)
         ct_int = ct.astype(np.int32)
-        draw_gaussian(hm[cls_id], ct_int, radius)
+        renderer.draw(hm, cls_id, ct_int, radius)
         wh[k] = 1. * w, 1. * h
         ind[k] = ct_int[1] * output_w + ct_int[0]
         reg[k] = ct - ct_int
@@ -122,11 +141,17 @@ class CTDetDataset(data.Dataset):
         cat_spec_wh[k, cls_id * 2: cls_id * 2 + 2] = wh[k]
         cat_spec_mask[k, cls_id * 2: cls_id * 2 + 2] = 1
         if self.opt.dense_wh:
-          draw_dense_reg(dense_wh, hm.max(axis=0), ct_int, wh[k], radius)
+          draw_gaussian(hm_max, ct_int, radius)
+          draw_dense_reg(dense_wh, hm_max, ct_int, wh[k], radius)
         gt_det.append([ct[0] - w / 2, ct[1] - h / 2, 
                        ct[0] + w / 2, ct[1] + h / 2, 1, cls_id])
+    renderer.flush()
     
     ret = {'input': inp, 'hm': hm, 'reg_mask': reg_mask, 'ind': ind, 'wh': wh}
+    if batch_aug:
+      ret['aug_trans'] = aug_trans
+    if aug_color is not None:
+      ret['aug_color'] = aug_color
     if self.opt.dense_wh:
       hm_a = hm.max(axis=0, keepdims=True)
       dense_wh_mask = np.concatenate([hm_a, hm_a], axis=0)
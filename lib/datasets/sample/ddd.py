@@ -13,6 +13,7 @@ import math
 from utils.image import flip, color_aug
 from utils.image import get_affine_transform, affine_transform
 from utils.image import gaussian_radius, draw_umich_gaussian, draw_msra_gaussian
+from utils.image import GaussianRenderer
 import pycocotools.coco as coco
 
 class DddDataset(data.Dataset):
@@ -28,7 +29,7 @@ class DddDataset(data.Dataset):
     img_id = self.images[index]
     img_info = self.coco.loadImgs(ids=[img_id])[0]
     img_path = os.path.join(self.img_dir, img_info['file_name'])
-    img = cv2.imread(img_path)
+    img = self._read_image(img_path)
     if 'calib' in img_info:
       calib = np.array(img_info['calib'], dtype=np.float32)
     else:
@@ -55,11 +56,12 @@ class DddDataset(data.Dataset):
     inp = cv2.warpAffine(img, trans_input, 
                          (self.opt.input_w, self.opt.input_h),
                          flags=cv2.INTER_LINEAR)
-    inp = (inp.astype(np.float32) / 255.)
-    # if self.split == 'train' and not self.opt.no_color_aug:
-    #   color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
-    inp = (inp - self.mean) / self.std
-    inp = inp.transpose(2, 0, 1)
+    if not self.opt.uint8_input:
+      inp = (inp.astype(np.float32) / 255.)
+      # if self.split == 'train' and not self.opt.no_color_aug:
+      #   color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
+      inp = (inp - self.mean) / self.std
+      inp = inp.transpose(2, 0, 1)
 
     num_classes = self.opt.num_classes
     trans_output = get_affine_transform(
@@ -80,8 +82,7 @@ class DddDataset(data.Dataset):
     ann_ids = self.coco.getAnnIds(imgIds=[img_id])
     anns = self.coco.loadAnns(ids=ann_ids)
     num_objs = min(len(anns), self.max_objs)
-    draw_gaussian = draw_msra_gaussian if self.opt.mse_loss else \
-                    draw_umich_gaussian
+    renderer = GaussianRenderer(self.opt.mse_loss)
     gt_det = []
     for k in range(num_objs):
       ann = anns[k]
@@ -105,15 +106,18 @@ class DddDataset(data.Dataset):
         if cls_id < 0:
           ignore_id = [_ for _ in range(num_classes)] \
                       if cls_id == - 1 else  [- cls_id - 2]
+          # the ignore marks overwrite the heatmap, draw what is queued first
           if self.opt.rect_mask:
+            renderer.flush()
             hm[ignore_id, int(bbox[1]): int(bbox[3]) + 1, 
               int(bbox[0]): int(bbox[2]) + 1] = 0.9999
           else:
             for cc in ignore_id:
-              draw_gaussian(hm[cc], ct, radius)
+              renderer.draw(hm, cc, ct, radius)
+            renderer.flush()
             hm[ignore_id, ct_int[1], ct_int[0]] = 0.9999
           continue
-        draw_gaussian(hm[cls_id], ct, radius)
+        renderer.draw(hm, cls_id, ct, radius)
 
         wh[k] = 1. * w, 1. * h
         gt_det.append([ct[0], ct[1], 1] + \
@@ -138,6 +142,7 @@ class DddDataset(data.Dataset):
           reg[k] = ct - ct_int
           reg_mask[k] = 1 if not aug else 0
           rot_mask[k] = 1
+    renderer.flush()
     # print('gt_det', gt_det)
     # print('')
     ret = {'input': inp, 'hm': hm, 'dep': dep, 'dim': dim, 'ind': ind, 
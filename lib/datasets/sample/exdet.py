@@ -10,8 +10,10 @@ import json
 import cv2
 import os
 from utils.image import flip, color_aug
+from utils.batch_aug import sample_color
 from utils.image import get_affine_transform, affine_transform
 from utils.image import gaussian_radius, draw_umich_gaussian, draw_msra_gaussian
+from utils.image import GaussianRenderer
 import pycocotools.coco as coco
 import math
 
@@ -31,7 +33,7 @@ class EXDetDataset(data.Dataset):
     img_id = self.images[index]
     img_info = self.coco.loadImgs(ids=[img_id])[0]
     img_path = os.path.join(self.img_dir, img_info['file_name'])
-    img = cv2.imread(img_path)
+    img = self._read_image(img_path)
 
     height, width = img.shape[0], img.shape[1]
     c = np.array([img.shape[1] / 2., img.shape[0] / 2.])
@@ -60,11 +62,17 @@ class EXDetDataset(data.Dataset):
     inp = cv2.warpAffine(img, trans_input, 
                          (self.opt.input_res, self.opt.input_res),
                          flags=cv2.INTER_LINEAR)
-    inp = (inp.astype(np.float32) / 255.)
-    if self.split == 'train' and not self.opt.no_color_aug:
-      color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
-    inp = (inp - self.mean) / self.std
-    inp = inp.transpose(2, 0, 1)
+    aug_color = None
+    if self.opt.uint8_input:
+      # the image stays uint8 HWC, see utils.batch_aug
+      if self.split == 'train' and not self.opt.no_color_aug:
+        aug_color = sample_color(self._data_rng, self._eig_val, self._eig_vec)
+    else:
+      inp = (inp.astype(np.float32) / 255.)
+      if self.split == 'train' and not self.opt.no_color_aug:
+        color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
+      inp = (inp - self.mean) / self.std
+      inp = inp.transpose(2, 0, 1)
 
     output_res = self.opt.output_res
     num_classes = self.opt.num_classes
@@ -89,8 +97,7 @@ class EXDetDataset(data.Dataset):
     ann_ids = self.coco.getAnnIds(imgIds=[img_id])
     anns = self.coco.loadAnns(ids=ann_ids)
     num_objs = min(len(anns), self.max_objs)
-    draw_gaussian = draw_msra_gaussian if self.opt.mse_loss else \
-                    draw_umich_gaussian
+    renderer = GaussianRenderer(self.opt.mse_loss)
 
     for k in range(num_objs):
       ann = anns[k]
@@ -111,10 +118,10 @@ class EXDetDataset(data.Dataset):
         radius = gaussian_radius((math.ceil(h), math.ceil(w)))
         radius = max(0, int(radius))
         pt_int = pts.astype(np.int32)
-        draw_gaussian(hm_t[hm_id], pt_int[0], radius)
-        draw_gaussian(hm_l[hm_id], pt_int[1], radius)
-        draw_gaussian(hm_b[hm_id], pt_int[2], radius)
-        draw_gaussian(hm_r[hm_id], pt_int[3], radius)
+        renderer.draw(hm_t, hm_id, pt_int[0], radius)
+        renderer.draw(hm_l, hm_id, pt_int[1], radius)
+        renderer.draw(hm_b, hm_id, pt_int[2], radius)
+        renderer.draw(hm_r, hm_id, pt_int[3], radius)
         reg_t[k] = pts[0] - pt_int[0]
         reg_l[k] = pts[1] - pt_int[1]
         reg_b[k] = pts[2] - pt_int[2]
@@ -125,10 +132,13 @@ class EXDetDataset(data.Dataset):
         ind_r[k] = pt_int[3, 1] * output_res + pt_int[3, 0]
 
         ct = [int((pts[3, 0] + pts[1, 0]) / 2), int((pts[0, 1] + pts[2, 1]) / 2)]
-        draw_gaussian(hm_c[cls_id], ct, radius)
+        renderer.draw(hm_c, cls_id, ct, radius)
         reg_mask[k] = 1
+    renderer.flush()
     ret = {'input': inp, 'hm_t': hm_t, 'hm_l': hm_l, 'hm_b': hm_b, 
             'hm_r': hm_r, 'hm_c': hm_c}
+    if aug_color is not None:
+      ret['aug_color'] = aug_color
     if self.opt.reg_offset:
       ret.update({'reg_mask': reg_mask,
         'reg_t': reg_t, 'reg_l': reg_l, 'reg_b': reg_b, 'reg_r': reg_r,
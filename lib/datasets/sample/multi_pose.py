@@ -9,9 +9,10 @@ import json
 import cv2
 import os
 from utils.image import flip, color_aug
+from utils.batch_aug import sample_color
 from utils.image import get_affine_transform, affine_transform
 from utils.image import gaussian_radius, draw_umich_gaussian, draw_msra_gaussian
-from utils.image import draw_dense_reg
+from utils.image import draw_dense_reg, GaussianRenderer
 import math
 
 class MultiPoseDataset(data.Dataset):
@@ -34,7 +35,7 @@ class MultiPoseDataset(data.Dataset):
     anns = self.coco.loadAnns(ids=ann_ids)
     num_objs = min(len(anns), self.max_objs)
 
-    img = cv2.imread(img_path)
+    img = self._read_image(img_path)
 
     height, width = img.shape[0], img.shape[1]
     c = np.array([img.shape[1] / 2., img.shape[0] / 2.], dtype=np.float32)
@@ -70,11 +71,17 @@ class MultiPoseDataset(data.Dataset):
     inp = cv2.warpAffine(img, trans_input, 
                          (self.opt.input_res, self.opt.input_res),
                          flags=cv2.INTER_LINEAR)
-    inp = (inp.astype(np.float32) / 255.)
-    if self.split == 'train' and not self.opt.no_color_aug:
-      color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
-    inp = (inp - self.mean) / self.std
-    inp = inp.transpose(2, 0, 1)
+    aug_color = None
+    if self.opt.uint8_input:
+      # the image stays uint8 HWC, see utils.batch_aug
+      if self.split == 'train' and not self.opt.no_color_aug:
+        aug_color = sample_color(self._data_rng, self._eig_val, self._eig_vec)
+    else:
+      inp = (inp.astype(np.float32) / 255.)
+      if self.split == 'train' and not self.opt.no_color_aug:
+        color_aug(self._data_rng, inp, self._eig_val, self._eig_vec)
+      inp = (inp - self.mean) / self.std
+      inp = inp.transpose(2, 0, 1)
 
     output_res = self.opt.output_res
     num_joints = self.num_joints
@@ -99,6 +106,8 @@ class MultiPoseDataset(data.Dataset):
 
     draw_gaussian = draw_msra_gaussian if self.opt.mse_loss else \
                     draw_umich_gaussian
+    # dense_hp reads hm while it is being drawn
+    renderer = GaussianRenderer(self.opt.mse_loss, immediate=self.opt.dense_hp)
 
     gt_det = []
     for k in range(num_objs):
@@ -127,6 +136,7 @@ class MultiPoseDataset(data.Dataset):
         reg_mask[k] = 1
         num_kpts = pts[:, 2].sum()
         if num_kpts == 0:
+          renderer.flush()
           hm[cls_id, ct_int[1], ct_int[0]] = 0.9999
           reg_mask[k] = 0
 
@@ -149,17 +159,20 @@ class MultiPoseDataset(data.Dataset):
                 draw_dense_reg(dense_kps[j], hm[cls_id], ct_int, 
                                pts[j, :2] - ct_int, radius, is_offset=True)
                 draw_gaussian(dense_kps_mask[j], ct_int, radius)
-              draw_gaussian(hm_hp[j], pt_int, hp_radius)
-        draw_gaussian(hm[cls_id], ct_int, radius)
+              renderer.draw(hm_hp, j, pt_int, hp_radius)
+        renderer.draw(hm, cls_id, ct_int, radius)
         gt_det.append([ct[0] - w / 2, ct[1] - h / 2, 
                        ct[0] + w / 2, ct[1] + h / 2, 1] + 
                        pts[:, :2].reshape(num_joints * 2).tolist() + [cls_id])
+    renderer.flush()
     if rot != 0:
       hm = hm * 0 + 0.9999
       reg_mask *= 0
       kps_mask *= 0
     ret = {'input': inp, 'hm': hm, 'reg_mask': reg_mask, 'ind': ind, 'wh': wh,
            'hps': kps, 'hps_mask': kps_mask}
+    if aug_color is not None:
+      ret['aug_color'] = aug_color
     if self.opt.dense_hp:
       dense_kps = dense_kps.reshape(num_joints * 2, output_res, output_res)
       dense_kps_mask = dense_kps_mask.reshape(
@@ -0,0 +1,99 @@
+'''
+Shape bucketing for --keep_res, where every image is padded to its own
+(h | pad) + 1 x (w | pad) + 1 input. ShapeBucketSampler only batches images
+of the same padded shape, so the default collate can stack them and every
+shape reuses one kernel plan.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import cv2
+import torch
+from torch.utils.data import Sampler
+
+
+def padded_shape(height, width, pad, scale=1.):
+  return (int(height * scale) | pad) + 1, (int(width * scale) | pad) + 1
+
+
+def _image_size(dataset, img_id):
+  img_info = dataset.coco.loadImgs(ids=[img_id])[0]
+  if 'height' in img_info and 'width' in img_info:
+    return img_info['height'], img_info['width']
+  img = cv2.imread(os.path.join(dataset.img_dir, img_info['file_name']))
+  return img.shape[0], img.shape[1]
+
+
+def input_shapes(dataset, opt, scales=(1., )):
+  '''
+  The network input shape of every image of dataset: with --keep_res the
+  padded image shape at each of scales, otherwise the fixed input size.
+  '''
+  if not opt.keep_res:
+    return [(opt.input_h, opt.input_w)] * len(dataset.images)
+  shapes = []
+  for img_id in dataset.images:
+    height, width = _image_size(dataset, img_id)
+    shapes.append(tuple(
+      padded_shape(height, width, opt.pad, scale) for scale in scales))
+  return shapes
+
+
+class ShapeBucketSampler(Sampler):
+  '''
+  Batch sampler over the buckets of equal shapes. With shuffle the samples
+  of every bucket and the order of the batches are shuffled each epoch.
+  With num_replicas > 1 (distributed training) every process takes every
+  num_replicas-th batch of the same order, seeded by seed + the epoch of
+  set_epoch.
+  '''
+  def __init__(self, shapes, batch_size, shuffle=True, drop_last=False,
+               num_replicas=1, rank=0, seed=0):
+    self.buckets = {}
+    for index, shape in enumerate(shapes):
+      self.buckets.setdefault(shape, []).append(index)
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.num_replicas = num_replicas
+    self.rank = rank
+    self.seed = seed
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def __iter__(self):
+    generator = None
+    if self.num_replicas > 1:
+      generator = torch.Generator()
+      generator.manual_seed(self.seed + self.epoch)
+    batches = []
+    for shape in sorted(self.buckets):
+      indices = self.buckets[shape]
+      if self.shuffle:
+        indices = [indices[i] for i in torch.randperm(
+          len(indices), generator=generator).tolist()]
+      for start in range(0, len(indices), self.batch_size):
+        batch = indices[start:start + self.batch_size]
+        if len(batch) == self.batch_size or not self.drop_last:
+          batches.append(batch)
+    if self.shuffle:
+      batches = [batches[i] for i in torch.randperm(
+        len(batches), generator=generator).tolist()]
+    return iter(batches[self.rank:len(self) * self.num_replicas:
+                        self.num_replicas])
+
+  def __len__(self):
+    if self.drop_last:
+      num_batches = sum(len(indices) // self.batch_size
+                        for indices in self.buckets.values())
+    else:
+      num_batches = sum((len(indices) + self.batch_size - 1) // self.batch_size
+                        for indices in self.buckets.values())
+    # every process runs the same number of batches
+    return num_batches // self.num_replicas
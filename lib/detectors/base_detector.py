@@ -2,6 +2,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 from progress.bar import Bar
@@ -9,7 +12,9 @@ import time
 import torch
 
 from models.model import create_model, load_model
+from models.external.modules.dcn_deform_conv import set_round_offset
 from utils.image import get_affine_transform
+from utils.batch_aug import normalize
 from utils.debugger import Debugger
 
 
@@ -23,16 +28,25 @@ class BaseDetector(object):
     print('Creating model...')
     self.model = create_model(opt.arch, opt.heads, opt.head_conv)
     self.model = load_model(self.model, opt.load_model)
+    if opt.round_offset:
+      print('Rounded offsets in {} deform layers.'.format(
+        set_round_offset(self.model)))
     self.model = self.model.to(opt.device)
     self.model.eval()
 
     self.mean = np.array(opt.mean, dtype=np.float32).reshape(1, 1, 3)
     self.std = np.array(opt.std, dtype=np.float32).reshape(1, 1, 3)
+    self.input_mean = torch.from_numpy(self.mean.reshape(1, 3, 1, 1)).to(
+      opt.device)
+    self.input_std = torch.from_numpy(self.std.reshape(1, 3, 1, 1)).to(
+      opt.device)
     self.max_per_image = 100
     self.num_classes = opt.num_classes
     self.scales = opt.test_scales
     self.opt = opt
     self.pause = True
+    self._scale_pool = None
+    self._scale_streams = threading.local()
 
   def pre_process(self, image, scale, meta=None):
     height, width = image.shape[0:2]
@@ -53,7 +67,8 @@ class BaseDetector(object):
     inp_image = cv2.warpAffine(
       resized_image, trans_input, (inp_width, inp_height),
       flags=cv2.INTER_LINEAR)
-    inp_image = ((inp_image / 255. - self.mean) / self.std).astype(np.float32)
+    if not self.opt.uint8_input:
+      inp_image = ((inp_image / 255. - self.mean) / self.std).astype(np.float32)
 
     images = inp_image.transpose(2, 0, 1).reshape(1, 3, inp_height, inp_width)
     if self.opt.flip_test:
@@ -64,6 +79,54 @@ class BaseDetector(object):
             'out_width': inp_width // self.opt.down_ratio}
     return images, meta
 
+  def _synchronize(self):
+    # only the calling thread's stream, so the timings of one multi-scale
+    # shape group do not wait for the other groups (run_multiscale)
+    if self.opt.device.type == 'cuda':
+      torch.cuda.current_stream(self.opt.device).synchronize()
+
+  def _to_device(self, images, non_blocking=False):
+    # uint8 inputs (--uint8_input) are normalized after the copy
+    images = images.to(self.opt.device, non_blocking=non_blocking)
+    if images.dtype == torch.uint8:
+      images = normalize(images, self.input_mean, self.input_std)
+    return images
+
+  def _load_image(self, image_or_path):
+    if isinstance(image_or_path, np.ndarray):
+      return image_or_path
+    return cv2.imread(image_or_path)
+
+  def _pad_batch(self, images):
+    # images: list of pre_processed 1(2 with flip) x 3 x h x w tensors.
+    # Pad to the largest shape with the (normalized) value of a black pixel,
+    # anchored at the top-left (top-right for the flipped copy) so that
+    # flipping the output back still lines up with the original.
+    max_h = max(image.shape[2] for image in images)
+    max_w = max(image.shape[3] for image in images)
+    if images[0].dtype == torch.uint8:
+      fill = torch.zeros((1, 3, 1, 1), dtype=torch.uint8)
+    else:
+      fill = torch.from_numpy((-self.mean / self.std).reshape(1, 3, 1, 1))
+    padded = []
+    for image in images:
+      height, width = image.shape[2], image.shape[3]
+      if height != max_h or width != max_w:
+        out = fill.expand(image.shape[0], 3, max_h, max_w).clone()
+        out[0:1, :, :height, :width] = image[0:1]
+        if image.shape[0] > 1:
+          out[1:2, :, :height, max_w - width:] = image[1:2]
+        image = out
+      padded.append(image)
+    # originals first, flipped copies in the second half of the batch
+    batch = [image[0:1] for image in padded]
+    if self.opt.flip_test:
+      batch += [image[1:2] for image in padded]
+    return torch.cat(batch, dim=0)
+
+  def _select_dets(self, dets, index, num_images):
+    return dets[index:index + 1]
+
   def process(self, images, return_time=False):
     raise NotImplementedError
 
@@ -80,6 +143,8 @@ class BaseDetector(object):
    raise NotImplementedError
 
   def run(self, image_or_path_or_tensor, meta=None):
+    if self.opt.ms_engine and len(self.scales) > 1:
+      return self.run_multiscale(image_or_path_or_tensor, meta)
     load_time, pre_time, net_time, dec_time, post_time = 0, 0, 0, 0, 0
     merge_time, tot_time = 0, 0
     debugger = Debugger(dataset=self.opt.dataset, ipynb=(self.opt.debug==3),
@@ -108,14 +173,14 @@ class BaseDetector(object):
         images = pre_processed_images['images'][scale][0]
         meta = pre_processed_images['meta'][scale]
         meta = {k: v.numpy()[0] for k, v in meta.items()}
-      images = images.to(self.opt.device)
-      torch.cuda.synchronize()
+      images = self._to_device(images)
+      self._synchronize()
       pre_process_time = time.time()
       pre_time += pre_process_time - scale_start_time
       
       output, dets, forward_time = self.process(images, return_time=True)
 
-      torch.cuda.synchronize()
+      self._synchronize()
       net_time += forward_time - pre_process_time
       decode_time = time.time()
       dec_time += decode_time - forward_time
@@ -124,14 +189,14 @@ class BaseDetector(object):
         self.debug(debugger, images, dets, output, scale)
       
       dets = self.post_process(dets, meta, scale)
-      torch.cuda.synchronize()
+      self._synchronize()
       post_process_time = time.time()
       post_time += post_process_time - decode_time
 
       detections.append(dets)
     
     results = self.merge_outputs(detections)
-    torch.cuda.synchronize()
+    self._synchronize()
     end_time = time.time()
     merge_time += end_time - post_process_time
     tot_time += end_time - start_time
@@ -141,4 +206,195 @@ class BaseDetector(object):
     
     return {'results': results, 'tot': tot_time, 'load': load_time,
             'pre': pre_time, 'net': net_time, 'dec': dec_time,
-            'post': post_time, 'merge': merge_time}
\ No newline at end of file
+            'post': post_time, 'merge': merge_time}
+
+  def _process_scales(self, group):
+    # one forward pass and decode for the scales of one input shape
+    batch = self._to_device(self._pad_batch([images for _, images, _ in group]))
+    _, dets, _ = self.process(batch, return_time=True)
+    dets = dets.detach().cpu()
+    return [(scale, self._select_dets(dets, i, len(group)), meta)
+            for i, (scale, _, meta) in enumerate(group)]
+
+  def _process_scales_stream(self, group):
+    # one side stream per pool thread, reused for every image
+    stream = getattr(self._scale_streams, 'stream', None)
+    if stream is None:
+      stream = torch.cuda.Stream(self.opt.device)
+      self._scale_streams.stream = stream
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+      return self._process_scales(group)
+
+  def run_multiscale(self, image_or_path_or_tensor, meta=None):
+    '''
+      Multi-scale test with all scales in flight at once (--ms_engine).
+      The scales are pre-processed in a thread pool, scales with the same
+      input shape (all of them with --fix_res) share one batched forward
+      pass and decode, and the remaining shape groups run concurrently in
+      the pool, each on its own cuda stream. Returns the same as run;
+      'net' is the wall time of the concurrent forward and decode.
+    '''
+    load_time, pre_time, net_time, dec_time, post_time = 0, 0, 0, 0, 0
+    merge_time, tot_time = 0, 0
+    start_time = time.time()
+    if self._scale_pool is None:
+      self._scale_pool = ThreadPoolExecutor(max_workers=len(self.scales))
+    if isinstance(image_or_path_or_tensor, dict):
+      image = image_or_path_or_tensor['image'][0].numpy()
+      inputs = [(image_or_path_or_tensor['images'][scale][0],
+                 {k: v.numpy()[0] for k, v in
+                  image_or_path_or_tensor['meta'][scale].items()})
+                for scale in self.scales]
+    else:
+      image = self._load_image(image_or_path_or_tensor)
+    loaded_time = time.time()
+    load_time += loaded_time - start_time
+
+    if not isinstance(image_or_path_or_tensor, dict):
+      inputs = list(self._scale_pool.map(
+        lambda scale: self.pre_process(image, scale, meta), self.scales))
+    groups = {}
+    for scale, (images, scale_meta) in zip(self.scales, inputs):
+      groups.setdefault(tuple(images.shape[2:]), []).append(
+        (scale, images, scale_meta))
+    pre_process_time = time.time()
+    pre_time += pre_process_time - loaded_time
+
+    groups = list(groups.values())
+    if len(groups) == 1:
+      outputs = self._process_scales(groups[0])
+    else:
+      process = self._process_scales_stream \
+                if self.opt.device.type == 'cuda' else self._process_scales
+      outputs = sum(self._scale_pool.map(process, groups), [])
+    self._synchronize()
+    decode_time = time.time()
+    net_time += decode_time - pre_process_time
+
+    detections = [self.post_process(dets, scale_meta, scale)
+                  for scale, dets, scale_meta in outputs]
+    post_process_time = time.time()
+    post_time += post_process_time - decode_time
+
+    results = self.merge_outputs(detections)
+    end_time = time.time()
+    merge_time += end_time - post_process_time
+    tot_time += end_time - start_time
+
+    if self.opt.debug >= 1:
+      debugger = Debugger(dataset=self.opt.dataset, ipynb=(self.opt.debug==3),
+                          theme=self.opt.debugger_theme)
+      self.show_results(debugger, image, results)
+
+    return {'results': results, 'tot': tot_time, 'load': load_time,
+            'pre': pre_time, 'net': net_time, 'dec': dec_time,
+            'post': post_time, 'merge': merge_time}
+
+  def stream_pre_process(self, image, meta=None):
+    '''
+      pre_process every test scale of one frame; the streaming pipeline
+      runs this in a worker thread. Returns ([(scale, images, meta)], time).
+    '''
+    start_time = time.time()
+    inputs = []
+    for scale in self.scales:
+      images, scale_meta = self.pre_process(image, scale, meta)
+      if self.opt.device.type == 'cuda':
+        images = images.pin_memory()
+      inputs.append((scale, images, scale_meta))
+    return inputs, time.time() - start_time
+
+  def stream_process(self, inputs):
+    '''
+      Forward and decode the pre-processed scales of one frame on the
+      network thread. Returns ([(scale, dets, meta)], net_time, dec_time)
+      with the detections already on the cpu.
+    '''
+    net_time, dec_time = 0, 0
+    outputs = []
+    for scale, images, meta in inputs:
+      start_time = time.time()
+      images = self._to_device(images, non_blocking=True)
+      _, dets, forward_time = self.process(images, return_time=True)
+      dets = dets.detach().cpu()
+      net_time += forward_time - start_time
+      dec_time += time.time() - forward_time
+      outputs.append((scale, dets, meta))
+    return outputs, net_time, dec_time
+
+  def stream_post_process(self, outputs):
+    '''post_process and merge the decoded scales of one frame.'''
+    start_time = time.time()
+    detections = [self.post_process(dets, meta, scale)
+                  for scale, dets, meta in outputs]
+    post_process_time = time.time()
+    results = self.merge_outputs(detections)
+    end_time = time.time()
+    return results, post_process_time - start_time, end_time - post_process_time
+
+  def run_batch(self, images_or_paths, metas=None):
+    '''
+      Runs one padded forward pass and one batched decode per test scale
+      for a list of images (arrays or paths). metas is an optional list of
+      per-image extra arguments for pre_process (e.g. calib for ddd).
+      images_or_paths can also be already pre-processed, as a dict with
+      'images' and 'meta' mapping every scale to per-image lists (see the
+      batched PrefetchDataset of test.py).
+      Returns the same timing keys as run, with 'results' a list holding
+      one merged result per input image.
+    '''
+    load_time, pre_time, net_time, dec_time, post_time = 0, 0, 0, 0, 0
+    merge_time, tot_time = 0, 0
+    start_time = time.time()
+    pre_processed = isinstance(images_or_paths, dict)
+    if pre_processed:
+      num_images = len(images_or_paths['meta'][self.scales[0]])
+    else:
+      images = [self._load_image(image) for image in images_or_paths]
+      num_images = len(images)
+    if metas is None:
+      metas = [None] * num_images
+
+    loaded_time = time.time()
+    load_time += (loaded_time - start_time)
+
+    detections = [[] for _ in range(num_images)]
+    for scale in self.scales:
+      scale_start_time = time.time()
+      if pre_processed:
+        inputs = images_or_paths['images'][scale]
+        scale_metas = images_or_paths['meta'][scale]
+      else:
+        inputs, scale_metas = [], []
+        for image, meta in zip(images, metas):
+          inp, meta = self.pre_process(image, scale, meta)
+          inputs.append(inp)
+          scale_metas.append(meta)
+      batch = self._to_device(self._pad_batch(inputs))
+      self._synchronize()
+      pre_process_time = time.time()
+      pre_time += pre_process_time - scale_start_time
+
+      output, dets, forward_time = self.process(batch, return_time=True)
+
+      self._synchronize()
+      net_time += forward_time - pre_process_time
+      decode_time = time.time()
+      dec_time += decode_time - forward_time
+
+      dets = dets.detach().cpu()
+      for i in range(num_images):
+        detections[i].append(self.post_process(
+          self._select_dets(dets, i, num_images), scale_metas[i], scale))
+      post_process_time = time.time()
+      post_time += post_process_time - decode_time
+
+    results = [self.merge_outputs(dets) for dets in detections]
+    end_time = time.time()
+    merge_time += end_time - post_process_time
+    tot_time += end_time - start_time
+
+    return {'results': results, 'tot': tot_time, 'load': load_time,
+            'pre': pre_time, 'net': net_time, 'dec': dec_time,
+            'post': post_time, 'merge': merge_time}
@@ -8,15 +8,11 @@ from progress.bar import Bar
 import time
 import torch
 
-try:
-  from external.nms import soft_nms
-except:
-  print('NMS not imported! If you need it,'
-        ' do \n cd $CenterNet_ROOT/src/lib/external \n make')
-from models.decode import ctdet_decode
+from models.decode import ctdet_decode, ctdet_decode_fused
 from models.utils import flip_tensor
 from utils.image import get_affine_transform
-from utils.post_process import ctdet_post_process
+from utils.post_process import ctdet_post_process, CtdetResult
+from utils.nms import matrix_soft_nms, batched_soft_nms
 from utils.debugger import Debugger
 
 from .base_detector import BaseDetector
@@ -32,12 +28,18 @@ class CtdetDetector(BaseDetector):
       wh = output['wh']
       reg = output['reg'] if self.opt.reg_offset else None
       if self.opt.flip_test:
-        hm = (hm[0:1] + flip_tensor(hm[1:2])) / 2
-        wh = (wh[0:1] + flip_tensor(wh[1:2])) / 2
-        reg = reg[0:1] if reg is not None else None
-      torch.cuda.synchronize()
+        n = hm.shape[0] // 2
+        hm = (hm[0:n] + flip_tensor(hm[n:])) / 2
+        wh = (wh[0:n] + flip_tensor(wh[n:])) / 2
+        reg = reg[0:n] if reg is not None else None
+      self._synchronize()
       forward_time = time.time()
-      dets = ctdet_decode(hm, wh, reg=reg, cat_spec_wh=self.opt.cat_spec_wh, K=self.opt.K)
+      if self.opt.decode_engine == 'fused':
+        dets = ctdet_decode_fused(hm, wh, reg=reg,
+                                  cat_spec_wh=self.opt.cat_spec_wh,
+                                  K=self.opt.K, thresh=self.opt.decode_thresh)
+      else:
+        dets = ctdet_decode(hm, wh, reg=reg, cat_spec_wh=self.opt.cat_spec_wh, K=self.opt.K)
       
     if return_time:
       return output, dets, forward_time
@@ -47,29 +49,29 @@ class CtdetDetector(BaseDetector):
   def post_process(self, dets, meta, scale=1):
     dets = dets.detach().cpu().numpy()
     dets = dets.reshape(1, -1, dets.shape[2])
+    if self.opt.decode_engine == 'fused':
+      # drop the zero rows padding an image with fewer than K peaks
+      dets = dets[:, dets[0, :, 4] > 0]
     dets = ctdet_post_process(
         dets.copy(), [meta['c']], [meta['s']],
         meta['out_height'], meta['out_width'], self.opt.num_classes)
-    for j in range(1, self.num_classes + 1):
-      dets[0][j] = np.array(dets[0][j], dtype=np.float32).reshape(-1, 5)
-      dets[0][j][:, :4] /= scale
+    dets[0].dets[:, :4] /= scale
     return dets[0]
 
   def merge_outputs(self, detections):
-    results = {}
-    for j in range(1, self.num_classes + 1):
-      results[j] = np.concatenate(
-        [detection[j] for detection in detections], axis=0).astype(np.float32)
-      if len(self.scales) > 1 or self.opt.nms:
-         soft_nms(results[j], Nt=0.5, method=2)
-    scores = np.hstack(
-      [results[j][:, 4] for j in range(1, self.num_classes + 1)])
+    results = CtdetResult.concat(detections)
+    if len(self.scales) > 1 or self.opt.nms:
+      if self.opt.ms_nms == 'matrix':
+        results.dets[:, 4] = matrix_soft_nms(
+          results.boxes, results.scores, results.classes)
+      else:
+        results = results.select(batched_soft_nms(
+          results.dets, results.classes, Nt=0.5, method=2))
+    scores = results.scores
     if len(scores) > self.max_per_image:
       kth = len(scores) - self.max_per_image
       thresh = np.partition(scores, kth)[kth]
-      for j in range(1, self.num_classes + 1):
-        keep_inds = (results[j][:, 4] >= thresh)
-        results[j] = results[j][keep_inds]
+      results = results.select(scores >= thresh)
     return results
 
   def debug(self, debugger, images, dets, output, scale=1):
@@ -42,8 +42,9 @@ class DddDetector(BaseDetector):
     inp_image = cv2.warpAffine(
       resized_image, trans_input, (inp_width, inp_height),
       flags=cv2.INTER_LINEAR)
-    inp_image = (inp_image.astype(np.float32) / 255.)
-    inp_image = (inp_image - self.mean) / self.std
+    if not self.opt.uint8_input:
+      inp_image = (inp_image.astype(np.float32) / 255.)
+      inp_image = (inp_image - self.mean) / self.std
     images = inp_image.transpose(2, 0, 1)[np.newaxis, ...]
     calib = np.array(calib, dtype=np.float32) if calib is not None \
             else self.calib
@@ -56,13 +57,13 @@ class DddDetector(BaseDetector):
   
   def process(self, images, return_time=False):
     with torch.no_grad():
-      torch.cuda.synchronize()
+      self._synchronize()
       output = self.model(images)[-1]
       output['hm'] = output['hm'].sigmoid_()
       output['dep'] = 1. / (output['dep'].sigmoid() + 1e-6) - 1.
       wh = output['wh'] if self.opt.reg_bbox else None
       reg = output['reg'] if self.opt.reg_offset else None
-      torch.cuda.synchronize()
+      self._synchronize()
       forward_time = time.time()
       
       dets = ddd_decode(output['hm'], output['rot'], output['dep'],
@@ -16,6 +16,7 @@ from models.decode import exct_decode, agnex_ct_decode
 from models.utils import flip_tensor
 from utils.image import get_affine_transform, transform_preds
 from utils.post_process import ctdet_post_process
+from utils.nms import batched_soft_nms
 from utils.debugger import Debugger
 
 from .base_detector import BaseDetector
@@ -27,14 +28,14 @@ class ExdetDetector(BaseDetector):
 
   def process(self, images, return_time=False):
     with torch.no_grad():
-      torch.cuda.synchronize()
+      self._synchronize()
       output = self.model(images)[-1]
       t_heat = output['hm_t'].sigmoid_()
       l_heat = output['hm_l'].sigmoid_()
       b_heat = output['hm_b'].sigmoid_()
       r_heat = output['hm_r'].sigmoid_()
       c_heat = output['hm_c'].sigmoid_()
-      torch.cuda.synchronize()
+      self._synchronize()
       forward_time = time.time()
       if self.opt.reg_offset:
         dets = self.decode(t_heat, l_heat, b_heat, r_heat, c_heat, 
@@ -82,6 +83,13 @@ class ExdetDetector(BaseDetector):
                                  detection[i, k, 4], 
                                  img_id='out_{:.1f}'.format(scale))
 
+  def _select_dets(self, dets, index, num_images):
+    # post_process expects the flipped detections right after the original
+    if self.opt.flip_test:
+      return torch.cat([dets[index:index + 1],
+                        dets[num_images + index:num_images + index + 1]], 0)
+    return dets[index:index + 1]
+
   def post_process(self, dets, meta, scale=1):
     out_width, out_height = meta['out_width'], meta['out_height']
     dets = dets.detach().cpu().numpy().reshape(2, -1, 14)
@@ -102,12 +110,13 @@ class ExdetDetector(BaseDetector):
     detections = detections[keep_inds]
     classes = classes[keep_inds]
 
+    keep_inds = batched_soft_nms(detections, classes, Nt=0.5, method=2)
+    detections = detections[keep_inds]
+    classes = classes[keep_inds]
     results = {}
     for j in range(self.num_classes):
       keep_inds = (classes == j)
-      results[j + 1] = detections[keep_inds][:, 0:7].astype(np.float32)
-      soft_nms(results[j + 1], Nt=0.5, method=2)
-      results[j + 1] = results[j + 1][:, 0:5]
+      results[j + 1] = detections[keep_inds][:, 0:5]
 
     scores = np.hstack([
       results[j][:, -1] 
@@ -8,15 +8,11 @@ from progress.bar import Bar
 import time
 import torch
 
-try:
-  from external.nms import soft_nms_39
-except:
-  print('NMS not imported! If you need it,'
-        ' do \n cd $CenterNet_ROOT/src/lib/external \n make')
 from models.decode import multi_pose_decode
 from models.utils import flip_tensor, flip_lr_off, flip_lr
 from utils.image import get_affine_transform
 from utils.post_process import multi_pose_post_process
+from utils.nms import batched_soft_nms
 from utils.debugger import Debugger
 
 from .base_detector import BaseDetector
@@ -28,7 +24,7 @@ class MultiPoseDetector(BaseDetector):
 
   def process(self, images, return_time=False):
     with torch.no_grad():
-      torch.cuda.synchronize()
+      self._synchronize()
       output = self.model(images)[-1]
       output['hm'] = output['hm'].sigmoid_()
       if self.opt.hm_hp and not self.opt.mse_loss:
@@ -37,22 +33,24 @@ class MultiPoseDetector(BaseDetector):
       reg = output['reg'] if self.opt.reg_offset else None
       hm_hp = output['hm_hp'] if self.opt.hm_hp else None
       hp_offset = output['hp_offset'] if self.opt.reg_hp_offset else None
-      torch.cuda.synchronize()
+      self._synchronize()
       forward_time = time.time()
       
       if self.opt.flip_test:
-        output['hm'] = (output['hm'][0:1] + flip_tensor(output['hm'][1:2])) / 2
-        output['wh'] = (output['wh'][0:1] + flip_tensor(output['wh'][1:2])) / 2
-        output['hps'] = (output['hps'][0:1] + 
-          flip_lr_off(output['hps'][1:2], self.flip_idx)) / 2
-        hm_hp = (hm_hp[0:1] + flip_lr(hm_hp[1:2], self.flip_idx)) / 2 \
+        n = output['hm'].shape[0] // 2
+        output['hm'] = (output['hm'][0:n] + flip_tensor(output['hm'][n:])) / 2
+        output['wh'] = (output['wh'][0:n] + flip_tensor(output['wh'][n:])) / 2
+        output['hps'] = (output['hps'][0:n] + 
+          flip_lr_off(output['hps'][n:], self.flip_idx)) / 2
+        hm_hp = (hm_hp[0:n] + flip_lr(hm_hp[n:], self.flip_idx)) / 2 \
                 if hm_hp is not None else None
-        reg = reg[0:1] if reg is not None else None
-        hp_offset = hp_offset[0:1] if hp_offset is not None else None
+        reg = reg[0:n] if reg is not None else None
+        hp_offset = hp_offset[0:n] if hp_offset is not None else None
       
       dets = multi_pose_decode(
         output['hm'], output['wh'], output['hps'],
-        reg=reg, hm_hp=hm_hp, hp_offset=hp_offset, K=self.opt.K)
+        reg=reg, hm_hp=hm_hp, hp_offset=hp_offset, K=self.opt.K,
+        hp_thresh=self.opt.hp_thresh, match_block=self.opt.hp_match_block)
 
     if return_time:
       return output, dets, forward_time
@@ -76,7 +74,10 @@ class MultiPoseDetector(BaseDetector):
     results[1] = np.concatenate(
         [detection[1] for detection in detections], axis=0).astype(np.float32)
     if self.opt.nms or len(self.opt.test_scales) > 1:
-      soft_nms_39(results[1], Nt=0.5, method=2)
+      keep = batched_soft_nms(
+        results[1], np.zeros(len(results[1]), dtype=np.int32),
+        Nt=0.5, method=2)
+      results[1] = results[1][keep]
     results[1] = results[1].tolist()
     return results
 
@@ -0,0 +1,172 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+image_ext = ['jpg', 'jpeg', 'png', 'webp']
+video_ext = ['mp4', 'mov', 'avi', 'mkv']
+
+_END = object()
+
+
+def read_frames(source):
+  '''
+    Yields decoded BGR frames from a video file, a camera index / 'webcam',
+    an image folder or a single image.
+  '''
+  if source == 'webcam' or str(source).isdigit() or \
+      source[source.rfind('.') + 1:].lower() in video_ext:
+    cam = cv2.VideoCapture(0 if source == 'webcam' else
+                           int(source) if str(source).isdigit() else source)
+    try:
+      while True:
+        ok, frame = cam.read()
+        if not ok:
+          break
+        yield frame
+    finally:
+      cam.release()
+  else:
+    if os.path.isdir(source):
+      names = sorted(os.listdir(source))
+      paths = [os.path.join(source, name) for name in names
+               if name[name.rfind('.') + 1:].lower() in image_ext]
+    else:
+      paths = [source]
+    for path in paths:
+      yield cv2.imread(path)
+
+
+class _Failure(object):
+  def __init__(self, exc):
+    self.exc = exc
+
+
+class StreamPipeline(object):
+  '''
+    Runs a detector over a stream of frames with the stages overlapped:
+
+      reader thread   decodes frame i + 2 (next() on the frame source)
+      worker pool     pre-processes frame i + 1
+      network thread  runs forward + decode of frame i
+      worker pool     post-processes and merges frame i - 1
+
+    Stages are connected by bounded queues of size queue_size, so a slow
+    consumer stalls the reader instead of buffering the whole video.
+    run() yields (frame, results, times) in input order; times holds the
+    per-stage seconds of that frame ('load', 'pre', 'net', 'dec', 'post',
+    'merge') and 'latency', the time from the frame being read to being
+    yielded. stats() summarizes them over the run.
+  '''
+  stages = ['load', 'pre', 'net', 'dec', 'post', 'merge', 'latency']
+
+  def __init__(self, detector, num_workers=2, queue_size=4):
+    self.detector = detector
+    self.num_workers = max(num_workers, 1)
+    self.queue_size = max(queue_size, 1)
+    self.times = {stage: [] for stage in self.stages}
+    self.wall_time = 0.
+
+  def _put(self, q, item, stop):
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _read(self, frames, pool, pre_queue, stop):
+    try:
+      frames = iter(frames)
+      while not stop.is_set():
+        start_time = time.time()
+        try:
+          frame = next(frames)
+        except StopIteration:
+          break
+        times = {'load': time.time() - start_time, 'start': start_time}
+        future = pool.submit(self.detector.stream_pre_process, frame)
+        if not self._put(pre_queue, (frame, future, times), stop):
+          return
+      self._put(pre_queue, _END, stop)
+    except Exception as e:
+      self._put(pre_queue, _Failure(e), stop)
+
+  def _forward(self, pool, pre_queue, post_queue, stop):
+    try:
+      while not stop.is_set():
+        item = pre_queue.get()
+        if item is _END or isinstance(item, _Failure):
+          self._put(post_queue, item, stop)
+          return
+        frame, future, times = item
+        inputs, times['pre'] = future.result()
+        outputs, times['net'], times['dec'] = \
+          self.detector.stream_process(inputs)
+        future = pool.submit(self.detector.stream_post_process, outputs)
+        if not self._put(post_queue, (frame, future, times), stop):
+          return
+    except Exception as e:
+      self._put(post_queue, _Failure(e), stop)
+
+  def run(self, frames):
+    self.times = {stage: [] for stage in self.stages}
+    pre_queue = queue.Queue(self.queue_size)
+    post_queue = queue.Queue(self.queue_size)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(self.num_workers)
+    threads = [
+      threading.Thread(target=self._read,
+                       args=(frames, pool, pre_queue, stop)),
+      threading.Thread(target=self._forward,
+                       args=(pool, pre_queue, post_queue, stop))]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    start_time = time.time()
+    try:
+      while True:
+        item = post_queue.get()
+        if item is _END:
+          break
+        if isinstance(item, _Failure):
+          raise item.exc
+        frame, future, times = item
+        results, times['post'], times['merge'] = future.result()
+        times['latency'] = time.time() - times.pop('start')
+        for stage in self.stages:
+          self.times[stage].append(times[stage])
+        yield frame, results, times
+    finally:
+      self.wall_time = time.time() - start_time
+      stop.set()
+      # unblock the network thread if it waits on an empty queue
+      try:
+        pre_queue.put_nowait(_END)
+      except queue.Full:
+        pass
+      for thread in threads:
+        thread.join()
+      pool.shutdown()
+
+  def stats(self):
+    '''Mean / p50 / p95 / max seconds per stage and the achieved fps.'''
+    ret = {}
+    for stage in self.stages:
+      times = np.array(self.times[stage])
+      if len(times) == 0:
+        continue
+      ret[stage] = {'mean': times.mean(), 'p50': np.percentile(times, 50),
+                    'p95': np.percentile(times, 95), 'max': times.max()}
+    num_frames = len(self.times['latency'])
+    ret['fps'] = num_frames / self.wall_time if self.wall_time > 0 else 0.
+    return ret
@@ -14,59 +14,47 @@ def _nms(heat, kernel=3):
     keep = (hmax == heat).float()
     return heat * keep
 
+def _run_aggregate(heat, dim):
+    '''
+        For every position along dim, the sum of the values before it in its
+        run of non-decreasing values: the scan
+            ret[i] = heat[i] + ret[i - 1] * (heat[i] >= heat[i - 1])
+        minus heat, computed as run-wise differences of a cumulative sum.
+    '''
+    heat = heat.transpose(dim, -1)
+    starts = torch.ones_like(heat, dtype=torch.uint8)
+    starts[..., 1:] = heat[..., 1:] < heat[..., :-1]
+    # index of each position's run, and the exclusive prefix sums
+    run = torch.cumsum(starts.long(), dim=-1) - 1
+    csum = torch.cumsum(heat.double(), dim=-1) - heat.double()
+    run_base = torch.zeros_like(csum).scatter_add_(
+        -1, run, csum * starts.double())
+    ret = csum - run_base.gather(-1, run)
+    return ret.to(heat.dtype).transpose(dim, -1).contiguous()
+
 def _left_aggregate(heat):
     '''
         heat: batchsize x channels x h x w
     '''
-    shape = heat.shape 
-    heat = heat.reshape(-1, heat.shape[3])
-    heat = heat.transpose(1, 0).contiguous()
-    ret = heat.clone()
-    for i in range(1, heat.shape[0]):
-        inds = (heat[i] >= heat[i - 1])
-        ret[i] += ret[i - 1] * inds.float()
-    return (ret - heat).transpose(1, 0).reshape(shape) 
+    return _run_aggregate(heat, 3)
 
 def _right_aggregate(heat):
     '''
         heat: batchsize x channels x h x w
     '''
-    shape = heat.shape 
-    heat = heat.reshape(-1, heat.shape[3])
-    heat = heat.transpose(1, 0).contiguous()
-    ret = heat.clone()
-    for i in range(heat.shape[0] - 2, -1, -1):
-        inds = (heat[i] >= heat[i +1])
-        ret[i] += ret[i + 1] * inds.float()
-    return (ret - heat).transpose(1, 0).reshape(shape) 
+    return _run_aggregate(heat.flip(3), 3).flip(3)
 
 def _top_aggregate(heat):
     '''
         heat: batchsize x channels x h x w
     '''
-    heat = heat.transpose(3, 2) 
-    shape = heat.shape
-    heat = heat.reshape(-1, heat.shape[3])
-    heat = heat.transpose(1, 0).contiguous()
-    ret = heat.clone()
-    for i in range(1, heat.shape[0]):
-        inds = (heat[i] >= heat[i - 1])
-        ret[i] += ret[i - 1] * inds.float()
-    return (ret - heat).transpose(1, 0).reshape(shape).transpose(3, 2)
+    return _run_aggregate(heat, 2)
 
 def _bottom_aggregate(heat):
     '''
         heat: batchsize x channels x h x w
     '''
-    heat = heat.transpose(3, 2) 
-    shape = heat.shape
-    heat = heat.reshape(-1, heat.shape[3])
-    heat = heat.transpose(1, 0).contiguous()
-    ret = heat.clone()
-    for i in range(heat.shape[0] - 2, -1, -1):
-        inds = (heat[i] >= heat[i + 1])
-        ret[i] += ret[i + 1] * inds.float()
-    return (ret - heat).transpose(1, 0).reshape(shape).transpose(3, 2)
+    return _run_aggregate(heat.flip(2), 2).flip(2)
 
 def _h_aggregate(heat, aggr_weight=0.1):
     return aggr_weight * _left_aggregate(heat) + \
@@ -494,8 +482,89 @@ def ctdet_decode(heat, wh, reg=None, cat_spec_wh=False, K=100):
       
     return detections
 
+def _peaks(heat, K=100, thresh=0.01):
+    '''
+        Per image, the top K local maxima of heat (3x3, like _nms) above thresh.
+        Only the pixels above thresh are compared with their neighbours, the
+        full-size max-pooled / masked heatmaps of _nms are never built.
+        Returns per-image lists of (scores, clses, ys, xs), each of length <= K.
+    '''
+    batch, cat, height, width = heat.size()
+    b, c, y, x = (heat > thresh).nonzero().unbind(1)
+    scores = heat[b, c, y, x]
+    keep = torch.ones_like(scores, dtype=torch.bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy == 0 and dx == 0:
+                continue
+            # out-of-image neighbours clamp to the pixel itself and never win
+            ny = (y + dy).clamp(0, height - 1)
+            nx = (x + dx).clamp(0, width - 1)
+            keep &= scores >= heat[b, c, ny, nx]
+    b, c, y, x, scores = b[keep], c[keep], y[keep], x[keep], scores[keep]
+
+    peaks = []
+    counts = torch.bincount(b, minlength=batch).tolist()
+    start = 0
+    for count in counts:
+        end = start + count
+        top_scores, top = torch.topk(scores[start:end], min(K, count))
+        top = top + start
+        peaks.append((top_scores, c[top], y[top], x[top]))
+        start = end
+    return peaks
+
+def ctdet_decode_fused(heat, wh, reg=None, cat_spec_wh=False, K=100, thresh=0.01):
+    '''
+        ctdet_decode for cpu inference: peaks come from _peaks and wh / reg
+        are gathered for the survivors only. Images with fewer than K peaks
+        above thresh are padded with zero rows (score 0, class 0), which
+        CtdetDetector.post_process drops.
+    '''
+    batch, cat, height, width = heat.size()
+    detections = heat.new_zeros((batch, K, 6))
+    for i, (scores, clses, ys, xs) in enumerate(_peaks(heat, K=K, thresh=thresh)):
+        n = scores.size(0)
+        if cat_spec_wh:
+            box_wh = wh[i].view(cat, 2, height, width)[clses, :, ys, xs]
+        else:
+            box_wh = wh[i][:, ys, xs].t()
+        if reg is not None:
+            off = reg[i][:, ys, xs].t()
+            cx = xs.float() + off[:, 0]
+            cy = ys.float() + off[:, 1]
+        else:
+            cx = xs.float() + 0.5
+            cy = ys.float() + 0.5
+        detections[i, :n, 0] = cx - box_wh[:, 0] / 2
+        detections[i, :n, 1] = cy - box_wh[:, 1] / 2
+        detections[i, :n, 2] = cx + box_wh[:, 0] / 2
+        detections[i, :n, 3] = cy + box_wh[:, 1] / 2
+        detections[i, :n, 4] = scores
+        detections[i, :n, 5] = clses.float()
+    return detections
+
+def _match_kps(reg_kps, hm_kps, block_size=None):
+  '''
+    reg_kps: n x K x 2 regressed joints, hm_kps: n x M x 2 heatmap joints.
+    Nearest heatmap joint of every regressed joint, computed block_size rows
+    of n at a time so that only block_size x K x M distances are alive.
+    Returns min_dist, min_ind: n x K
+  '''
+  n = reg_kps.size(0)
+  block_size = block_size or n
+  min_dist, min_ind = [], []
+  for start in range(0, n, block_size):
+    diff = reg_kps[start:start + block_size].unsqueeze(2) - \
+           hm_kps[start:start + block_size].unsqueeze(1)
+    dist, ind = (diff ** 2).sum(dim=3).min(dim=2)
+    min_dist.append(dist.sqrt())
+    min_ind.append(ind)
+  return torch.cat(min_dist, dim=0), torch.cat(min_ind, dim=0)
+
 def multi_pose_decode(
-    heat, wh, kps, reg=None, hm_hp=None, hp_offset=None, K=100):
+    heat, wh, kps, reg=None, hm_hp=None, hp_offset=None, K=100,
+    hp_thresh=0.1, match_block=None):
   batch, cat, height, width = heat.size()
   num_joints = kps.shape[1] // 2
   # heat = torch.sigmoid(heat)
@@ -526,10 +595,9 @@ def multi_pose_decode(
                       ys + wh[..., 1:2] / 2], dim=2)
   if hm_hp is not None:
       hm_hp = _nms(hm_hp)
-      thresh = 0.1
+      thresh = hp_thresh
       kps = kps.view(batch, K, num_joints, 2).permute(
           0, 2, 1, 3).contiguous() # b x J x K x 2
-      reg_kps = kps.unsqueeze(3).expand(batch, num_joints, K, K, 2)
       hm_score, hm_inds, hm_ys, hm_xs = _topk_channel(hm_hp, K=K) # b x J x K
       if hp_offset is not None:
           hp_offset = _transpose_and_gather_feat(
@@ -545,16 +613,19 @@ def multi_pose_decode(
       hm_score = (1 - mask) * -1 + mask * hm_score
       hm_ys = (1 - mask) * (-10000) + mask * hm_ys
       hm_xs = (1 - mask) * (-10000) + mask * hm_xs
-      hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).unsqueeze(
-          2).expand(batch, num_joints, K, K, 2)
-      dist = (((reg_kps - hm_kps) ** 2).sum(dim=4) ** 0.5)
-      min_dist, min_ind = dist.min(dim=3) # b x J x K
+      hm_kps = torch.stack([hm_xs, hm_ys], dim=-1) # b x J x K x 2
+      # candidates come sorted by score and the ones below thresh sit at
+      # -10000, so only the first num_cand of every joint can be nearest
+      num_cand = max(int(mask.sum(dim=2).max().item()), 1)
+      min_dist, min_ind = _match_kps(
+          kps.view(batch * num_joints, K, 2),
+          hm_kps[:, :, :num_cand].reshape(batch * num_joints, num_cand, 2),
+          match_block)
+      min_ind = min_ind.view(batch, num_joints, K)
       hm_score = hm_score.gather(2, min_ind).unsqueeze(-1) # b x J x K x 1
-      min_dist = min_dist.unsqueeze(-1)
-      min_ind = min_ind.view(batch, num_joints, K, 1, 1).expand(
-          batch, num_joints, K, 1, 2)
-      hm_kps = hm_kps.gather(3, min_ind)
-      hm_kps = hm_kps.view(batch, num_joints, K, 2)
+      min_dist = min_dist.view(batch, num_joints, K, 1)
+      hm_kps = hm_kps.gather(
+          2, min_ind.unsqueeze(-1).expand(batch, num_joints, K, 2))
       l = bboxes[:, :, 0].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
       t = bboxes[:, :, 1].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
       r = bboxes[:, :, 2].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
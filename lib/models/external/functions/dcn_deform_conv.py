@@ -5,7 +5,13 @@ import sys
 import os
 dirname = os.path.dirname(__file__)
 sys.path.insert(0, os.path.join(dirname,"../"))
-from _ext.dcn import dcn_deform_conv_cuda
+try:
+    from _ext.dcn import dcn_deform_conv_cuda
+except ImportError:
+    # CPU-only build, see deform_conv_cpu
+    dcn_deform_conv_cuda = None
+from .deform_conv_cpu import deform_conv_cpu, modulated_deform_conv_cpu
+from .deform_conv_cpu import full_precision
 
 
 class DeformConvFunction(Function):
@@ -182,5 +188,25 @@ class ModulatedDeformConvFunction(Function):
         return n, channels_out, height_out, width_out
 
 
-deform_conv = DeformConvFunction.apply
-modulated_deform_conv = ModulatedDeformConvFunction.apply
+@full_precision
+def deform_conv(input, offset, weight, stride=1, padding=0, dilation=1,
+                groups=1, deformable_groups=1, im2col_step=64):
+    if not input.is_cuda:
+        return deform_conv_cpu(input, offset, weight, stride, padding,
+                               dilation, groups, deformable_groups)
+    return DeformConvFunction.apply(input, offset, weight, stride, padding,
+                                    dilation, groups, deformable_groups,
+                                    im2col_step)
+
+
+@full_precision
+def modulated_deform_conv(input, offset, mask, weight, bias=None, stride=1,
+                          padding=0, dilation=1, groups=1,
+                          deformable_groups=1):
+    if not input.is_cuda:
+        return modulated_deform_conv_cpu(input, offset, mask, weight, bias,
+                                         stride, padding, dilation, groups,
+                                         deformable_groups)
+    return ModulatedDeformConvFunction.apply(input, offset, mask, weight, bias,
+                                             stride, padding, dilation, groups,
+                                             deformable_groups)
@@ -0,0 +1,238 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+
+import torch
+import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+
+
+def full_precision(fn):
+    '''
+    Run the deformable conv fn on contiguous operands, in float32 and outside
+    autocast when it is enabled (--amp): half precision sampling coordinates
+    are off by whole pixels and the cuda kernels read every operand in the
+    dtype of the input. The im2col views need NCHW tensors (--channels_last).
+    '''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        autocast = torch.is_autocast_enabled() or \
+            torch.is_autocast_cpu_enabled()
+
+        def prepare(arg):
+            if not torch.is_tensor(arg):
+                return arg
+            if autocast and arg.is_floating_point():
+                arg = arg.float()
+            return arg.contiguous()
+        args = [prepare(arg) for arg in args]
+        kwargs = {key: prepare(arg) for key, arg in kwargs.items()}
+        if not autocast:
+            return fn(*args, **kwargs)
+        with torch.autocast(args[0].device.type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _output_hw(height, width, kernel_size, stride, padding, dilation):
+    out_h = (height + 2 * padding[0] -
+             (dilation[0] * (kernel_size[0] - 1) + 1)) // stride[0] + 1
+    out_w = (width + 2 * padding[1] -
+             (dilation[1] * (kernel_size[1] - 1) + 1)) // stride[1] + 1
+    if out_h <= 0 or out_w <= 0:
+        raise ValueError(
+            "convolution input is too small (output would be {}x{})".format(
+                out_h, out_w))
+    return out_h, out_w
+
+
+def deform_im2col(input, offset, kernel_size, stride, padding, dilation,
+                  deformable_groups, mask=None):
+    '''
+    Sample the deformable columns of `input` for the whole batch at once.
+    `offset` follows the CUDA layout (n, dg * kh * kw * 2, oh, ow) with (dy, dx)
+    pairs per kernel position; out-of-image taps read zeros, as in the kernel.
+    Returns columns of shape (n, c, kh * kw, oh, ow).
+    '''
+    kernel_size = _pair(kernel_size)
+    stride = _pair(stride)
+    padding = _pair(padding)
+    dilation = _pair(dilation)
+    n, c, h, w = input.shape
+    kh, kw = kernel_size
+    k = kh * kw
+    dg = deformable_groups
+    out_h, out_w = _output_hw(h, w, kernel_size, stride, padding, dilation)
+
+    opts = dict(dtype=offset.dtype, device=offset.device)
+    base_y = torch.arange(out_h, **opts) * stride[0] - padding[0]
+    base_x = torch.arange(out_w, **opts) * stride[1] - padding[1]
+    ky = (torch.arange(kh, **opts) * dilation[0]).repeat_interleave(kw)
+    kx = (torch.arange(kw, **opts) * dilation[1]).repeat(kh)
+
+    offset = offset.view(n, dg, k, 2, out_h, out_w)
+    py = base_y.view(1, 1, 1, out_h, 1) + ky.view(1, 1, k, 1, 1) + offset[:, :, :, 0]
+    px = base_x.view(1, 1, 1, 1, out_w) + kx.view(1, 1, k, 1, 1) + offset[:, :, :, 1]
+    # pixel -> [-1, 1] with align_corners=True
+    gy = py * (2. / max(h - 1, 1)) - 1
+    gx = px * (2. / max(w - 1, 1)) - 1
+    grid = torch.stack([gx, gy], dim=-1).view(n * dg, k * out_h, out_w, 2)
+
+    cols = F.grid_sample(input.reshape(n * dg, c // dg, h, w), grid.to(input.dtype),
+                         mode='bilinear', padding_mode='zeros', align_corners=True)
+    cols = cols.view(n, dg, c // dg, k, out_h, out_w)
+    if mask is not None:
+        cols = cols * mask.view(n, dg, 1, k, out_h, out_w)
+    return cols.view(n, c, k, out_h, out_w)
+
+
+def _cols_conv(cols, weight, groups):
+    n, c, k, out_h, out_w = cols.shape
+    out_c = weight.size(0)
+    if groups == c and out_c == c:
+        # depthwise: per-channel multiply-accumulate over the kernel taps
+        return (cols * weight.view(1, c, k, 1, 1)).sum(2)
+    cols = cols.view(n, groups, (c // groups) * k, out_h * out_w)
+    weight = weight.view(groups, out_c // groups, -1)
+    output = torch.matmul(weight, cols)
+    return output.view(n, out_c, out_h, out_w)
+
+
+def deform_conv_cpu(input, offset, weight, stride=1, padding=0, dilation=1,
+                    groups=1, deformable_groups=1):
+    '''
+    Reference implementation of DeformConvFunction built from differentiable
+    torch ops, so backward comes from autograd.
+    '''
+    if input.dim() != 4:
+        raise ValueError(
+            "Expected 4D tensor as input, got {}D tensor instead.".format(
+                input.dim()))
+    cols = deform_im2col(input, offset, weight.shape[2:4], stride, padding,
+                         dilation, deformable_groups)
+    return _cols_conv(cols, weight, groups)
+
+
+def modulated_deform_conv_cpu(input, offset, mask, weight, bias=None, stride=1,
+                              padding=0, dilation=1, groups=1,
+                              deformable_groups=1):
+    cols = deform_im2col(input, offset, weight.shape[2:4], stride, padding,
+                         dilation, deformable_groups, mask=mask)
+    output = _cols_conv(cols, weight, groups)
+    if bias is not None:
+        output = output + bias.view(1, -1, 1, 1)
+    return output
+
+
+def _scale_window(input, dg, bound, out_size, stride, padding, dilation):
+    # zero-pad so every tap within `bound` of a kernel centre is in range and
+    # return the flattened input with the padded centre coordinates
+    n, c, h, w = input.shape
+    bound = int(bound)
+    pad_h = bound + max(padding[0] - dilation[0], 0)
+    pad_w = bound + max(padding[1] - dilation[1], 0)
+    x = F.pad(input, (pad_w, pad_w, pad_h, pad_h))
+    wp = w + 2 * pad_w
+    x = x.view(n, dg, c // dg, -1)
+    cy = (torch.arange(out_size[0], device=input.device) * stride[0] -
+          padding[0] + dilation[0] + pad_h).view(1, 1, -1, 1)
+    cx = (torch.arange(out_size[1], device=input.device) * stride[1] -
+          padding[1] + dilation[1] + pad_w).view(1, 1, 1, -1)
+    return x, wp, cy, cx
+
+
+@full_precision
+def deform_conv_scale_cpu(input, scale, weight, stride=1, padding=1,
+                          dilation=1):
+    '''
+    Depthwise 3x3 deformable conv whose offsets are anchor_offset * (scale - 1),
+    as produced by DeformConvWithOffsetScaleBoundPositive. Every tap lies on a
+    3x3 grid dilated by d = dilation + scale - 1 around the kernel centre, so a
+    location needs only one bilinear weight pair (1 - frac(d), frac(d)) shared
+    by all taps and channels. `scale` is (n, deformable_groups, oh, ow); the
+    offset tensor and the im2col columns are never materialized.
+    '''
+    stride = _pair(stride)
+    padding = _pair(padding)
+    dilation = _pair(dilation)
+    n, c, h, w = input.shape
+    dg = scale.size(1)
+    assert weight.shape == (c, 1, 3, 3), \
+        'expected a depthwise 3x3 weight, got {}'.format(tuple(weight.shape))
+    out_h, out_w = _output_hw(h, w, (3, 3), stride, padding, dilation)
+    assert scale.shape[2:] == (out_h, out_w)
+
+    dy = scale + (dilation[0] - 1)
+    dx = scale + (dilation[1] - 1)
+    dy0 = dy.detach().floor()
+    dx0 = dx.detach().floor()
+    fy = (dy - dy0).unsqueeze(2)
+    fx = (dx - dx0).unsqueeze(2)
+    dy0 = dy0.long()
+    dx0 = dx0.long()
+
+    x, wp, cy, cx = _scale_window(input, dg, max(dy0.abs().max().item(),
+                                              dx0.abs().max().item()) + 1,
+                                  (out_h, out_w), stride, padding, dilation)
+    # five sample rows/cols per location at (-d0-1, -d0, 0, d0, d0+1) with
+    # bilinear weights (f, 1-f, 1, 1-f, f); `taps` maps them to kernel rows/cols
+    rows = [cy - dy0 - 1, cy - dy0, cy + dy0 * 0, cy + dy0, cy + dy0 + 1]
+    cols = [cx - dx0 - 1, cx - dx0, cx + dx0 * 0, cx + dx0, cx + dx0 + 1]
+    wys = [fy, 1 - fy, None, 1 - fy, fy]
+    wxs = [fx, 1 - fx, None, 1 - fx, fx]
+    taps = [0, 0, 1, 2, 2]
+
+    weight = weight.view(1, dg, c // dg, 9, 1)
+    output = None
+    for r in range(5):
+        for q in range(5):
+            index = (rows[r] * wp + cols[q]).view(n, dg, 1, -1)
+            val = x.gather(3, index.expand(n, dg, c // dg, index.size(3)))
+            val = val * weight[:, :, :, taps[r] * 3 + taps[q]]
+            if wys[r] is not None:
+                val = val * wys[r].view(n, dg, 1, -1)
+            if wxs[q] is not None:
+                val = val * wxs[q].view(n, dg, 1, -1)
+            output = val if output is None else output + val
+    return output.view(n, c, out_h, out_w)
+
+
+@full_precision
+def deform_conv_scale_int_cpu(input, scale, weight, stride=1, padding=1,
+                              dilation=1):
+    '''
+    deform_conv_scale_cpu for integer-valued scales (see round_offset in
+    DeformConvWithOffsetScaleBoundPositive): every tap falls on a pixel, so the
+    layer is a per-location dilated 3x3 window gather plus a depthwise
+    multiply-accumulate, with no bilinear interpolation.
+    '''
+    stride = _pair(stride)
+    padding = _pair(padding)
+    dilation = _pair(dilation)
+    n, c, h, w = input.shape
+    dg = scale.size(1)
+    assert weight.shape == (c, 1, 3, 3), \
+        'expected a depthwise 3x3 weight, got {}'.format(tuple(weight.shape))
+    out_h, out_w = _output_hw(h, w, (3, 3), stride, padding, dilation)
+    assert scale.shape[2:] == (out_h, out_w)
+
+    scale = scale.detach().round().long()
+    dy = scale + (dilation[0] - 1)
+    dx = scale + (dilation[1] - 1)
+    x, wp, cy, cx = _scale_window(input, dg, max(dy.abs().max().item(),
+                                              dx.abs().max().item()),
+                                  (out_h, out_w), stride, padding, dilation)
+    rows = [cy - dy, cy + dy * 0, cy + dy]
+    cols = [cx - dx, cx + dx * 0, cx + dx]
+
+    weight = weight.view(1, dg, c // dg, 9, 1)
+    output = None
+    for i in range(3):
+        for j in range(3):
+            index = (rows[i] * wp + cols[j]).view(n, dg, 1, -1)
+            val = x.gather(3, index.expand(n, dg, c // dg, index.size(3)))
+            val = val * weight[:, :, :, i * 3 + j]
+            output = val if output is None else output + val
+    return output.view(n, c, out_h, out_w)
@@ -9,6 +9,7 @@ import os
 dirname = os.path.dirname(__file__)
 sys.path.insert(0, os.path.join(dirname,"../"))
 from functions.dcn_deform_conv import deform_conv, modulated_deform_conv
+from functions.deform_conv_cpu import deform_conv_scale_cpu, deform_conv_scale_int_cpu
 
 
 class DeformConv(nn.Module):
@@ -321,9 +322,14 @@ class DeformConvWithOffsetScale(nn.Module):
         self.anchor_offset = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
                                                 0, -1,  0, 0,  0, 1,
                                                 1, -1,  1, 0,  1, 1]).unsqueeze(0).unsqueeze(2).unsqueeze(2)
+        # snap scales to integers at inference, see set_round_offset
+        self.round_offset = False
 
     def forward(self, x):
-        o = self.anchor_offset.to(x.device) * (self.conv_scale(x) - 1)
+        s = self.conv_scale(x)
+        if self.round_offset:
+            s = s.round()
+        o = self.anchor_offset.to(x.device) * (s - 1)
         return self.conv(x, o)
 
 
@@ -344,9 +350,13 @@ class DeformConvWithOffsetScaleBound(nn.Module):
         self.anchor_offset = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
                                                 0, -1,  0, 0,  0, 1,
                                                 1, -1,  1, 0,  1, 1]).unsqueeze(0).unsqueeze(2).unsqueeze(2)
+        # snap scales to integers at inference, see set_round_offset
+        self.round_offset = False
 
     def forward(self, x):
         s = self.conv_bound(self.conv_scale(x))
+        if self.round_offset:
+            s = s.round()
         o = self.anchor_offset.to(x.device) * (s - 1)
         return self.conv(x, o)
 
@@ -419,9 +429,19 @@ class DeformConvWithOffsetScaleBoundPositive(nn.Module):
         self.anchor_offset = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
                                                 0, -1,  0, 0,  0, 1,
                                                 1, -1,  1, 0,  1, 1]).unsqueeze(0).unsqueeze(2).unsqueeze(2)
+        # snap scales to integers at inference, see set_round_offset
+        self.round_offset = False
 
     def forward(self, x):
         s = self.conv_bound(self.conv_scale(x))
+        if self.round_offset:
+            s = s.round()
+        if not x.is_cuda:
+            # structured offsets: sample straight from the scale map
+            op = deform_conv_scale_int_cpu if self.round_offset else deform_conv_scale_cpu
+            return self.conv_channel(op(
+                x, s, self.conv.weight, self.conv.stride, self.conv.padding,
+                self.conv.dilation))
         # o = self.anchor_offset.to(x.device) * s
         o = self.anchor_offset.to(x.device) * (s - 1)
         # o = self.anchor_offset.to(x.device) * (s - 2)
@@ -451,10 +471,14 @@ class ModulatedDeformConvWithOffsetScaleBoundPositive(nn.Module):
         self.anchor_offset = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
                                                 0, -1,  0, 0,  0, 1,
                                                 1, -1,  1, 0,  1, 1]).unsqueeze(0).unsqueeze(2).unsqueeze(2)
+        # snap scales to integers at inference, see set_round_offset
+        self.round_offset = False
 
     def forward(self, x):
         m = self.conv_mask(x)
         s = self.conv_bound(self.conv_scale(x))
+        if self.round_offset:
+            s = s.round()
         o = self.anchor_offset.to(x.device) * (s - 1)
         return self.conv(x, o, m)
 
@@ -478,9 +502,26 @@ class ModulatedDeformConvWithOffset1x1ScaleBoundPositive(nn.Module):
         self.anchor_offset = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
                                                 0, -1,  0, 0,  0, 1,
                                                 1, -1,  1, 0,  1, 1]).unsqueeze(0).unsqueeze(2).unsqueeze(2)
+        # snap scales to integers at inference, see set_round_offset
+        self.round_offset = False
 
     def forward(self, x):
         m = self.conv_mask(x)
         s = self.conv_bound(self.conv_scale(x))
+        if self.round_offset:
+            s = s.round()
         o = self.anchor_offset.to(x.device) * (s - 1)
         return self.conv(x, o, m)
+
+
+def set_round_offset(model, enabled=True):
+    '''
+    Toggle integer offset scales on every offset-scale deform layer of `model`.
+    Meant for inference; returns the number of layers switched.
+    '''
+    count = 0
+    for m in model.modules():
+        if hasattr(m, 'round_offset') and hasattr(m, 'anchor_offset'):
+            m.round_offset = enabled
+            count += 1
+    return count
@@ -46,6 +46,10 @@ def _neg_loss(pred, gt):
       pred (batch x c x h x w)
       gt_regr (batch x c x h x w)
   '''
+  # the 1 - 1e-4 clamp of _sigmoid rounds to 1 in half precision, where
+  # log(1 - pred) is -inf, so the loss is always computed in float32
+  pred = pred.float().clamp(min=1e-4, max=1 - 1e-4)
+  gt = gt.float()
   pos_inds = gt.eq(1).float()
   neg_inds = gt.lt(1).float()
 
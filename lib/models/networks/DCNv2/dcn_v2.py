@@ -10,7 +10,19 @@ from torch.autograd import Function
 from torch.nn.modules.utils import _pair
 from torch.autograd.function import once_differentiable
 
-import _ext as _backend
+try:
+    import _ext as _backend
+except ImportError:
+    _backend = None
+try:
+    from ...external.functions.deform_conv_cpu import modulated_deform_conv_cpu
+    from ...external.functions.deform_conv_cpu import full_precision
+except (ImportError, ValueError):
+    # loaded as a top-level module (e.g. by test.py)
+    modulated_deform_conv_cpu = None
+
+    def full_precision(fn):
+        return fn
 
 
 class _DCNv2(Function):
@@ -51,7 +63,15 @@ class _DCNv2(Function):
             None, None, None, None,
 
 
-dcn_v2_conv = _DCNv2.apply
+@full_precision
+def dcn_v2_conv(input, offset, mask, weight, bias,
+                stride, padding, dilation, deformable_groups):
+    if not input.is_cuda and modulated_deform_conv_cpu is not None:
+        return modulated_deform_conv_cpu(input, offset, mask, weight, bias,
+                                         stride, padding, dilation, 1,
+                                         deformable_groups)
+    return _DCNv2.apply(input, offset, mask, weight, bias,
+                        stride, padding, dilation, deformable_groups)
 
 
 class DCNv2(nn.Module):
@@ -545,10 +545,10 @@ def get_shufflenetv2_dcn(num_layers, heads, head_conv=64, deform_conv='Modulated
     model = PoseShuffleNetV2(block_class, layers, heads, head_conv=head_conv, w2=w2, deform=False, maxpool=maxpool)
     model.init_weights(num_layers)
 
-    input = torch.randn(1, 3, 512, 512).cuda()
-    print(input.is_cuda)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    input = torch.randn(1, 3, 512, 512).to(device)
 
-    macs, params = profile(model.cuda(), inputs=(input,))
+    macs, params = profile(model.to(device), inputs=(input,))
     print('MACs:', macs, 'Parameters:', params)
 
     return model
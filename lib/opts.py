@@ -42,6 +42,20 @@ class opts(object):
                              help='disable when the input size is not fixed.')
     self.parser.add_argument('--seed', type=int, default=317, 
                              help='random seed') # from CornerNet
+    self.parser.add_argument('--dist_procs', type=int, default=0,
+                             help='training processes per node with '
+                                  'DistributedDataParallel, one per gpu of '
+                                  '--gpus or a share of the cpu cores with '
+                                  '--gpus -1. 0: single process.')
+    self.parser.add_argument('--dist_nodes', type=int, default=1,
+                             help='number of nodes of a distributed run.')
+    self.parser.add_argument('--dist_node_rank', type=int, default=0,
+                             help='rank of this node.')
+    self.parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456',
+                             help='rendezvous of the process group, the '
+                                  'address of node 0 for several nodes.')
+    self.parser.add_argument('--dist_backend', default='gloo',
+                             choices=['gloo', 'nccl'])
 
     # log
     self.parser.add_argument('--print_iter', type=int, default=0, 
@@ -90,6 +104,16 @@ class opts(object):
                              help='batch size')
     self.parser.add_argument('--master_batch_size', type=int, default=-1,
                              help='batch size on the master gpu.')
+    self.parser.add_argument('--micro_batch_size', type=int, default=-1,
+                             help='split every batch into micro-batches of '
+                                  'this size and accumulate their gradients. '
+                                  '-1: batch_size, no accumulation | 0: the '
+                                  'largest size that fits the gpu memory, '
+                                  'probed before training.')
+    self.parser.add_argument('--not_prefetch_train', action='store_true',
+                             help='load and copy every batch to the device '
+                                  'in the training step instead of staging '
+                                  'the next one in a background thread.')
     self.parser.add_argument('--num_iters', type=int, default=-1,
                              help='default: #samples / batch_size.')
     self.parser.add_argument('--val_intervals', type=int, default=5,
@@ -97,6 +121,14 @@ class opts(object):
     self.parser.add_argument('--trainval', action='store_true',
                              help='include validation in training and '
                                   'test on test set')
+    self.parser.add_argument('--amp', default='', choices=['', 'fp16', 'bf16'],
+                             help='train and validate the model under '
+                                  'autocast. fp16: gpu only, with dynamic '
+                                  'loss scaling | bf16: also on the cpu. '
+                                  'the losses stay float32.')
+    self.parser.add_argument('--channels_last', action='store_true',
+                             help='train with the model and its input in '
+                                  'NHWC memory format.')
 
     # test
     self.parser.add_argument('--flip_test', action='store_true',
@@ -109,14 +141,66 @@ class opts(object):
                              help='max number of output objects.') 
     self.parser.add_argument('--not_prefetch_test', action='store_true',
                              help='not use parallal data pre-processing.')
+    self.parser.add_argument('--ms_engine', action='store_true',
+                             help='multi scale test: run all test scales '
+                                  'at once, batching scales of the same '
+                                  'input shape into one forward pass.')
+    self.parser.add_argument('--ms_nms', default='soft',
+                             choices=['soft', 'matrix'],
+                             help='ctdet: merge the scales with soft: '
+                                  'gaussian soft-NMS as external/nms.pyx | '
+                                  'matrix: its parallel approximation '
+                                  '(Matrix NMS).')
+    self.parser.add_argument('--test_batch_size', type=int, default=1,
+                             help='prefetch test: images per forward pass. '
+                                  'with --keep_res only images of the same '
+                                  'padded shape are batched together.')
+    self.parser.add_argument('--test_workers', type=int, default=1,
+                             help='prefetch test: data pre-processing '
+                                  'workers.')
     self.parser.add_argument('--fix_res', action='store_true',
                              help='fix testing resolution or keep '
                                   'the original resolution')
     self.parser.add_argument('--keep_res', action='store_true',
                              help='keep the original resolution'
                                   ' during validation.')
+    self.parser.add_argument('--round_offset', action='store_true',
+                             help='snap the deformable offset scales to '
+                                  'integers at inference (dilated window '
+                                  'gather, no bilinear sampling).')
+    self.parser.add_argument('--decode_engine', default='torch',
+                             choices=['torch', 'fused'],
+                             help='ctdet decode: torch (max-pool nms + topk '
+                                  'over the full heatmap) | fused (peaks '
+                                  'above --decode_thresh only, for cpu).')
+    self.parser.add_argument('--decode_thresh', type=float, default=0.01,
+                             help='min heatmap score of the fused decode.')
+    self.parser.add_argument('--hp_thresh', type=float, default=0.1,
+                             help='multi_pose: min heatmap score of a joint '
+                                  'peak to be matched with a regressed joint.')
+    self.parser.add_argument('--hp_match_block', type=int, default=16,
+                             help='multi_pose: (image, joint) rows matched '
+                                  'per block, bounds the distance matrix; '
+                                  '0 matches all at once.')
+    self.parser.add_argument('--stream', action='store_true',
+                             help='demo: overlap frame decoding, '
+                                  'pre-processing, the network and '
+                                  'post-processing of consecutive frames.')
+    self.parser.add_argument('--stream_workers', type=int, default=2,
+                             help='demo: pre/post-processing threads.')
+    self.parser.add_argument('--stream_queue', type=int, default=4,
+                             help='demo: max frames buffered between stages.')
 
     # dataset
+    self.parser.add_argument('--image_backend', default='file',
+                             choices=['file', 'shard'],
+                             help='file: decode every image with cv2.imread | '
+                                  'shard: read pre-decoded images from the '
+                                  'memory-mapped shards of '
+                                  'tools/pack_image_shards.py.')
+    self.parser.add_argument('--image_shards', default='',
+                             help='root of the image shards, one sub folder '
+                                  'per split. default: data/shards/<dataset>')
     self.parser.add_argument('--not_rand_crop', action='store_true',
                              help='not use the random crop data augmentation'
                                   'from CornerNet.')
@@ -134,6 +218,21 @@ class opts(object):
     self.parser.add_argument('--no_color_aug', action='store_true',
                              help='not use the color augmenation '
                                   'from CornerNet')
+    self.parser.add_argument('--uint8_input', action='store_true',
+                             help='datasets and detectors emit uint8 images '
+                                  'that are normalized (and colour '
+                                  'augmented) on the consuming device, '
+                                  'a quarter of the float32 bytes through '
+                                  'worker queues and pinned memory.')
+    self.parser.add_argument('--batch_aug', action='store_true',
+                             help='ctdet training: load uint8 images and '
+                                  'run the affine warp, colour augmentation '
+                                  'and normalization per batch on the '
+                                  'training device. ignored with --keep_res.')
+    self.parser.add_argument('--batch_aug_canvas', type=int, default=-1,
+                             help='side of the square uint8 canvas images '
+                                  'are letterboxed into for --batch_aug. '
+                                  '-1: max(input_h, input_w) / 0.6')
     # multi_pose
     self.parser.add_argument('--aug_rot', type=float, default=0, 
                              help='probability of applying '
@@ -233,6 +332,8 @@ class opts(object):
     opt.gpus_str = opt.gpus
     opt.gpus = [int(gpu) for gpu in opt.gpus.split(',')]
     opt.gpus = [i for i in range(len(opt.gpus))] if opt.gpus[0] >=0 else [-1]
+    # set per process by utils.distributed.launch
+    opt.rank, opt.local_rank, opt.world_size = 0, 0, 1
     opt.lr_step = [int(i) for i in opt.lr_step.split(',')]
     opt.test_scales = [float(i) for i in opt.test_scales.split(',')]
 
@@ -251,6 +352,10 @@ class opts(object):
     if opt.trainval:
       opt.val_intervals = 100000000
 
+    if opt.amp == 'fp16' and opt.gpus[0] < 0:
+      print('fp16 autocast needs a gpu, using bf16.')
+      opt.amp = 'bf16'
+
     if opt.debug > 0:
       opt.num_workers = 0
       opt.batch_size = 1
@@ -259,14 +364,11 @@ class opts(object):
 
     if opt.master_batch_size == -1:
       opt.master_batch_size = opt.batch_size // len(opt.gpus)
-    rest_batch_size = (opt.batch_size - opt.master_batch_size)
-    opt.chunk_sizes = [opt.master_batch_size]
-    for i in range(len(opt.gpus) - 1):
-      slave_chunk_size = rest_batch_size // (len(opt.gpus) - 1)
-      if i < rest_batch_size % (len(opt.gpus) - 1):
-        slave_chunk_size += 1
-      opt.chunk_sizes.append(slave_chunk_size)
-    print('training chunk_sizes:', opt.chunk_sizes)
+    if opt.debug > 0 or opt.micro_batch_size < 0:
+      opt.micro_batch_size = opt.batch_size
+    # main.py probes the size before training, no accumulation until then
+    opt.probe_micro_batch = opt.micro_batch_size == 0
+    self.set_micro_batch(opt, opt.micro_batch_size or opt.batch_size)
 
     opt.root_dir = os.path.join(os.path.dirname(__file__), '..', '..')
     opt.data_dir = os.path.join(opt.root_dir, 'data')
@@ -281,6 +383,28 @@ class opts(object):
       opt.load_model = os.path.join(model_path, 'model_last.pth')
     return opt
 
+  def set_micro_batch(self, opt, micro_batch_size):
+    '''
+    Loader batches of micro_batch_size, accum_steps of which make one
+    optimizer step of batch_size, each split into the gpu chunk_sizes.
+    '''
+    assert opt.batch_size % micro_batch_size == 0, \
+      'micro_batch_size must divide batch_size'
+    opt.micro_batch_size = micro_batch_size
+    opt.accum_steps = opt.batch_size // micro_batch_size
+    master_chunk_size = max(opt.master_batch_size // opt.accum_steps, 1) \
+                        if len(opt.gpus) > 1 else micro_batch_size
+    rest_batch_size = (micro_batch_size - master_chunk_size)
+    opt.chunk_sizes = [master_chunk_size]
+    for i in range(len(opt.gpus) - 1):
+      slave_chunk_size = rest_batch_size // (len(opt.gpus) - 1)
+      if i < rest_batch_size % (len(opt.gpus) - 1):
+        slave_chunk_size += 1
+      opt.chunk_sizes.append(slave_chunk_size)
+    print('training chunk_sizes:', opt.chunk_sizes,
+          'accumulated over', opt.accum_steps, 'micro-batches')
+    return opt
+
   def update_dataset_info_and_set_heads(self, opt, dataset):
     input_h, input_w = dataset.default_resolution
     opt.mean, opt.std = dataset.mean, dataset.std
@@ -2,21 +2,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import time
 import torch
+from torch.nn.parallel import DistributedDataParallel
 from progress.bar import Bar
 from models.data_parallel import DataParallel
-from utils.utils import AverageMeter
+from utils.utils import AverageMeter, DeviceAverageMeter
+from utils.batch_aug import BatchAugment
+from utils.distributed import reduce_average
+from utils.prefetcher import Prefetcher
+
+
+_AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+# seconds between progress bar redraws, each reads the losses back
+_BAR_INTERVAL = 0.5
 
 
 class ModelWithLoss(torch.nn.Module):
-  def __init__(self, model, loss):
+  def __init__(self, model, loss, amp_dtype=None):
     super(ModelWithLoss, self).__init__()
     self.model = model
     self.loss = loss
+    self.amp_dtype = amp_dtype
   
   def forward(self, batch):
-    outputs = self.model(batch['input'])
+    if self.amp_dtype is None:
+      outputs = self.model(batch['input'])
+    else:
+      # autocast is per thread, so it is entered here for DataParallel
+      with torch.autocast(batch['input'].device.type, dtype=self.amp_dtype):
+        outputs = self.model(batch['input'])
+      # the losses run in float32, outside autocast
+      outputs = [{head: output[head].float() for head in output}
+                 for output in outputs]
     loss, loss_stats = self.loss(outputs, batch)
     return outputs[-1], loss, loss_stats
 
@@ -26,27 +45,58 @@ class BaseTrainer(object):
     self.opt = opt
     self.optimizer = optimizer
     self.loss_stats, self.loss = self._get_losses(opt)
-    self.model_with_loss = ModelWithLoss(model, self.loss)
+    self.model_with_loss = ModelWithLoss(
+      model, self.loss, _AMP_DTYPES.get(opt.amp))
+    # fp16 gradients underflow without loss scaling, bf16 has the range
+    self.scaler = torch.cuda.amp.GradScaler(enabled=opt.amp == 'fp16')
+    self.batch_aug = BatchAugment(opt) \
+                     if opt.batch_aug or opt.uint8_input else None
 
   def set_device(self, gpus, chunk_sizes, device):
-    if len(gpus) > 1:
+    if self.opt.world_size > 1:
+      # one process per device, see utils.distributed
+      self.to_device(device)
+      self.model_with_loss = DistributedDataParallel(
+        self.model_with_loss,
+        device_ids=gpus if device.type == 'cuda' else None)
+    elif len(gpus) > 1:
       self.model_with_loss = DataParallel(
         self.model_with_loss, device_ids=gpus, 
-        chunk_sizes=chunk_sizes).to(device)
+        chunk_sizes=chunk_sizes)
+      self.to_device(device)
     else:
-      self.model_with_loss = self.model_with_loss.to(device)
+      self.to_device(device)
+
+  def to_device(self, device):
+    if self.opt.channels_last:
+      self.model_with_loss = self.model_with_loss.to(
+        memory_format=torch.channels_last)
+    self.model_with_loss = self.model_with_loss.to(device)
+    if self.batch_aug is not None:
+      self.batch_aug.to(device)
     
     for state in self.optimizer.state.values():
       for k, v in state.items():
         if isinstance(v, torch.Tensor):
           state[k] = v.to(device=device, non_blocking=True)
 
+  def prepare_batch(self, batch):
+    for k in batch:
+      if k != 'meta':
+        batch[k] = batch[k].to(device=self.opt.device, non_blocking=True)
+    if batch['input'].dtype == torch.uint8:
+      batch = self.batch_aug(batch)
+    if self.opt.channels_last:
+      batch['input'] = batch['input'].contiguous(
+        memory_format=torch.channels_last)
+    return batch
+
   def run_epoch(self, phase, epoch, data_loader):
     model_with_loss = self.model_with_loss
     if phase == 'train':
       model_with_loss.train()
     else:
-      if len(self.opt.gpus) > 1:
+      if len(self.opt.gpus) > 1 or self.opt.world_size > 1:
         model_with_loss = self.model_with_loss.module
       model_with_loss.eval()
       torch.cuda.empty_cache()
@@ -54,42 +104,64 @@ class BaseTrainer(object):
     opt = self.opt
     results = {}
     data_time, batch_time = AverageMeter(), AverageMeter()
-    avg_loss_stats = {l: AverageMeter() for l in self.loss_stats}
-    num_iters = len(data_loader) if opt.num_iters < 0 else opt.num_iters
+    # summed on the device, read back only to print them
+    avg_loss_stats = DeviceAverageMeter(self.loss_stats, opt.device)
+    # one optimizer step per accum_steps loader batches (micro-batches)
+    accum_steps = opt.accum_steps if phase == 'train' else 1
+    num_iters = len(data_loader) if opt.num_iters < 0 else \
+                min(opt.num_iters * accum_steps, len(data_loader))
     bar = Bar('{}/{}'.format(opt.task, opt.exp_id), max=num_iters)
-    end = time.time()
-    for iter_id, batch in enumerate(data_loader):
+    # the next batch is staged on the device while this step runs
+    batches = map(self.prepare_batch, data_loader) \
+              if opt.not_prefetch_train else \
+              Prefetcher(data_loader, self.prepare_batch, opt.device)
+    end = last_render = time.time()
+    for iter_id, batch in enumerate(batches):
       if iter_id >= num_iters:
         break
       data_time.update(time.time() - end)
 
-      for k in batch:
-        if k != 'meta':
-          batch[k] = batch[k].to(device=opt.device, non_blocking=True)    
-      output, loss, loss_stats = model_with_loss(batch)
-      loss = loss.mean()
-      if phase == 'train':
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+      step = (iter_id + 1) % accum_steps == 0 or iter_id + 1 == num_iters
+      # DistributedDataParallel only reduces the gradients of the last
+      # micro-batch of a step
+      sync = model_with_loss.no_sync() \
+             if phase == 'train' and not step and opt.world_size > 1 else \
+             contextlib.suppress()
+      with sync:
+        output, loss, loss_stats = model_with_loss(batch)
+        loss = loss.mean()
+        if phase == 'train':
+          if iter_id % accum_steps == 0:
+            self.optimizer.zero_grad()
+            # the last step of an epoch may have fewer micro-batches
+            num_micro = min(accum_steps, num_iters - iter_id)
+          self.scaler.scale(loss / num_micro).backward()
+      if phase == 'train' and step:
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
       batch_time.update(time.time() - end)
       end = time.time()
 
-      Bar.suffix = '{phase}: [{0}][{1}/{2}]|Tot: {total:} |ETA: {eta:} '.format(
-        epoch, iter_id, num_iters, phase=phase,
-        total=bar.elapsed_td, eta=bar.eta_td)
-      for l in avg_loss_stats:
-        avg_loss_stats[l].update(
-          loss_stats[l].mean().item(), batch['input'].size(0))
-        Bar.suffix = Bar.suffix + '|{} {:.4f} '.format(l, avg_loss_stats[l].avg)
-      if not opt.hide_data_time:
-        Bar.suffix = Bar.suffix + '|Data {dt.val:.3f}s({dt.avg:.3f}s) ' \
-          '|Net {bt.avg:.3f}s'.format(dt=data_time, bt=batch_time)
+      avg_loss_stats.update(loss_stats, batch['input'].size(0))
       if opt.print_iter > 0:
-        if iter_id % opt.print_iter == 0:
-          print('{}/{}| {}'.format(opt.task, opt.exp_id, Bar.suffix)) 
+        render = iter_id % opt.print_iter == 0
       else:
-        bar.next()
+        render = iter_id + 1 == num_iters or \
+                 end - last_render >= _BAR_INTERVAL
+      if render:
+        last_render = end
+        Bar.suffix = '{phase}: [{0}][{1}/{2}]|Tot: {total:} |ETA: {eta:} '.format(
+          epoch, iter_id, num_iters, phase=phase,
+          total=bar.elapsed_td, eta=bar.eta_td)
+        for l, avg in avg_loss_stats.average().items():
+          Bar.suffix = Bar.suffix + '|{} {:.4f} '.format(l, avg)
+        if not opt.hide_data_time:
+          Bar.suffix = Bar.suffix + '|Data {dt.val:.3f}s({dt.avg:.3f}s) ' \
+            '|Net {bt.avg:.3f}s'.format(dt=data_time, bt=batch_time)
+        if opt.print_iter > 0:
+          print('{}/{}| {}'.format(opt.task, opt.exp_id, Bar.suffix)) 
+        else:
+          bar.next(iter_id + 1 - bar.index)
       
       if opt.debug > 0:
         self.debug(batch, output, iter_id)
@@ -99,7 +171,8 @@ class BaseTrainer(object):
       del output, loss, loss_stats
     
     bar.finish()
-    ret = {k: v.avg for k, v in avg_loss_stats.items()}
+    ret = reduce_average(avg_loss_stats) if opt.world_size > 1 else \
+          avg_loss_stats.average()
     ret['time'] = bar.elapsed_td.total_seconds() / 60.
     return ret, results
   
@@ -0,0 +1,104 @@
+'''
+Micro-batch sizing for --micro_batch_size 0: the peak memory of a training
+step is measured on the master gpu for 1 and 2 samples and extrapolated
+linearly, then the largest micro-batch that divides batch_size and fits is
+verified with one more step (and shrunk on failure).
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from utils.distributed import reduce_min
+
+# headroom for allocator fragmentation and cudnn workspaces
+_MEMORY_FRACTION = 0.9
+
+
+def _probe_batch(dataset, size):
+  samples = [dataset[i % len(dataset)] for i in range(size)]
+  for sample in samples:
+    sample.pop('meta', None)
+  return default_collate(samples)
+
+
+def peak_memory(trainer, dataset, size):
+  '''
+  Peak gpu memory of a forward / backward pass of trainer on size samples
+  of dataset, None when it runs out of memory.
+  '''
+  device = trainer.opt.device
+  model_with_loss = trainer.model_with_loss
+  model_with_loss.train()
+  torch.cuda.empty_cache()
+  torch.cuda.reset_peak_memory_stats(device)
+  peak = None
+  try:
+    batch = trainer.prepare_batch(_probe_batch(dataset, size))
+    _, loss, _ = model_with_loss(batch)
+    trainer.scaler.scale(loss.mean()).backward()
+    peak = torch.cuda.max_memory_allocated(device)
+    del batch, loss
+  except RuntimeError as e:
+    if 'out of memory' not in str(e):
+      raise
+  model_with_loss.zero_grad()
+  torch.cuda.empty_cache()
+  return peak
+
+
+def find_micro_batch_size(trainer, dataset):
+  '''
+  The largest divisor of opt.batch_size whose master gpu chunk trains
+  within _MEMORY_FRACTION of the gpu memory, optimizer state included.
+  trainer must be on its (master) device and not wrapped yet.
+  '''
+  opt = trainer.opt
+  if opt.device.type != 'cuda':
+    print('no gpu to probe, micro_batch_size = batch_size')
+    return opt.batch_size
+  num_gpus = len(opt.gpus)
+  budget = _MEMORY_FRACTION * \
+           torch.cuda.get_device_properties(opt.device).total_memory
+  model_with_loss = trainer.model_with_loss
+  if not trainer.optimizer.state:
+    # Adam allocates two moments per parameter on its first step
+    budget -= 2 * sum(p.numel() * p.element_size()
+                      for p in model_with_loss.parameters())
+  # the probes must not leak into the batch norm statistics
+  buffers = [b.clone() for b in model_with_loss.buffers()]
+
+  peak_1 = peak_memory(trainer, dataset, 1)
+  assert peak_1 is not None and peak_1 <= budget, \
+    'a single sample does not fit the gpu memory'
+  peak_2 = peak_memory(trainer, dataset, 2)
+  per_sample = max(peak_2 - peak_1, 1) if peak_2 is not None else budget
+  fits = int((budget - peak_1) // per_sample) + 1
+
+  sizes = [size for size in range(opt.batch_size, 0, -1)
+           if opt.batch_size % size == 0 and size >= num_gpus]
+  micro_batch_size = sizes[-1]
+  for size in sizes:
+    # the master gpu takes the largest chunk
+    chunk = (size + num_gpus - 1) // num_gpus
+    if chunk > fits:
+      continue
+    peak = peak_memory(trainer, dataset, chunk)
+    print('micro-batch probe: {} samples/gpu, peak {:.2f} GB'.format(
+      chunk, (peak or float('inf')) / 2 ** 30))
+    if peak is not None and peak <= budget:
+      micro_batch_size = size
+      break
+
+  for b, saved in zip(model_with_loss.buffers(), buffers):
+    b.copy_(saved)
+  if opt.world_size > 1:
+    # every process must accumulate the same number of micro-batches
+    micro_batch_size = int(reduce_min(micro_batch_size, opt.device))
+  print('micro_batch_size {} (peak {:.2f} GB + {:.2f} GB/sample, '
+        'budget {:.2f} GB)'.format(micro_batch_size, peak_1 / 2 ** 30,
+                                   per_sample / 2 ** 30, budget / 2 ** 30))
+  return micro_batch_size
@@ -0,0 +1,132 @@
+'''
+Consumer-side input processing for training.
+
+With --uint8_input the sample datasets return the warped image as uint8
+HWC and BatchAugment converts, colour augments and normalizes the whole
+batch on the training device. With --batch_aug (ctdet) the workers only
+draw the random augmentation parameters (they need the affine transform
+for the targets anyway) and letterbox the uint8 image into a fixed square
+canvas; BatchAugment then also does the affine warp. The samples record
+  aug_trans  2x3 map from output pixels to canvas pixels (--batch_aug)
+  aug_color  brightness / contrast / saturation alphas (3), the order they
+             are applied in (3) and the lighting offset (3), only when
+             colour augmentation is on
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import random
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .image import get_affine_transform
+
+# the smallest random crop scale of the sample classes (0.6), the canvas is
+# large enough that zooming in to it never upsamples the canvas
+_MIN_CROP_SCALE = 0.6
+_COLOR_FUNCTIONS = 3
+
+
+def canvas_size(opt):
+  if opt.batch_aug_canvas > 0:
+    return opt.batch_aug_canvas
+  size = max(opt.input_h, opt.input_w) / _MIN_CROP_SCALE
+  return int(math.ceil(size / 32.)) * 32
+
+
+def letterbox(img, size):
+  '''
+  Resize img into the top left corner of a size x size uint8 canvas.
+  Returns the canvas and the x / y scales of the resize.
+  '''
+  height, width = img.shape[0], img.shape[1]
+  k = size / max(height, width)
+  new_w = min(size, int(round(width * k)))
+  new_h = min(size, int(round(height * k)))
+  canvas = np.zeros((size, size, img.shape[2]), dtype=np.uint8)
+  canvas[:new_h, :new_w] = cv2.resize(img, (new_w, new_h))
+  return canvas, new_w / width, new_h / height
+
+
+def canvas_transform(c, s, output_size, kx, ky):
+  '''Output pixel -> canvas pixel map of the crop (c, s) of the image.'''
+  trans = get_affine_transform(c, s, 0, output_size, inv=1)
+  scale = np.array([[kx], [ky]], dtype=np.float64)
+  trans = trans * scale
+  # cv2.resize aligns pixel centers: x' = (x + 0.5) * k - 0.5
+  trans[:, 2] += 0.5 * scale[:, 0] - 0.5
+  return trans.astype(np.float32)
+
+
+def normalize(images, mean, std):
+  '''uint8 N x 3 x H x W images -> normalized float32, on their device.'''
+  return (images.float() / 255. - mean) / std
+
+
+def sample_color(data_rng, eig_val, eig_vec, var=0.4, alphastd=0.1):
+  '''The random parameters of utils.image.color_aug, in the same order.'''
+  order = list(range(_COLOR_FUNCTIONS))
+  random.shuffle(order)
+  alphas = 1. + data_rng.uniform(low=-var, high=var, size=_COLOR_FUNCTIONS)
+  lighting = np.dot(eig_vec, eig_val * data_rng.normal(
+    scale=alphastd, size=(3, )))
+  return np.concatenate([alphas, order, lighting]).astype(np.float32)
+
+
+class BatchAugment(object):
+  def __init__(self, opt):
+    self.output_h, self.output_w = opt.input_h, opt.input_w
+    self.mean = torch.tensor(opt.mean, dtype=torch.float32).view(1, 3, 1, 1)
+    self.std = torch.tensor(opt.std, dtype=torch.float32).view(1, 3, 1, 1)
+    # BGR to gray weights of cv2.cvtColor
+    self.gray = torch.tensor(
+      [0.114, 0.587, 0.299], dtype=torch.float32).view(1, 3, 1, 1)
+    ys, xs = torch.meshgrid(
+      torch.arange(self.output_h, dtype=torch.float32),
+      torch.arange(self.output_w, dtype=torch.float32))
+    self.pixels = torch.stack(
+      [xs, ys, torch.ones_like(xs)], dim=2).view(1, -1, 3)
+
+  def to(self, device):
+    for name in ['mean', 'std', 'gray', 'pixels']:
+      setattr(self, name, getattr(self, name).to(device))
+    return self
+
+  def warp(self, images, trans):
+    batch, height, width, _ = images.shape
+    images = images.permute(0, 3, 1, 2).float() / 255.
+    src = torch.matmul(self.pixels, trans.transpose(1, 2))
+    size = torch.tensor([width, height], dtype=src.dtype, device=src.device)
+    grid = (2 * src + 1) / size - 1
+    grid = grid.view(batch, self.output_h, self.output_w, 2)
+    return F.grid_sample(images, grid, mode='bilinear',
+                         padding_mode='zeros', align_corners=False)
+
+  def color_aug(self, inp, params):
+    alphas, order, lighting = params[:, :3], params[:, 3:6], params[:, 6:]
+    gs = (inp * self.gray).sum(dim=1, keepdim=True)
+    gs_mean = gs.mean(dim=(2, 3), keepdim=True)
+    # brightness, contrast and saturation all blend towards a base image:
+    # inp * alpha + base * (1 - alpha) with base 0, gs_mean or gs
+    for step in range(_COLOR_FUNCTIONS):
+      func = order[:, step].view(-1, 1, 1, 1)
+      alpha = alphas.gather(1, order[:, step:step + 1].long()).view(-1, 1, 1, 1)
+      base = gs_mean * (func == 1).float() + gs * (func == 2).float()
+      inp = inp * alpha + base * (1 - alpha)
+    return inp + lighting.view(-1, 3, 1, 1)
+
+  def __call__(self, batch):
+    if 'aug_trans' in batch:
+      inp = self.warp(batch['input'], batch.pop('aug_trans'))
+    else:
+      inp = batch['input'].permute(0, 3, 1, 2).float() / 255.
+    if 'aug_color' in batch:
+      inp = self.color_aug(inp, batch.pop('aug_color'))
+    batch['input'] = (inp - self.mean) / self.std
+    return batch
@@ -0,0 +1,88 @@
+'''
+Multi-process training with torch.distributed, gloo by default so it also
+scales cpu training over cores and nodes. launch(main, opt) starts
+--dist_procs processes per node (or joins the process group of torchrun)
+and runs main(opt) in each with its rank in opt.rank / opt.world_size, one
+gpu of --gpus or a share of the cpu cores, and its part of --batch_size.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from progress.bar import Bar
+
+
+def is_master(opt):
+  return opt.rank == 0
+
+
+def reduce_average(meter):
+  '''The averages of a DeviceAverageMeter over all processes.'''
+  totals = torch.cat([meter.sum, meter.sum.new_tensor([meter.count])])
+  dist.all_reduce(totals)
+  totals = totals.tolist()
+  return dict(zip(meter.keys, [total / max(totals[-1], 1)
+                               for total in totals[:-1]]))
+
+
+def reduce_min(value, device):
+  value = torch.tensor([value], device=device)
+  dist.all_reduce(value, op=dist.ReduceOp.MIN)
+  return value.item()
+
+
+def _setup(opt, rank, local_rank, world_size, local_size):
+  from opts import opts
+  opt.rank, opt.local_rank, opt.world_size = rank, local_rank, world_size
+  if opt.gpus[0] >= 0:
+    # one gpu per process, main() makes it the only visible one
+    gpus = opt.gpus_str.split(',')
+    opt.gpus_str = gpus[local_rank % len(gpus)]
+    opt.gpus = [0]
+  else:
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+  # --batch_size stays the global batch
+  assert opt.batch_size % world_size == 0, \
+    'batch_size must divide over the processes'
+  opt.batch_size //= world_size
+  opt.master_batch_size = opt.batch_size
+  opts().set_micro_batch(opt, min(opt.micro_batch_size, opt.batch_size))
+  if not is_master(opt):
+    # one copy of the prints and progress bars, the errors still show
+    sys.stdout = open(os.devnull, 'w')
+    Bar.file = sys.stdout
+
+
+def _run(main, opt, rank, local_rank, world_size, local_size, init_method):
+  dist.init_process_group(opt.dist_backend, init_method=init_method,
+                          rank=rank, world_size=world_size)
+  try:
+    _setup(opt, rank, local_rank, world_size, local_size)
+    main(opt)
+  finally:
+    dist.destroy_process_group()
+
+
+def _worker(local_rank, main, opt):
+  _run(main, opt, opt.dist_node_rank * opt.dist_procs + local_rank,
+       local_rank, opt.dist_nodes * opt.dist_procs, opt.dist_procs,
+       opt.dist_url)
+
+
+def launch(main, opt):
+  if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+    # started by torchrun
+    _run(main, opt, int(os.environ['RANK']),
+         int(os.environ.get('LOCAL_RANK', 0)), int(os.environ['WORLD_SIZE']),
+         int(os.environ.get('LOCAL_WORLD_SIZE', 1)), 'env://')
+  elif opt.dist_procs > 0:
+    mp.spawn(_worker, args=(main, opt), nprocs=opt.dist_procs)
+  else:
+    main(opt)
@@ -17,10 +17,9 @@ def flip(img):
   return img[:, :, ::-1].copy()  
 
 def transform_preds(coords, center, scale, output_size):
-    target_coords = np.zeros(coords.shape)
     trans = get_affine_transform(center, scale, 0, output_size, inv=1)
-    for p in range(coords.shape[0]):
-        target_coords[p, 0:2] = affine_transform(coords[p, 0:2], trans)
+    target_coords = np.zeros(coords.shape)
+    target_coords[:, 0:2] = np.dot(coords[:, 0:2], trans[:, :2].T) + trans[:, 2]
     return target_coords
 
 
@@ -123,9 +122,23 @@ def gaussian2D(shape, sigma=1):
     h[h < np.finfo(h.dtype).eps * h.max()] = 0
     return h
 
+_gaussian_cache = {}
+
+def gaussian_kernel(radius):
+  '''
+  The draw_umich_gaussian kernel of an integer radius. Kernels are cached per
+  process (radii are small integers, so the cache stays small) and read-only.
+  '''
+  gaussian = _gaussian_cache.get(radius)
+  if gaussian is None:
+    diameter = 2 * radius + 1
+    gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6)
+    gaussian.flags.writeable = False
+    _gaussian_cache[radius] = gaussian
+  return gaussian
+
 def draw_umich_gaussian(heatmap, center, radius, k=1):
-  diameter = 2 * radius + 1
-  gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6)
+  gaussian = gaussian_kernel(radius)
   
   x, y = int(center[0]), int(center[1])
 
@@ -140,16 +153,66 @@ def draw_umich_gaussian(heatmap, center, radius, k=1):
     np.maximum(masked_heatmap, masked_gaussian * k, out=masked_heatmap)
   return heatmap
 
+def draw_umich_gaussians(heatmap, channels, centers, radii, k=1):
+  '''
+  draw_umich_gaussian for all objects of an image at once.
+  heatmap: C x H x W (C-contiguous), channels: (n,) channel of each object,
+  centers: (n, 2) integer x, y, radii: (n,) integer radii.
+  Objects are grouped by radius and every group is written with a single
+  np.maximum.at, which resolves overlapping gaussians like drawing one by one.
+  '''
+  if not heatmap.flags.c_contiguous:
+    raise ValueError('draw_umich_gaussians needs a C-contiguous heatmap')
+  channels = np.asarray(channels, dtype=np.int64)
+  centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+  radii = np.asarray(radii, dtype=np.int64)
+  _, height, width = heatmap.shape
+  flat = heatmap.reshape(-1)
+  for radius in np.unique(radii):
+    sel = radii == radius
+    radius = int(radius)
+    gaussian = (gaussian_kernel(radius) * k).astype(heatmap.dtype)
+    delta = np.arange(-radius, radius + 1)
+    ys = centers[sel, 1].reshape(-1, 1, 1) + delta.reshape(1, -1, 1)
+    xs = centers[sel, 0].reshape(-1, 1, 1) + delta.reshape(1, 1, -1)
+    valid = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    inds = (channels[sel].reshape(-1, 1, 1) * height + ys) * width + xs
+    values = np.broadcast_to(gaussian, valid.shape)
+    np.maximum.at(flat, inds[valid], values[valid])
+  return heatmap
+
+class GaussianRenderer(object):
+  '''
+  Heatmap target drawing shared by the sample classes. With mse_loss the msra
+  gaussians are drawn right away. Otherwise umich gaussians are queued per
+  heatmap and flush() draws each heatmap with one draw_umich_gaussians call;
+  call it before anything reads or overwrites the heatmap. immediate=True
+  draws umich gaussians right away as well.
+  '''
+  def __init__(self, mse_loss=False, immediate=False):
+    self.mse_loss = mse_loss
+    self.immediate = immediate
+    self._queue = {}
+
+  def draw(self, heatmap, channel, center, radius):
+    if self.mse_loss:
+      draw_msra_gaussian(heatmap[channel], center, radius)
+    elif self.immediate:
+      draw_umich_gaussian(heatmap[channel], center, radius)
+    else:
+      objs = self._queue.setdefault(id(heatmap), (heatmap, []))[1]
+      objs.append((channel, int(center[0]), int(center[1]), radius))
+
+  def flush(self):
+    for heatmap, objs in self._queue.values():
+      objs = np.array(objs, dtype=np.int64)
+      draw_umich_gaussians(heatmap, objs[:, 0], objs[:, 1:3], objs[:, 3])
+    self._queue = {}
+
 def draw_dense_reg(regmap, heatmap, center, value, radius, is_offset=False):
-  diameter = 2 * radius + 1
-  gaussian = gaussian2D((diameter, diameter), sigma=diameter / 6)
+  gaussian = gaussian_kernel(radius)
   value = np.array(value, dtype=np.float32).reshape(-1, 1, 1)
   dim = value.shape[0]
-  reg = np.ones((dim, diameter*2+1, diameter*2+1), dtype=np.float32) * value
-  if is_offset and dim == 2:
-    delta = np.arange(diameter*2+1) - radius
-    reg[0] = reg[0] - delta.reshape(1, -1)
-    reg[1] = reg[1] - delta.reshape(-1, 1)
   
   x, y = int(center[0]), int(center[1])
 
@@ -162,9 +225,13 @@ def draw_dense_reg(regmap, heatmap, center, value, radius, is_offset=False):
   masked_regmap = regmap[:, y - top:y + bottom, x - left:x + right]
   masked_gaussian = gaussian[radius - top:radius + bottom,
                              radius - left:radius + right]
-  masked_reg = reg[:, radius - top:radius + bottom,
-                      radius - left:radius + right]
   if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0: # TODO debug
+    # only the visible window of the regression target is built
+    masked_reg = np.empty((dim,) + masked_gaussian.shape, dtype=np.float32)
+    masked_reg[:] = value
+    if is_offset and dim == 2:
+      masked_reg[0] -= np.arange(-left, right).reshape(1, -1)
+      masked_reg[1] -= np.arange(-top, bottom).reshape(-1, 1)
     idx = (masked_gaussian >= masked_heatmap).reshape(
       1, masked_gaussian.shape[0], masked_gaussian.shape[1])
     masked_regmap = (1-idx) * masked_regmap + idx * masked_reg
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+  # (..., n, 4) x (..., m, 4) -> (..., n, m), with the pixel inclusive areas
+  # (+1) of external/nms.pyx. One coordinate at a time: the (n, m, 2) corner
+  # arrays are several times slower.
+  ax1, ay1, ax2, ay2 = [boxes_a[..., :, k, None] for k in range(4)]
+  bx1, by1, bx2, by2 = [boxes_b[..., None, :, k] for k in range(4)]
+  iw = np.maximum(np.minimum(ax2, bx2) - np.maximum(ax1, bx1) + 1, 0)
+  ih = np.maximum(np.minimum(ay2, by2) - np.maximum(ay1, by1) + 1, 0)
+  inter = iw * ih
+  return inter / ((ax2 - ax1 + 1) * (ay2 - ay1 + 1) +
+                  (bx2 - bx1 + 1) * (by2 - by1 + 1) - inter)
+
+
+def matrix_soft_nms(boxes, scores, classes, sigma=0.5):
+  '''
+  Gaussian soft-NMS of all classes at once in the parallel form of Matrix
+  NMS (SOLOv2): every box is decayed by its worst overlap with a higher
+  scored box of its class, compensated by how much that box was suppressed
+  itself. Returns the decayed scores in the input order.
+  '''
+  order = np.argsort(-scores, kind='mergesort')
+  boxes, classes = boxes[order], classes[order]
+  # iou[i, j]: box i scores higher than box j and has the same class
+  iou = box_iou(boxes, boxes)
+  iou *= np.triu(classes[:, None] == classes[None, :], k=1)
+  compensate = iou.max(axis=0)
+  decay = np.exp(-(iou ** 2 - compensate[:, None] ** 2) / sigma).min(axis=0)
+  decayed = np.empty_like(scores)
+  decayed[order] = scores[order] * decay
+  return decayed
+
+
+def _decay(ov, sigma, Nt, method):
+  # the weights of soft_nms in external/nms.pyx, 1 where boxes do not overlap
+  if method == 1:
+    return np.where(ov > Nt, 1 - ov, 1)
+  elif method == 2:
+    return np.exp(-(ov * ov) / sigma)
+  return np.where(ov > Nt, 0, 1)
+
+
+def batched_soft_nms(dets, classes, sigma=0.5, Nt=0.3, threshold=0.001,
+                     method=0):
+  '''
+  Soft-NMS of external/nms.pyx (method 0 nms, 1 linear, 2 gaussian) for
+  every class of dets (N, 5 + extra) at once. The boxes are laid out as
+  classes x boxes with the iou weights of each class computed up front, so
+  a step takes the highest remaining box of every class and decays the
+  rest of its class with one gather. Decays dets[:, 4] in place and returns
+  the indices of the rows kept, by class and in the order they were
+  selected.
+
+  The kept boxes and their scores are those of nms.pyx, up to float rounding
+  and the choice between equal scores. Unlike nms.pyx nothing is moved: the
+  extra columns (the keypoints of soft_nms_39) stay with their box, and the
+  suppressed boxes are dropped by the caller instead of being left behind
+  as stale copies past the kept rows.
+  '''
+  if len(dets) == 0:
+    return np.zeros(0, dtype=np.int64)
+  order = np.argsort(classes, kind='mergesort')
+  counts = np.unique(classes[order], return_counts=True)[1]
+  size = counts.max()
+  valid = np.arange(size)[None] < counts[:, None]
+  rows = np.zeros(valid.shape, dtype=np.int64)
+  rows[valid] = order
+  boxes = dets[rows, :4].astype(np.float64)
+  ov = box_iou(boxes, boxes)
+  overlap = ov > 0
+  weight = _decay(ov, sigma, Nt, method)
+
+  scores = np.where(valid, dets[rows, 4], 0).astype(np.float64)
+  alive = valid.copy()
+  step = np.full(valid.shape, size)
+  labels = np.arange(len(counts))
+  for i in range(size):
+    # the highest remaining box of every class that has one left
+    best = np.where(alive, scores, -np.inf).argmax(axis=1)
+    left = alive[labels, best]
+    step[labels[left], best[left]] = i
+    alive[labels, best] = False
+    if not alive.any():
+      break
+    scores = np.where(alive, scores * weight[labels, best], scores)
+    # as in nms.pyx only the boxes that overlap the pick are discarded
+    alive &= ~(overlap[labels, best] & (scores < threshold))
+  dets[rows[valid], 4] = scores[valid]
+  label, pos = np.nonzero(step < size)
+  keep = np.lexsort((step[label, pos], label))
+  return rows[label[keep], pos[keep]]
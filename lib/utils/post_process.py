@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from collections.abc import Mapping
+
 import numpy as np
 from .image import transform_preds
 from .ddd_utils import ddd2locrot
@@ -80,23 +82,61 @@ def ddd_post_process(dets, c, s, calibs, opt):
   return dets
 
 
+class CtdetResult(Mapping):
+  '''
+  Columnar ctdet detections of one image: dets (N, 5) float32 rows of
+  [x1, y1, x2, y2, score] sorted by their 1-based class ids in classes (N,).
+  Indexing with a class id returns that class's rows as a view of dets, so
+  code written against the old {class: (n, 5) array} dict keeps working.
+  '''
+  def __init__(self, dets, classes, num_classes):
+    order = np.argsort(classes, kind='mergesort')
+    self.dets = np.ascontiguousarray(dets[order], dtype=np.float32)
+    self.classes = classes[order].astype(np.int32)
+    self.num_classes = num_classes
+    self._bounds = np.searchsorted(
+      self.classes, np.arange(1, num_classes + 2))
+
+  @property
+  def boxes(self):
+    return self.dets[:, :4]
+
+  @property
+  def scores(self):
+    return self.dets[:, 4]
+
+  def __getitem__(self, j):
+    if not isinstance(j, (int, np.integer)) or not 1 <= j <= self.num_classes:
+      raise KeyError(j)
+    return self.dets[self._bounds[j - 1]:self._bounds[j]]
+
+  def __iter__(self):
+    return iter(range(1, self.num_classes + 1))
+
+  def __len__(self):
+    return self.num_classes
+
+  def select(self, keep):
+    return CtdetResult(self.dets[keep], self.classes[keep], self.num_classes)
+
+  @staticmethod
+  def concat(results):
+    return CtdetResult(
+      np.concatenate([result.dets for result in results], axis=0),
+      np.concatenate([result.classes for result in results], axis=0),
+      results[0].num_classes)
+
+
 def ctdet_post_process(dets, c, s, h, w, num_classes):
   # dets: batch x max_dets x dim
-  # return 1-based class det dict
+  # return one CtdetResult (1-based classes) per image
   ret = []
   for i in range(dets.shape[0]):
-    top_preds = {}
-    dets[i, :, :2] = transform_preds(
-          dets[i, :, 0:2], c[i], s[i], (w, h))
-    dets[i, :, 2:4] = transform_preds(
-          dets[i, :, 2:4], c[i], s[i], (w, h))
-    classes = dets[i, :, -1]
-    for j in range(num_classes):
-      inds = (classes == j)
-      top_preds[j + 1] = np.concatenate([
-        dets[i, inds, :4].astype(np.float32),
-        dets[i, inds, 4:5].astype(np.float32)], axis=1).tolist()
-    ret.append(top_preds)
+    boxes = transform_preds(
+      dets[i, :, :4].reshape(-1, 2), c[i], s[i], (w, h)).reshape(-1, 4)
+    ret.append(CtdetResult(
+      np.concatenate([boxes, dets[i, :, 4:5]], axis=1),
+      dets[i, :, -1].astype(np.int32) + 1, num_classes))
   return ret
 
 
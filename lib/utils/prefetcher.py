@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import queue
+import threading
+
+import torch
+
+_END = object()
+
+
+class _Failure(object):
+  def __init__(self, exc):
+    self.exc = exc
+
+
+class Prefetcher(object):
+  '''
+    Double-buffered iterator over a DataLoader for the training loop: a
+    background thread fetches batch i + 1 and runs prepare on it (the host
+    to device copy and the batch augmentation of BaseTrainer.prepare_batch)
+    while the caller runs step i. At most two prepared batches exist at a
+    time, the one in use and the one staged.
+
+    On cuda prepare runs on a side stream, so the copies overlap the compute
+    of the previous step; the consumer's stream waits for the batch with an
+    event. On the cpu the thread alone hides the loading.
+  '''
+  def __init__(self, data_loader, prepare, device):
+    self.data_loader = data_loader
+    self.prepare = prepare
+    self.device = device
+
+  def __len__(self):
+    return len(self.data_loader)
+
+  def _put(self, q, item, stop):
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _fill(self, batches, q, slots, stop):
+    stream = torch.cuda.Stream(self.device) \
+             if self.device.type == 'cuda' else None
+    try:
+      while not stop.is_set():
+        # a free buffer: the caller is done with the batch before last
+        if not slots.acquire(timeout=0.1):
+          continue
+        try:
+          batch = next(batches)
+        except StopIteration:
+          break
+        event = None
+        if stream is not None:
+          with torch.cuda.stream(stream):
+            batch = self.prepare(batch)
+          event = torch.cuda.Event()
+          event.record(stream)
+        else:
+          batch = self.prepare(batch)
+        if not self._put(q, (batch, event), stop):
+          return
+      self._put(q, _END, stop)
+    except Exception as e:
+      self._put(q, _Failure(e), stop)
+
+  def __iter__(self):
+    q = queue.Queue()
+    slots = threading.Semaphore(2)
+    stop = threading.Event()
+    thread = threading.Thread(
+      target=self._fill, args=(iter(self.data_loader), q, slots, stop))
+    thread.daemon = True
+    thread.start()
+    try:
+      while True:
+        item = q.get()
+        if item is _END:
+          break
+        if isinstance(item, _Failure):
+          raise item.exc
+        batch, event = item
+        if event is not None:
+          current = torch.cuda.current_stream(self.device)
+          current.wait_event(event)
+          # the side stream allocated them, keep them alive for this one
+          for value in batch.values():
+            if torch.is_tensor(value) and value.is_cuda:
+              value.record_stream(current)
+        yield batch
+        slots.release()
+    finally:
+      stop.set()
+      thread.join()
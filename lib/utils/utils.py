@@ -20,4 +20,26 @@ class AverageMeter(object):
         self.sum += val * n
         self.count += n
         if self.count > 0:
-          self.avg = self.sum / self.count
\ No newline at end of file
+          self.avg = self.sum / self.count
+
+
+class DeviceAverageMeter(object):
+    """
+    Sample-weighted running averages of a dict of (loss) tensors, summed on
+    their device so that updating never waits for it; average() reads back.
+    """
+    def __init__(self, keys, device):
+        self.keys = list(keys)
+        self.sum = torch.zeros(len(self.keys), dtype=torch.float64,
+                               device=device)
+        self.count = 0
+
+    def update(self, vals, n=1):
+        self.sum += torch.stack(
+            [vals[k].detach().mean().double() for k in self.keys]) * n
+        self.count += n
+
+    def average(self):
+        if self.count == 0:
+            return {k: 0. for k in self.keys}
+        return dict(zip(self.keys, (self.sum / self.count).tolist()))
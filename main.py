@@ -8,22 +8,28 @@ import os
 
 import torch
 import torch.utils.data
+from torch.utils.data.distributed import DistributedSampler
 from opts import opts
 from models.model import create_model, load_model, save_model
 from models.data_parallel import DataParallel
 from logger import Logger
 from datasets.dataset_factory import get_dataset
+from datasets.shape_buckets import ShapeBucketSampler, input_shapes
 from trains.train_factory import train_factory
+from trains.micro_batch import find_micro_batch_size
+from utils.distributed import launch, is_master
 
 
 def main(opt):
-  torch.manual_seed(opt.seed)
+  # a different augmentation stream per process, DDP broadcasts the weights
+  torch.manual_seed(opt.seed + opt.rank)
   torch.backends.cudnn.benchmark = not opt.not_cuda_benchmark and not opt.test
   Dataset = get_dataset(opt.dataset, opt.task)
   opt = opts().update_dataset_info_and_set_heads(opt, Dataset)
   print(opt)
 
-  logger = Logger(opt)
+  master = is_master(opt)
+  logger = Logger(opt) if master else None
 
   os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpus_str
   opt.device = torch.device('cuda' if opt.gpus[0] >= 0 else 'cpu')
@@ -38,65 +44,103 @@ def main(opt):
 
   Trainer = train_factory[opt.task]
   trainer = Trainer(opt, model, optimizer)
+  if opt.probe_micro_batch and not opt.test:
+    # probe on the master gpu before DataParallel splits the batches
+    trainer.to_device(opt.device)
+    opt = opts().set_micro_batch(
+      opt, find_micro_batch_size(trainer, Dataset(opt, 'train')))
   trainer.set_device(opt.gpus, opt.chunk_sizes, opt.device)
 
   print('Setting up data...')
+  val_dataset = Dataset(opt, 'val')
+  # validation losses are reduced over the processes, test runs whole
+  distributed = opt.world_size > 1
   val_loader = torch.utils.data.DataLoader(
-      Dataset(opt, 'val'), 
+      val_dataset, 
       batch_size=1, 
       shuffle=False,
+      sampler=DistributedSampler(val_dataset, shuffle=False) \
+              if distributed and not opt.test else None,
       num_workers=1,
       pin_memory=True
   )
 
   if opt.test:
     _, preds = trainer.val(0, val_loader)
-    val_loader.dataset.run_eval(preds, opt.save_dir)
+    if master:
+      val_loader.dataset.run_eval(preds, opt.save_dir)
     return
 
-  train_loader = torch.utils.data.DataLoader(
-      Dataset(opt, 'train'), 
-      batch_size=opt.batch_size, 
-      shuffle=True,
-      num_workers=opt.num_workers,
-      pin_memory=True,
-      drop_last=True
-  )
+  train_dataset = Dataset(opt, 'train')
+  if opt.keep_res:
+    # every image has its own padded shape, batch equal shapes only
+    train_sampler = ShapeBucketSampler(
+      input_shapes(train_dataset, opt), opt.micro_batch_size,
+      shuffle=True, drop_last=True, num_replicas=opt.world_size,
+      rank=opt.rank, seed=opt.seed)
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_sampler=train_sampler,
+        num_workers=opt.num_workers,
+        pin_memory=True
+    )
+  else:
+    train_sampler = DistributedSampler(train_dataset, seed=opt.seed) \
+                    if distributed else None
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, 
+        batch_size=opt.micro_batch_size, 
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        num_workers=opt.num_workers,
+        pin_memory=True,
+        drop_last=True
+    )
 
   print('Starting training...')
   best = 1e10
   for epoch in range(start_epoch + 1, opt.num_epochs + 1):
     mark = epoch if opt.save_all else 'last'
+    if train_sampler is not None:
+      train_sampler.set_epoch(epoch)
     log_dict_train, _ = trainer.train(epoch, train_loader)
-    logger.write('epoch: {} |'.format(epoch))
-    for k, v in log_dict_train.items():
-      logger.scalar_summary('train_{}'.format(k), v, epoch)
-      logger.write('{} {:8f} | '.format(k, v))
+    # the logs and checkpoints are written by the master process only
+    if master:
+      logger.write('epoch: {} |'.format(epoch))
+      for k, v in log_dict_train.items():
+        logger.scalar_summary('train_{}'.format(k), v, epoch)
+        logger.write('{} {:8f} | '.format(k, v))
     if opt.val_intervals > 0 and epoch % opt.val_intervals == 0:
-      save_model(os.path.join(opt.save_dir, 'model_{}.pth'.format(mark)), 
-                 epoch, model, optimizer)
+      if master:
+        save_model(os.path.join(opt.save_dir, 'model_{}.pth'.format(mark)), 
+                   epoch, model, optimizer)
       with torch.no_grad():
         log_dict_val, preds = trainer.val(epoch, val_loader)
-      for k, v in log_dict_val.items():
-        logger.scalar_summary('val_{}'.format(k), v, epoch)
-        logger.write('{} {:8f} | '.format(k, v))
+      if master:
+        for k, v in log_dict_val.items():
+          logger.scalar_summary('val_{}'.format(k), v, epoch)
+          logger.write('{} {:8f} | '.format(k, v))
       if log_dict_val[opt.metric] < best:
         best = log_dict_val[opt.metric]
-        save_model(os.path.join(opt.save_dir, 'model_best.pth'), 
-                   epoch, model)
-    else:
+        if master:
+          save_model(os.path.join(opt.save_dir, 'model_best.pth'), 
+                     epoch, model)
+    elif master:
       save_model(os.path.join(opt.save_dir, 'model_last.pth'), 
                  epoch, model, optimizer)
-    logger.write('\n')
+    if master:
+      logger.write('\n')
     if epoch in opt.lr_step:
-      save_model(os.path.join(opt.save_dir, 'model_{}.pth'.format(epoch)), 
-                 epoch, model, optimizer)
+      if master:
+        save_model(os.path.join(opt.save_dir, 'model_{}.pth'.format(epoch)), 
+                   epoch, model, optimizer)
       lr = opt.lr * (0.1 ** (opt.lr_step.index(epoch) + 1))
       print('Drop LR to', lr)
       for param_group in optimizer.param_groups:
           param_group['lr'] = lr
-  logger.close()
+  if master:
+    logger.close()
 
 if __name__ == '__main__':
   opt = opts().parse()
-  main(opt)
\ No newline at end of file
+  launch(main, opt)
\ No newline at end of file
@@ -2,3 +2,5 @@ from .quantization_utils.quantize_model import quantize_shufflenetv2_dcn, quanti
 from .quantization_utils.data_utils import getData, getGaussianData
 from .train_utils import train, test
 from .quantization_utils.quant_utils import SymmetricQuantFunction, AsymmetricQuantFunction
+from .quantization_utils.integer_export import export_integer_graph, IntegerExecutor, integer_parity
+from .quant_modules import freeze_quantized_weights
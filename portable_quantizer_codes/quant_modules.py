@@ -18,6 +18,126 @@ sys.path.append('/rscratch/zhendong/yaohuic/CenterNet/src/lib/models/')
 from external.functions.dcn_deform_conv import deform_conv
 
 
+def weight_min_max(weight, per_channel, weight_percentile):
+    # per-output-channel (or per-tensor) range used to quantize a conv weight
+    if per_channel:
+        x_transform = weight.data.contiguous().view(weight.shape[0], -1)
+
+        if not weight_percentile:
+            w_min = x_transform.min(dim=1).values
+            w_max = x_transform.max(dim=1).values
+        elif weight_percentile:
+            lower_percentile = 0.1
+            upper_percentile = 99.9
+            input_length = x_transform.shape[1]
+
+            if input_length < 10:
+                w_min = x_transform.min(dim=1).values * 0.95
+                w_max = x_transform.max(dim=1).values * 0.95
+            else:
+                lower_index = math.ceil(input_length * lower_percentile * 0.01)
+                upper_index = math.ceil(input_length * upper_percentile * 0.01)
+
+                w_min = torch.kthvalue(x_transform, k=lower_index, dim=1).values
+                w_max = torch.kthvalue(x_transform, k=upper_index, dim=1).values
+
+    elif not per_channel:
+        if not weight_percentile:
+            w_min = weight.data.min()
+            w_max = weight.data.max()
+        elif weight_percentile:
+            w_min, w_max = get_percentile_min_max(weight.view(-1), 0.1, 99.9, output_tensor=True)
+    return w_min, w_max
+
+
+def quantize_conv_weight(module, weight, bias, show=False):
+    # fake-quantize a (BN-folded) conv weight/bias with the settings of `module`;
+    # show=True also returns the weight scale and zero point
+    scale = zero_point = None
+    if not module.full_precision_flag:
+        w_min, w_max = weight_min_max(weight, module.per_channel, module.weight_percentile)
+        if module.quantize_bias:
+            if module.per_channel:
+                raise NotImplementedError('channel-wise quantize bias is not supported')
+            bias = module.weight_function(bias, module.bias_bit, bias.data.min(), bias.data.max(), False, False)
+        if show:
+            weight, scale, zero_point = module.weight_function(weight, module.weight_bit, w_min, w_max,
+                                                               module.per_channel, module.weight_percentile, True)
+        else:
+            weight = module.weight_function(weight, module.weight_bit, w_min, w_max, module.per_channel,
+                                            module.weight_percentile)
+    if show:
+        return weight, bias, scale, zero_point
+    return weight, bias
+
+
+class QuantWeightModule(Module):
+    # base of the quantized conv modules: with `frozen` set, eval-mode forwards reuse the
+    # quantized (BN-folded) weights instead of recomputing them. The cache is filled by eval(),
+    # device/dtype moves and freeze_quantized_weights, and held in non-persistent buffers, so
+    # that nn.DataParallel copies it to every replica instead of each replica recomputing it
+    # and throwing it away; train() and load_state_dict drop it
+    def __init__(self):
+        super(QuantWeightModule, self).__init__()
+        self.frozen = False
+        self.register_buffer('frozen_weight', None, persistent=False)
+        self.register_buffer('frozen_bias', None, persistent=False)
+
+    def quantized_weight(self, show=False):
+        raise NotImplementedError
+
+    def inference_weight(self):
+        if self.training or not self.frozen:
+            return self.quantized_weight()
+        if self.frozen_weight is None:
+            # e.g. after load_state_dict, the children were not loaded yet when it dropped the cache
+            self.update_weight_cache()
+        return self.frozen_weight, self.frozen_bias
+
+    def clear_weight_cache(self):
+        self.frozen_weight = None
+        self.frozen_bias = None
+
+    def update_weight_cache(self):
+        # fill the cache of a frozen module in eval mode, drop it otherwise
+        self.clear_weight_cache()
+        if self.frozen and not self.training:
+            with torch.no_grad():
+                weight, bias = self.quantized_weight()
+            # detached: an assigned Parameter would be registered as a parameter
+            self.frozen_weight = weight.detach()
+            self.frozen_bias = None if bias is None else bias.detach()
+
+    def train(self, mode=True):
+        super(QuantWeightModule, self).train(mode)
+        self.update_weight_cache()
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        self.clear_weight_cache()
+        super(QuantWeightModule, self)._apply(fn, *args, **kwargs)
+        self.update_weight_cache()
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_weight_cache()
+        return super(QuantWeightModule, self)._load_from_state_dict(*args, **kwargs)
+
+
+def freeze_quantized_weights(model, enabled=True):
+    '''
+    Toggle the frozen-inference weight cache on every quantized conv of `model`.
+    Returns the number of modules switched.
+    '''
+    count = 0
+    for m in model.modules():
+        if isinstance(m, QuantWeightModule):
+            m.frozen = enabled
+            m.update_weight_cache()
+            count += 1
+    return count
+
+
 ## basic quantization modules
 class QuantLinear(_linear):
     def __init__(self,
@@ -304,7 +424,7 @@ class QuantAct(Module):
             return x
 
 
-class Quant_Conv2d(Module):
+class Quant_Conv2d(QuantWeightModule):
     def __init__(self,
                  weight_bit,
                  bias_bit=None, 
@@ -350,55 +470,19 @@ class Quant_Conv2d(Module):
         except AttributeError:
             self.bias = None
 
-    def forward(self, x):
-        w = self.weight
-
-        if self.per_channel:
-            x_transform = w.data.contiguous().view(self.out_channels, -1)
-
-            if not self.weight_percentile:
-                w_min = x_transform.min(dim=1).values
-                w_max = x_transform.max(dim=1).values
-            elif self.weight_percentile:
-                lower_percentile = 0.1
-                upper_percentile = 99.9
-                input_length = x_transform.shape[1]
-
-                if input_length < 10:
-                    w_min = x_transform.min(dim=1).values * 0.95
-                    w_max = x_transform.max(dim=1).values * 0.95
-                else:
-                    lower_index = math.ceil(input_length * lower_percentile * 0.01)
-                    upper_index = math.ceil(input_length * upper_percentile * 0.01)
-
-                    w_min = torch.kthvalue(x_transform, k=lower_index, dim=1).values
-                    w_max = torch.kthvalue(x_transform, k=upper_index, dim=1).values
-            if self.quantize_bias:
-                raise NotImplementedError('channel-wise quantize bias is not supported')
-
-        elif not self.per_channel:
-            if not self.weight_percentile:
-                w_min = w.data.min()
-                w_max = w.data.max()
-            elif self.weight_percentile:
-                w_min, w_max = get_percentile_min_max(w.view(-1), 0.1, 99.9, output_tensor=True)
-            if self.quantize_bias:
-                b_min = self.bias.min()
-                b_max = self.bias.max()
-
-        if not self.full_precision_flag:
-            w = self.weight_function(self.weight, self.weight_bit, w_min, w_max, self.per_channel, self.weight_percentile)
-            if self.quantize_bias:
-                b = self.weight_function(self.bias, self.bias_bit, b_min, b_max, self.per_channel, False)
-        else:
-            w = self.weight
+    def quantized_weight(self, show=False):
+        return quantize_conv_weight(self, self.weight, self.bias, show)
 
+    def forward(self, x):
+        w, _ = self.inference_weight()
         # The next line is used to check the correctness of quantization
         # print('unique wts = {}'.format(w.unique().numel()))
+        # the float bias, not the quantized one: checkpoints were calibrated
+        # this way, and the integer exporter takes the same bias
         return F.conv2d(x, w, self.bias, self.stride, self.padding, self.dilation, self.groups)
 
 
-class QuantBnConv2d(Module):
+class QuantBnConv2d(QuantWeightModule):
     def __init__(self,
                  weight_bit,
                  bias_bit=None, 
@@ -475,6 +559,10 @@ class QuantBnConv2d(Module):
         # self.running_mean.add_((self.momentum - 1.) * self.running_mean + (1. - self.momentum) * y_mean.detach())
         # self.running_var.add_((self.momentum - 1.) * self.running_var + (1. - self.momentum) * y_var.detach())
 
+        scaled_weight, scaled_bias = self.inference_weight()
+        return F.conv2d(x, scaled_weight, scaled_bias, self.conv.stride, self.conv.padding, self.conv.dilation, self.conv.groups)
+
+    def folded_weight(self):
         running_std = torch.sqrt(self.bn.running_var + self.bn.eps)
         scale_factor = self.bn.weight / running_std
         scaled_weight = self.conv.weight * scale_factor.reshape([self.conv.out_channels, 1, 1, 1])
@@ -483,61 +571,10 @@ class QuantBnConv2d(Module):
         else:
             scaled_bias = torch.zeros_like(self.bn.running_mean)
         scaled_bias = (scaled_bias - self.bn.running_mean) * scale_factor + self.bn.bias
+        return scaled_weight, scaled_bias
 
-        if not self.full_precision_flag:
-            if self.per_channel:
-                x_transform = scaled_weight.data.contiguous().view(self.conv.out_channels, -1)
-
-                if not self.weight_percentile:
-                    w_min = x_transform.min(dim=1).values
-                    w_max = x_transform.max(dim=1).values
-
-                elif self.weight_percentile:
-                    lower_percentile = 0.1
-                    upper_percentile = 99.9
-                    input_length = x_transform.shape[1]
-
-                    if input_length < 10:
-                        w_min = x_transform.min(dim=1).values * 0.95
-                        w_max = x_transform.max(dim=1).values * 0.95
-                    else:
-                        lower_index = math.ceil(input_length * lower_percentile * 0.01)
-                        upper_index = math.ceil(input_length * upper_percentile * 0.01)
-
-                        w_min = torch.kthvalue(x_transform, k=lower_index, dim=1).values
-                        w_max = torch.kthvalue(x_transform, k=upper_index, dim=1).values
-
-                if self.quantize_bias:
-                    raise NotImplementedError
-
-            elif not self.per_channel:
-                if not self.weight_percentile:
-                    w_min = scaled_weight.data.min()
-                    w_max = scaled_weight.data.max()
-                elif self.weight_percentile:
-                    w_min, w_max = get_percentile_min_max(scaled_weight.view(-1), lower_percentile, upper_percentile, output_tensor=True)
-
-                if self.quantize_bias:
-                    b_min = scaled_bias.data.min()
-                    b_max = scaled_bias.data.max()
-
-            scaled_weight = self.weight_function(scaled_weight, self.weight_bit, w_min, w_max, self.per_channel, self.weight_percentile)
-            if self.quantize_bias:
-                scaled_bias = self.weight_function(scaled_bias, self.bias_bit, b_min, b_max, self.per_channel, False)
-
-
-
-        # w_view = (out_channels, 1, 1, 1)
-
-        # weight, bias = self._fold_bn()
-
-        # if self.weight_percentile:
-        #     lower_percentile = 1.
-        #     upper_percentile = 99.
-
-
-
-        return F.conv2d(x, scaled_weight, scaled_bias, self.conv.stride, self.conv.padding, self.conv.dilation, self.conv.groups)
+    def quantized_weight(self, show=False):
+        return quantize_conv_weight(self, *self.folded_weight(), show=show)
 
     # def _fold_bn(self):
     #     running_std = torch.sqrt(self.running_var + self.eps)
@@ -550,7 +587,7 @@ class QuantBnConv2d(Module):
     #     return weight, bias
 
 
-class QuantDeformConv2d(Module):
+class QuantDeformConv2d(QuantWeightModule):
     # quantize DeformConv
     def __init__(self,
                  weight_bit,
@@ -598,54 +635,15 @@ class QuantDeformConv2d(Module):
         except AttributeError:
             self.bias = None
 
-    def forward(self, x, offset):
-        w = self.weight
-
-        if self.per_channel:
-            x_transform = w.data.contiguous().view(self.out_channels, -1)
-
-            if not self.weight_percentile:
-                w_min = x_transform.min(dim=1).values
-                w_max = x_transform.max(dim=1).values
-            elif self.weight_percentile:
-                lower_percentile = 0.1
-                upper_percentile = 99.9
-                input_length = x_transform.shape[1]
-
-                if input_length < 10:
-                    w_min = x_transform.min(dim=1).values * 0.95
-                    w_max = x_transform.max(dim=1).values * 0.95
-                else:
-                    lower_index = math.ceil(input_length * lower_percentile * 0.01)
-                    upper_index = math.ceil(input_length * upper_percentile * 0.01)
-
-                    w_min = torch.kthvalue(x_transform, k=lower_index, dim=1).values
-                    w_max = torch.kthvalue(x_transform, k=upper_index, dim=1).values
-            if self.quantize_bias:
-                raise NotImplementedError('channel-wise quantize bias is not supported')
-
-        elif not self.per_channel:
-            if not self.weight_percentile:
-                w_min = w.data.min()
-                w_max = w.data.max()
-            elif self.weight_percentile:
-                w_min, w_max = get_percentile_min_max(w.view(-1), 0.1, 99.9, output_tensor=True)
-            if self.quantize_bias:
-                b_min = self.bias.min()
-                b_max = self.bias.max()
-
-        if not self.full_precision_flag:
-            w = self.weight_function(self.weight, self.weight_bit, w_min, w_max, self.per_channel,
-                                     self.weight_percentile)
-            if self.quantize_bias:
-                b = self.weight_function(self.bias, self.bias_bit, b_min, b_max, self.per_channel, False)
-        else:
-            w = self.weight
+    def quantized_weight(self, show=False):
+        return quantize_conv_weight(self, self.weight, self.bias, show)
 
+    def forward(self, x, offset):
+        w = self.inference_weight()[0]
         return deform_conv(x, offset, w, self.stride, self.padding, self.dilation, self.groups, self.deformable_groups)
 
 
-class QuantBnDeformConv2d(Module):
+class QuantBnDeformConv2d(QuantWeightModule):
     def __init__(self,
                  weight_bit,
                  bias_bit=None,
@@ -681,8 +679,7 @@ class QuantBnDeformConv2d(Module):
             conv_s, self.weight_bit, self.bias_bit, self.conv.groups, self.per_channel, self.weight_percentile, False)
         return s
 
-    def forward(self, x, offset):
-
+    def folded_weight(self):
         running_std = torch.sqrt(self.bn.running_var + self.bn.eps)
         scale_factor = self.bn.weight / running_std
         scaled_weight = self.conv.weight * scale_factor.reshape([self.conv.out_channels, 1, 1, 1])
@@ -691,49 +688,13 @@ class QuantBnDeformConv2d(Module):
         else:
             scaled_bias = torch.zeros_like(self.bn.running_mean)
         scaled_bias = (scaled_bias - self.bn.running_mean) * scale_factor + self.bn.bias
+        return scaled_weight, scaled_bias
 
-        if not self.full_precision_flag:
-            if self.per_channel:
-                x_transform = scaled_weight.data.contiguous().view(self.conv.out_channels, -1)
-
-                if not self.weight_percentile:
-                    w_min = x_transform.min(dim=1).values
-                    w_max = x_transform.max(dim=1).values
-
-                elif self.weight_percentile:
-                    lower_percentile = 0.1
-                    upper_percentile = 99.9
-                    input_length = x_transform.shape[1]
-
-                    if input_length < 10:
-                        w_min = x_transform.min(dim=1).values * 0.95
-                        w_max = x_transform.max(dim=1).values * 0.95
-                    else:
-                        lower_index = math.ceil(input_length * lower_percentile * 0.01)
-                        upper_index = math.ceil(input_length * upper_percentile * 0.01)
-
-                        w_min = torch.kthvalue(x_transform, k=lower_index, dim=1).values
-                        w_max = torch.kthvalue(x_transform, k=upper_index, dim=1).values
-
-                if self.quantize_bias:
-                    raise NotImplementedError
-
-            elif not self.per_channel:
-                if not self.weight_percentile:
-                    w_min = scaled_weight.data.min()
-                    w_max = scaled_weight.data.max()
-                elif self.weight_percentile:
-                    w_min, w_max = get_percentile_min_max(scaled_weight.view(-1), lower_percentile, upper_percentile,
-                                                          output_tensor=True)
-
-                if self.quantize_bias:
-                    b_min = scaled_bias.data.min()
-                    b_max = scaled_bias.data.max()
-
-            scaled_weight = self.weight_function(scaled_weight, self.weight_bit, w_min, w_max, self.per_channel, self.weight_percentile)
-            if self.quantize_bias:
-                scaled_bias = self.weight_function(scaled_bias, self.bias_bit, b_min, b_max, self.per_channel, False)
+    def quantized_weight(self, show=False):
+        return quantize_conv_weight(self, *self.folded_weight(), show=show)
 
+    def forward(self, x, offset):
+        scaled_weight, scaled_bias = self.inference_weight()
         output = deform_conv(x, offset, scaled_weight, self.conv.stride, self.conv.padding, self.conv.dilation,
                         self.conv.groups, self.conv.deformable_groups)
         return output + scaled_bias.view(1, -1, 1, 1).expand(output.size())
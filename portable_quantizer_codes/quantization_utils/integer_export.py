@@ -0,0 +1,362 @@
+"""
+Integer export of a fake-quantized ShuffleNetV2-DCN (see quantize_shufflenetv2_dcn).
+
+export_integer_graph turns the trained Quant* modules into a flat list of integer
+ops with precomputed scales and zero points:
+
+    real = scale * (q - zero_point)
+
+Weights are stored as int8 arrays (int4 weights use the same container), biases
+as int32 in units of input_scale * weight_scale, and every conv produces an
+int32 accumulator that is requantized into the next activation with a
+precomputed per-channel multiplier. IntegerExecutor is the reference runtime for
+that graph; it keeps the integer values in float64 tensors, which represent
+int32 accumulation exactly. integer_parity compares it with the fake-quantized
+model.
+
+Deformable layers sample the integer activations with the offset-scale
+operators from external.functions.deform_conv_cpu. With round_offset=True the
+scales are snapped to integers and the sampling is a pure integer gather;
+otherwise the bilinear taps make the accumulator fractional before requantization.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ..quant_modules import QuantAct, Quant_Conv2d, QuantBnConv2d, QuantDeformConv2d, QuantBnDeformConv2d, \
+    QuantBaseNode, QuantBaseNodeDeform, QuantDepthwiseNode, QuantDeformConvWithOffsetScaleBoundPositive, \
+    QuantDeformConvWithOffsetScaleBoundPositiveBn
+from .quant_utils import asymmetric_linear_quantization_params, symmetric_linear_quantization_params
+from external.functions.deform_conv_cpu import deform_conv_scale_cpu, deform_conv_scale_int_cpu
+
+
+def _signed_range(bits):
+    return -2 ** (bits - 1), 2 ** (bits - 1) - 1
+
+
+def _act_params(quant_act):
+    # QuantAct uses real = (q + zero_point) / scale, flip it to scale * (q - zero_point)
+    if quant_act.full_precision_flag:
+        raise ValueError('cannot export a full precision QuantAct')
+    bits = quant_act.activation_bit
+    if quant_act.quant_mode == 'symmetric':
+        magnitude = max(quant_act.x_min.abs(), quant_act.x_max.abs())
+        scale, zero_point = symmetric_linear_quantization_params(bits, magnitude)
+    else:
+        scale, zero_point = asymmetric_linear_quantization_params(bits, quant_act.x_min, quant_act.x_max)
+    qmin, qmax = _signed_range(bits)
+    return {'scale': 1. / float(scale), 'zero_point': -int(zero_point), 'qmin': qmin, 'qmax': qmax}
+
+
+def _act_unit(module):
+    # QuantAct, optionally preceded by ReLU / Hardtanh, as used by quantize_shufflenetv2_dcn
+    if isinstance(module, QuantAct):
+        return module, None, None
+    if isinstance(module, nn.Sequential) and len(module) == 2 and isinstance(module[1], QuantAct):
+        act = module[0]
+        if isinstance(act, nn.ReLU):
+            return module[1], 0., None
+        if isinstance(act, nn.Hardtanh):
+            return module[1], act.min_val, act.max_val
+    return None
+
+
+def _export_weight(qconv):
+    if qconv.full_precision_flag:
+        raise ValueError('cannot export a full precision {}'.format(type(qconv).__name__))
+    weight, bias, scale, zero_point = qconv.quantized_weight(show=True)
+    # export the bias the fake-quantized forward adds, whatever bias_bit says
+    if isinstance(qconv, Quant_Conv2d):
+        bias = qconv.bias
+    elif isinstance(qconv, QuantDeformConv2d):
+        bias = None
+    out_channels = weight.shape[0]
+    scale = scale.reshape(-1).expand(out_channels).double()
+    zero_point = zero_point.reshape(-1).expand(out_channels).double()
+    q = torch.round(weight.double() * scale.view(-1, 1, 1, 1) - zero_point.view(-1, 1, 1, 1))
+    assert q.abs().max() < 128, 'weights wider than 8 bits'
+    return {'weight': q.cpu().numpy().astype(np.int8),
+            'weight_scale': (1. / scale).cpu().numpy(),
+            'weight_zero_point': (-zero_point).cpu().numpy().astype(np.int32),
+            'bias': None if bias is None else bias.detach().double().cpu().numpy()}
+
+
+def _geometry(qconv):
+    conv = getattr(qconv, 'conv', qconv)
+    return {'stride': tuple(conv.stride), 'padding': tuple(conv.padding),
+            'dilation': tuple(conv.dilation), 'groups': conv.groups}
+
+
+class _GraphBuilder(object):
+    def __init__(self, round_offset):
+        self.round_offset = round_offset
+        self.nodes = []
+        self.tensors = {}
+
+    def add(self, node, params):
+        name = 't{}'.format(len(self.tensors))
+        self.tensors[name] = params
+        node['output'] = name
+        self.nodes.append(node)
+        return name
+
+    def quantize(self, x, params):
+        node = {'op': 'quantize', 'input': x}
+        node.update(params)
+        return self.add(node, params)
+
+    def _conv_node(self, op, x, qconv):
+        src = self.tensors[x]
+        w = _export_weight(qconv)
+        acc_scale = src['scale'] * w['weight_scale']
+        node = {'op': op, 'input': x, 'input_zero_point': src['zero_point'],
+                'weight': w['weight'], 'weight_zero_point': w['weight_zero_point'], 'bias': None}
+        if w['bias'] is not None:
+            node['bias'] = np.round(w['bias'] / acc_scale).astype(np.int32)
+        node.update(_geometry(qconv))
+        return node, {'scale': acc_scale, 'zero_point': 0}
+
+    def conv(self, x, qconv):
+        node, params = self._conv_node('conv', x, qconv)
+        return self.add(node, params)
+
+    def deform_conv(self, x, offset_scale, qconv):
+        node, params = self._conv_node('deform_conv', x, qconv)
+        src = self.tensors[offset_scale]
+        node.update({'offset_scale': offset_scale, 'offset_step': src['scale'],
+                     'offset_zero_point': src['zero_point'], 'round_offset': self.round_offset})
+        return self.add(node, params)
+
+    def requant(self, x, quant_act, clamp_min=None, clamp_max=None):
+        src = self.tensors[x]
+        params = _act_params(quant_act)
+        in_scale = np.asarray(src['scale'], dtype=np.float64).reshape(-1)
+        node = {'op': 'requant', 'input': x, 'input_zero_point': src['zero_point'],
+                'multiplier': in_scale / params['scale'],
+                'clamp_min': None if clamp_min is None else clamp_min / in_scale,
+                'clamp_max': None if clamp_max is None else clamp_max / in_scale}
+        node.update(params)
+        return self.add(node, params)
+
+    def rescale(self, x, params):
+        src = self.tensors[x]
+        node = {'op': 'requant', 'input': x, 'input_zero_point': src['zero_point'],
+                'multiplier': np.asarray(src['scale'], dtype=np.float64).reshape(-1) / params['scale'],
+                'clamp_min': None, 'clamp_max': None}
+        node.update(params)
+        return self.add(node, params)
+
+    def dequantize(self, x):
+        src = self.tensors[x]
+        node = {'op': 'dequantize', 'input': x, 'scale': np.asarray(src['scale'], dtype=np.float64).reshape(-1),
+                'zero_point': src['zero_point']}
+        return self.add(node, None)
+
+    def split(self, x):
+        params = self.tensors[x]
+        return (self.add({'op': 'split', 'input': x, 'index': 0}, params),
+                self.add({'op': 'split', 'input': x, 'index': 1}, params))
+
+    def concat(self, xs):
+        params = self.tensors[xs[0]]
+        xs = [x if self.tensors[x] == params else self.rescale(x, params) for x in xs]
+        return self.add({'op': 'concat', 'inputs': xs}, params)
+
+    def channel_shuffle(self, x, groups):
+        return self.add({'op': 'channel_shuffle', 'input': x, 'groups': groups}, self.tensors[x])
+
+    def upsample(self, x, scale_factor):
+        return self.add({'op': 'upsample', 'input': x, 'scale_factor': int(scale_factor)}, self.tensors[x])
+
+
+def _export_act(builder, x, module):
+    quant_act, clamp_min, clamp_max = _act_unit(module)
+    return builder.requant(x, quant_act, clamp_min, clamp_max)
+
+
+def _export_offset_scale(builder, x, module):
+    # conv_scale -> Hardtanh -> QuantAct of the offset-scale deform layers
+    s = builder.conv(x, module.quant_conv_scale)
+    return _export_act(builder, s, module.quant_act)
+
+
+def _export_conv_or_deform(builder, x, module):
+    if isinstance(module, QuantDeformConvWithOffsetScaleBoundPositiveBn):
+        s = _export_offset_scale(builder, x, module)
+        return builder.deform_conv(x, s, module.quant_deform_conv_bn)
+    return builder.conv(x, module)
+
+
+def _export_base_node(builder, x, node):
+    if node.stride == 1:
+        x1, x2 = builder.split(x)
+    else:
+        x1 = _export_conv_or_deform(builder, x, node.quant_convbn4)
+        x1 = builder.requant(x1, node.quant_act4)
+        x1 = builder.conv(x1, node.quant_convbn5)
+        x1 = builder.requant(x1, node.quant_act, 0.)
+        x2 = x
+    x2 = builder.conv(x2, node.quant_convbn1)
+    x2 = builder.requant(x2, node.quant_act1, 0.)
+    x2 = _export_conv_or_deform(builder, x2, node.quant_convbn2)
+    x2 = builder.requant(x2, node.quant_act2)
+    x2 = builder.conv(x2, node.quant_convbn3)
+    x2 = builder.requant(x2, node.quant_act, 0.)
+    y = builder.concat([x1, x2])
+    return builder.channel_shuffle(y, 2)
+
+
+def _export_module(builder, x, module):
+    if isinstance(module, nn.Sequential) and _act_unit(module) is None:
+        for child in module:
+            x = _export_module(builder, x, child)
+        return x
+    if _act_unit(module) is not None:
+        return _export_act(builder, x, module)
+    if isinstance(module, (Quant_Conv2d, QuantBnConv2d)):
+        return builder.conv(x, module)
+    if isinstance(module, (QuantBaseNode, QuantBaseNodeDeform)):
+        return _export_base_node(builder, x, module)
+    if isinstance(module, QuantDeformConvWithOffsetScaleBoundPositive):
+        s = _export_offset_scale(builder, x, module)
+        x = builder.deform_conv(x, s, module.quant_deform_conv)
+        x = _export_act(builder, x, module.quant_identity_deform)
+        return builder.conv(x, module.quant_conv_channel_bn)
+    if isinstance(module, QuantDepthwiseNode):
+        x = builder.conv(x, module.quant_convbn1)
+        x = _export_act(builder, x, module.quant_act1)
+        x = builder.conv(x, module.quant_convbn2)
+        x = _export_act(builder, x, module.quant_act3)
+        return builder.conv(x, module.quant_conv)
+    if isinstance(module, nn.Upsample):
+        assert module.mode == 'nearest'
+        return builder.upsample(x, module.scale_factor)
+    raise NotImplementedError('no integer export for {}'.format(type(module).__name__))
+
+
+def export_integer_graph(model, input_min, input_max, input_bit=8, round_offset=False):
+    """
+    Export a model prepared by quantize_shufflenetv2_dcn (and trained/calibrated) to an
+    integer graph. The fake-quantized model feeds layer0 with float input, the integer
+    graph quantizes it first with an asymmetric input_bit quantizer over
+    [input_min, input_max] (the normalized image range).
+    """
+    builder = _GraphBuilder(round_offset)
+    builder.tensors['input'] = None
+    with torch.no_grad():
+        scale, zero_point = asymmetric_linear_quantization_params(
+            input_bit, torch.tensor(float(input_min)), torch.tensor(float(input_max)))
+        qmin, qmax = _signed_range(input_bit)
+        x = builder.quantize('input', {'scale': 1. / float(scale), 'zero_point': -int(zero_point),
+                                       'qmin': qmin, 'qmax': qmax})
+        for name in ['layer0', 'layer1', 'layer2', 'layer3', 'layer4', 'deconv_layers']:
+            x = _export_module(builder, x, getattr(model, name))
+        outputs = {}
+        for head in model.heads:
+            outputs[head] = builder.dequantize(_export_module(builder, x, getattr(model, head)))
+    return {'nodes': builder.nodes, 'input': 'input', 'outputs': outputs}
+
+
+def _as_tensor(value, device):
+    return torch.as_tensor(np.asarray(value), dtype=torch.float64, device=device)
+
+
+class IntegerExecutor(object):
+    """Reference runtime for the graph produced by export_integer_graph."""
+
+    def __init__(self, graph, device='cpu'):
+        self.graph = graph
+        self.device = torch.device(device)
+        self.nodes = []
+        for node in graph['nodes']:
+            node = dict(node)
+            for key in ['weight', 'weight_zero_point', 'bias', 'multiplier', 'clamp_min', 'clamp_max']:
+                if node.get(key) is not None:
+                    node[key] = _as_tensor(node[key], self.device)
+            if node['op'] == 'dequantize':
+                node['scale'] = _as_tensor(node['scale'], self.device)
+            self.nodes.append(node)
+
+    def _conv(self, env, node):
+        x = env[node['input']] - node['input_zero_point']
+        w = node['weight'] - node['weight_zero_point'].view(-1, 1, 1, 1)
+        if node['op'] == 'conv':
+            acc = F.conv2d(x, w, None, node['stride'], node['padding'], node['dilation'], node['groups'])
+        else:
+            s = node['offset_step'] * (env[node['offset_scale']] - node['offset_zero_point'])
+            op = deform_conv_scale_int_cpu if node['round_offset'] else deform_conv_scale_cpu
+            acc = op(x, s, w, node['stride'], node['padding'], node['dilation'])
+        if node['bias'] is not None:
+            acc = acc + node['bias'].view(1, -1, 1, 1)
+        return acc
+
+    def _requant(self, env, node):
+        acc = env[node['input']] - node['input_zero_point']
+        if node['clamp_min'] is not None:
+            acc = torch.max(acc, node['clamp_min'].view(1, -1, 1, 1))
+        if node['clamp_max'] is not None:
+            acc = torch.min(acc, node['clamp_max'].view(1, -1, 1, 1))
+        q = torch.round(acc * node['multiplier'].view(1, -1, 1, 1)) + node['zero_point']
+        return q.clamp(node['qmin'], node['qmax'])
+
+    def run_node(self, env, node):
+        op = node['op']
+        if op == 'quantize':
+            q = torch.round(env[node['input']].double() / node['scale']) + node['zero_point']
+            return q.clamp(node['qmin'], node['qmax'])
+        if op in ('conv', 'deform_conv'):
+            return self._conv(env, node)
+        if op == 'requant':
+            return self._requant(env, node)
+        if op == 'dequantize':
+            return ((env[node['input']] - node['zero_point']) * node['scale'].view(1, -1, 1, 1)).float()
+        if op == 'split':
+            x = env[node['input']]
+            split = x.shape[1] // 2
+            return x[:, :split] if node['index'] == 0 else x[:, split:]
+        if op == 'concat':
+            return torch.cat([env[x] for x in node['inputs']], dim=1)
+        if op == 'channel_shuffle':
+            x = env[node['input']]
+            n, c, h, w = x.shape
+            g = node['groups']
+            return x.view(n, g, c // g, h, w).transpose(1, 2).contiguous().view(n, c, h, w)
+        if op == 'upsample':
+            return F.interpolate(env[node['input']], scale_factor=node['scale_factor'], mode='nearest')
+        raise ValueError('unknown op {}'.format(op))
+
+    def __call__(self, x):
+        env = {self.graph['input']: x.to(self.device)}
+        for node in self.nodes:
+            env[node['output']] = self.run_node(env, node)
+        return {head: env[name] for head, name in self.graph['outputs'].items()}
+
+
+def integer_parity(model, graph, images, device='cpu'):
+    """
+    Per-head mean/max absolute difference between the fake-quantized model and the
+    integer executor over `images` (an iterable of normalized input batches).
+    """
+    executor = IntegerExecutor(graph, device)
+    acts = [m for m in model.modules() if isinstance(m, QuantAct)]
+    running_stat = [m.running_stat for m in acts]
+    for m in acts:
+        m.running_stat = False
+    stats = {}
+    try:
+        with torch.no_grad():
+            for x in images:
+                ref = model(x.to(device))[-1]
+                out = executor(x)
+                for head in out:
+                    diff = (out[head] - ref[head].float()).abs()
+                    stats.setdefault(head, []).append([diff.mean().item(), diff.max().item(),
+                                                       ref[head].abs().max().item()])
+    finally:
+        for m, flag in zip(acts, running_stat):
+            m.running_stat = flag
+    return {head: {'mean_abs_diff': float(np.mean([v[0] for v in values])),
+                   'max_abs_diff': float(np.max([v[1] for v in values])),
+                   'max_abs_ref': float(np.max([v[2] for v in values]))}
+            for head, values in stats.items()}
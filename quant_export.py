@@ -0,0 +1,68 @@
+'''
+Export a quantization-aware fine-tuned ShuffleNetV2-DCN (see quant_main.py)
+to an integer inference graph and report its parity with the fake-quantized
+model on the first --num_images validation inputs.
+
+  python quant_export.py ctdet --arch shufflenetv2_dcn --dataset pascal \
+    --load_model ../exp/ctdet/quant/model_best.pth --round_offset
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+import torch.utils.data
+from opts import opts
+from models.model import create_model, load_model
+from datasets.dataset_factory import get_dataset
+
+# quant_modules imports the deform conv ops as `external.*`
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'lib', 'models'))
+from portable_quantizer_codes import quantize_shufflenetv2_dcn, freeze_quantized_weights, export_integer_graph, \
+  integer_parity
+
+
+def main(opt, num_images):
+  Dataset = get_dataset(opt.dataset, opt.task)
+  opt = opts().update_dataset_info_and_set_heads(opt, Dataset)
+  os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpus_str
+
+  print('Creating model...')
+  model = create_model(opt.arch, opt.heads, opt.head_conv, opt.deform_conv)
+  quantize_shufflenetv2_dcn(model, quant_conv=4, quant_bn=None, quant_act=8,
+                            wt_quant_mode='symmetric', act_quant_mode='asymmetric',
+                            wt_per_channel=True, wt_percentile=True, act_percentile=False, deform_backbone=False)
+  model = load_model(model, opt.load_model)
+  model.eval()
+  freeze_quantized_weights(model)
+
+  # normalized range of a [0, 1] image
+  mean, std = np.array(opt.mean), np.array(opt.std)
+  input_min = float(((0. - mean) / std).min())
+  input_max = float(((1. - mean) / std).max())
+  graph = export_integer_graph(model, input_min, input_max, round_offset=opt.round_offset)
+  path = os.path.join(opt.save_dir, 'model_int.pth')
+  torch.save(graph, path)
+  print('Saved {} integer ops to {}'.format(len(graph['nodes']), path))
+
+  dataset = Dataset(opt, 'val')
+  num_images = min(num_images, len(dataset))
+  images = (torch.from_numpy(dataset[i]['input']).unsqueeze(0) for i in range(num_images))
+  stats = integer_parity(model, graph, images)
+  print('integer parity on {} {} images (round_offset={})'.format(num_images, opt.dataset, opt.round_offset))
+  for head, stat in stats.items():
+    print('  {:8s} mean abs diff {:.4e}  max abs diff {:.4e}  (max abs output {:.4e})'.format(
+      head, stat['mean_abs_diff'], stat['max_abs_diff'], stat['max_abs_ref']))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument('--num_images', type=int, default=20)
+  args, rest = parser.parse_known_args()
+  main(opts().parse(rest), args.num_images)
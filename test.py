@@ -12,11 +12,11 @@ import time
 from progress.bar import Bar
 import torch
 
-from external.nms import soft_nms
 from opts import opts
 from logger import Logger
 from utils.utils import AverageMeter
 from datasets.dataset_factory import dataset_factory
+from datasets.shape_buckets import ShapeBucketSampler, input_shapes
 from detectors.detector_factory import detector_factory
 
 class PrefetchDataset(torch.utils.data.Dataset):
@@ -44,6 +44,15 @@ class PrefetchDataset(torch.utils.data.Dataset):
   def __len__(self):
     return len(self.images)
 
+def collate_prefetch(samples):
+  # per-image lists instead of stacked tensors, run_batch pads them. The
+  # collate runs in the workers, so the raw images are not sent over.
+  img_ids = [img_id for img_id, _ in samples]
+  scales = list(samples[0][1]['images'].keys())
+  return img_ids, {
+    key: {scale: [sample[key][scale] for _, sample in samples]
+          for scale in scales} for key in ['images', 'meta']}
+
 def prefetch_test(opt):
   os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpus_str
 
@@ -57,26 +66,50 @@ def prefetch_test(opt):
   dataset = Dataset(opt, split)
   detector = Detector(opt)
   
-  data_loader = torch.utils.data.DataLoader(
-    PrefetchDataset(opt, dataset, detector.pre_process), 
-    batch_size=1, shuffle=False, num_workers=1, pin_memory=True)
+  prefetch_dataset = PrefetchDataset(opt, dataset, detector.pre_process)
+  if opt.test_batch_size > 1:
+    data_loader = torch.utils.data.DataLoader(
+      prefetch_dataset,
+      batch_sampler=ShapeBucketSampler(
+        input_shapes(dataset, opt, opt.test_scales), opt.test_batch_size,
+        shuffle=False),
+      collate_fn=collate_prefetch, num_workers=opt.test_workers,
+      pin_memory=True)
+  else:
+    data_loader = torch.utils.data.DataLoader(
+      prefetch_dataset, 
+      batch_size=1, shuffle=False, num_workers=opt.test_workers,
+      pin_memory=True)
 
   results = {}
   num_iters = len(dataset)
-  bar = Bar('{}'.format(opt.exp_id), max=num_iters)
+  bar = Bar('{}'.format(opt.exp_id), max=len(data_loader))
   time_stats = ['tot', 'load', 'pre', 'net', 'dec', 'post', 'merge']
   avg_time_stats = {t: AverageMeter() for t in time_stats}
-  for ind, (img_id, pre_processed_images) in enumerate(data_loader):
-    ret = detector.run(pre_processed_images)
-    results[img_id.numpy().astype(np.int32)[0]] = ret['results']
+  num_done = 0
+  for img_ids, pre_processed_images in data_loader:
+    if opt.test_batch_size > 1:
+      ret = detector.run_batch(pre_processed_images)
+      batch_results = ret['results']
+    else:
+      img_ids = [img_ids.numpy().astype(np.int32)[0]]
+      ret = detector.run(pre_processed_images)
+      batch_results = [ret['results']]
+    for img_id, result in zip(img_ids, batch_results):
+      results[img_id] = result
+    num_done += len(img_ids)
     Bar.suffix = '[{0}/{1}]|Tot: {total:} |ETA: {eta:} '.format(
-                   ind, num_iters, total=bar.elapsed_td, eta=bar.eta_td)
+                   num_done, num_iters, total=bar.elapsed_td, eta=bar.eta_td)
+    # times per image: a batch's times are split evenly over its images, so
+    # val is the per-image share of the last batch and avg the running mean
     for t in avg_time_stats:
-      avg_time_stats[t].update(ret[t])
+      avg_time_stats[t].update(ret[t] / len(img_ids), len(img_ids))
       Bar.suffix = Bar.suffix + '|{} {tm.val:.3f}s ({tm.avg:.3f}s) '.format(
         t, tm = avg_time_stats[t])
     bar.next()
   bar.finish()
+  # the shape buckets visit the images out of order, evaluate in dataset order
+  results = {img_id: results[img_id] for img_id in dataset.images}
   dataset.run_eval(results, opt.save_dir)
 
 def test(opt):
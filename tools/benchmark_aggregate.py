@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import argparse
+import time
+import torch
+
+from models.decode import _left_aggregate, _right_aggregate, \
+  _top_aggregate, _bottom_aggregate
+
+
+# the original per-column scans, kept here as the reference
+def left_aggregate_loop(heat):
+  shape = heat.shape
+  heat = heat.reshape(-1, heat.shape[3])
+  heat = heat.transpose(1, 0).contiguous()
+  ret = heat.clone()
+  for i in range(1, heat.shape[0]):
+    inds = (heat[i] >= heat[i - 1])
+    ret[i] += ret[i - 1] * inds.float()
+  return (ret - heat).transpose(1, 0).reshape(shape)
+
+
+def right_aggregate_loop(heat):
+  shape = heat.shape
+  heat = heat.reshape(-1, heat.shape[3])
+  heat = heat.transpose(1, 0).contiguous()
+  ret = heat.clone()
+  for i in range(heat.shape[0] - 2, -1, -1):
+    inds = (heat[i] >= heat[i + 1])
+    ret[i] += ret[i + 1] * inds.float()
+  return (ret - heat).transpose(1, 0).reshape(shape)
+
+
+def top_aggregate_loop(heat):
+  return left_aggregate_loop(heat.transpose(3, 2)).transpose(3, 2)
+
+
+def bottom_aggregate_loop(heat):
+  return right_aggregate_loop(heat.transpose(3, 2)).transpose(3, 2)
+
+
+def bench(fn, x, iters):
+  fn(x)
+  start = time.time()
+  for _ in range(iters):
+    fn(x)
+  return (time.time() - start) / iters * 1000
+
+
+def main(args):
+  torch.manual_seed(0)
+  device = torch.device(args.device)
+  heat = torch.rand(args.batch, args.channels, args.size, args.size,
+                    device=device)
+  # coarse levels give plateaus, which exercise the non-strict >=
+  plateau = (heat * 4).round() / 4
+  pairs = [('left', left_aggregate_loop, _left_aggregate),
+           ('right', right_aggregate_loop, _right_aggregate),
+           ('top', top_aggregate_loop, _top_aggregate),
+           ('bottom', bottom_aggregate_loop, _bottom_aggregate)]
+  ok = True
+  for name, loop, vec in pairs:
+    diff = max((loop(x) - vec(x)).abs().max().item() for x in (heat, plateau))
+    ok = ok and diff < 1e-4
+    t_loop = bench(loop, heat, args.iters)
+    t_vec = bench(vec, heat, args.iters)
+    print('{:6s} max abs diff {:.2e}  loop {:8.2f} ms  vectorized {:8.2f} ms '
+          '({:.1f}x)'.format(name, diff, t_loop, t_vec, t_loop / t_vec))
+  print('equivalent' if ok else 'MISMATCH')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='vectorized vs loop ExtremeNet edge aggregation')
+  parser.add_argument('--batch', type=int, default=1)
+  parser.add_argument('--channels', type=int, default=80)
+  parser.add_argument('--size', type=int, default=128)
+  parser.add_argument('--iters', type=int, default=5)
+  parser.add_argument('--device', default='cpu')
+  main(parser.parse_args())
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import argparse
+import time
+import torch
+import torch.nn as nn
+
+from models.external.functions.deform_conv_cpu import deform_conv_cpu, \
+  deform_conv_scale_cpu
+
+ANCHOR_OFFSET = torch.FloatTensor([-1, -1, -1, 0, -1, 1,
+                                   0, -1, 0, 0, 0, 1,
+                                   1, -1, 1, 0, 1, 1]).view(1, 18, 1, 1)
+
+
+def bench(fn, iters, backward=False):
+  for _ in range(2):
+    out = fn()
+    if backward:
+      out.sum().backward()
+  start = time.time()
+  for _ in range(iters):
+    out = fn()
+    if backward:
+      out.sum().backward()
+  return (time.time() - start) / iters * 1000
+
+
+def main(args):
+  torch.set_num_threads(args.threads)
+  n, c, h, w = args.batch, args.channels, args.size, args.size
+  dg = args.deformable_groups
+  x = torch.randn(n, c, h, w, requires_grad=args.backward)
+  # offsets as DeformConvWithOffsetScaleBoundPositive builds them
+  scale = (torch.rand(n, dg, h, w) * 4 - 1).requires_grad_(args.backward)
+  offset = ANCHOR_OFFSET.repeat(1, dg, 1, 1) * (scale - 1)
+  conv = nn.Conv2d(c, c, 3, padding=1, groups=c, bias=False)
+  weight = conv.weight.detach().clone().requires_grad_(args.backward)
+
+  # zero offsets must reproduce the plain depthwise conv
+  with torch.no_grad():
+    ref = conv(x)
+    out = deform_conv_cpu(x, torch.zeros_like(offset), weight, 1, 1, 1, c, dg)
+    print('max abs diff vs depthwise conv (zero offset): {:.2e}'.format(
+      (ref - out).abs().max().item()))
+    ref = deform_conv_cpu(x, offset, weight, 1, 1, 1, c, dg)
+    out = deform_conv_scale_cpu(x, scale, weight, 1, 1, 1)
+    print('max abs diff scale op vs generic op: {:.2e}'.format(
+      (ref - out).abs().max().item()))
+
+  mode = 'fwd+bwd' if args.backward else 'fwd'
+  t_dw = bench(lambda: conv(x), args.iters, args.backward)
+  t_dcn = bench(lambda: deform_conv_cpu(
+    x, ANCHOR_OFFSET.repeat(1, dg, 1, 1) * (scale - 1), weight, 1, 1, 1, c, dg),
+    args.iters, args.backward)
+  t_scale = bench(lambda: deform_conv_scale_cpu(x, scale, weight, 1, 1, 1),
+                  args.iters, args.backward)
+  print('input {}x{}x{}x{}, {} threads, {}'.format(
+    n, c, h, w, args.threads, mode))
+  print('depthwise conv  {:8.2f} ms'.format(t_dw))
+  print('deform conv cpu {:8.2f} ms ({:.1f}x)'.format(t_dcn, t_dcn / t_dw))
+  print('scale deform    {:8.2f} ms ({:.1f}x)'.format(t_scale, t_scale / t_dw))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='CPU deformable convs vs depthwise conv of the same shape')
+  parser.add_argument('--batch', type=int, default=1)
+  parser.add_argument('--channels', type=int, default=128)
+  parser.add_argument('--size', type=int, default=64)
+  parser.add_argument('--deformable_groups', type=int, default=1)
+  parser.add_argument('--iters', type=int, default=20)
+  parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+  parser.add_argument('--backward', action='store_true')
+  main(parser.parse_args())
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import argparse
+import sys
+import time
+import numpy as np
+
+from utils.nms import batched_soft_nms
+
+try:
+  from external.nms import soft_nms as cython_nms
+  from external.nms import soft_nms_39 as cython_nms_39
+except ImportError:
+  cython_nms = cython_nms_39 = None
+
+
+def random_dets(rng, num_dets, num_classes, num_extra):
+  xy = rng.rand(num_dets, 2) * 512
+  wh = rng.rand(num_dets, 2) * 128 + 1
+  scores = rng.rand(num_dets, 1) ** 4
+  extra = rng.rand(num_dets, num_extra)
+  dets = np.concatenate([xy, xy + wh, scores, extra], axis=1)
+  classes = rng.randint(0, num_classes, num_dets)
+  order = np.argsort(classes, kind='mergesort')
+  return dets[order].astype(np.float32), classes[order]
+
+
+def reference_soft_nms(dets, method, Nt=0.5, sigma=0.5, threshold=0.001):
+  # soft_nms of nms.pyx for one class, one pick at a time: the kept rows in
+  # the order they are picked
+  dets = dets.astype(np.float64)
+  kept = []
+  while len(dets):
+    i = dets[:, 4].argmax()
+    box = dets[i]
+    kept.append(box)
+    dets = np.delete(dets, i, axis=0)
+    iw = np.minimum(box[2], dets[:, 2]) - np.maximum(box[0], dets[:, 0]) + 1
+    ih = np.minimum(box[3], dets[:, 3]) - np.maximum(box[1], dets[:, 1]) + 1
+    overlap = (iw > 0) & (ih > 0)
+    inter = np.where(overlap, iw * ih, 0)
+    ov = inter / ((box[2] - box[0] + 1) * (box[3] - box[1] + 1) +
+                  (dets[:, 2] - dets[:, 0] + 1) *
+                  (dets[:, 3] - dets[:, 1] + 1) - inter)
+    if method == 1:
+      weight = np.where(ov > Nt, 1 - ov, 1)
+    elif method == 2:
+      weight = np.exp(-(ov * ov) / sigma)
+    else:
+      weight = np.where(ov > Nt, 0, 1)
+    dets[:, 4] *= np.where(overlap, weight, 1)
+    dets = dets[~(overlap & (dets[:, 4] < threshold))]
+  return np.array(kept).reshape(-1, 5)
+
+
+def cython_soft_nms(dets, classes, method):
+  # the kept rows of every class, the rows behind them are stale
+  kept = []
+  for j in np.unique(classes):
+    inds = np.nonzero(classes == j)[0]
+    # the classes are sorted, so inds is a slice and this is a view
+    view = dets[inds[0]:inds[-1] + 1]
+    if dets.shape[1] == 39:
+      keep = cython_nms_39(view, Nt=0.5, method=method)
+    else:
+      keep = cython_nms(view, Nt=0.5, method=method)
+    kept.append(view[:len(keep)])
+  return np.concatenate(kept)
+
+
+def batched(dets, classes, method):
+  return dets[batched_soft_nms(dets, classes, Nt=0.5, method=method)]
+
+
+def bench(fn, dets, classes, method, iters):
+  start = time.time()
+  for _ in range(iters):
+    fn(dets.copy(), classes, method)
+  return (time.time() - start) / iters * 1000
+
+
+def main(args):
+  rng = np.random.RandomState(0)
+  ok = True
+  for method, name in enumerate(['nms', 'linear', 'gaussian']):
+    for _ in range(args.checks):
+      dets, classes = random_dets(
+        rng, args.num_dets, args.num_classes, args.num_extra)
+      result = batched(dets.copy(), classes, method)[:, :5]
+      expected = [np.concatenate([
+        reference_soft_nms(dets[classes == j, :5], method)
+        for j in np.unique(classes)])]
+      if cython_nms is not None:
+        # the extra columns are not moved with their box by nms.pyx
+        expected.append(cython_soft_nms(dets.copy(), classes, method)[:, :5])
+      for rows in expected:
+        ok = ok and rows.shape == result.shape and \
+             np.allclose(rows, result, rtol=1e-5, atol=1e-6)
+    dets, classes = random_dets(
+      rng, args.num_dets, args.num_classes, args.num_extra)
+    t_batched = bench(batched, dets, classes, method, args.iters)
+    if cython_nms is None:
+      print('{:8s} batched {:8.3f} ms'.format(name, t_batched))
+      continue
+    t_cython = bench(cython_soft_nms, dets, classes, method, args.iters)
+    print('{:8s} cython {:8.3f} ms  batched {:8.3f} ms ({:.2f}x)'.format(
+      name, t_cython, t_batched, t_cython / t_batched))
+  if cython_nms is None:
+    print('external.nms is not built, checked against the reference only')
+  print('equivalent' if ok else 'MISMATCH')
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='batched numpy soft-NMS vs a per-box reference and, when it '
+                'is built, the cython lib/external/nms.pyx')
+  parser.add_argument('--num_dets', type=int, default=300,
+                      help='detections per image, e.g. K x test scales')
+  parser.add_argument('--num_classes', type=int, default=80)
+  parser.add_argument('--num_extra', type=int, default=0,
+                      help='extra columns, 34 for multi_pose (soft_nms_39)')
+  parser.add_argument('--checks', type=int, default=20)
+  parser.add_argument('--iters', type=int, default=20)
+  sys.exit(main(parser.parse_args()))
@@ -0,0 +1,67 @@
+'''
+Decode every image of a dataset split once and pack the raw uint8 pixels
+into memory-mapped shards for --image_backend shard.
+
+  python tools/pack_image_shards.py ctdet --dataset pascal --splits train,val
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import os
+import argparse
+from multiprocessing import Pool
+
+import cv2
+from progress.bar import Bar
+
+from opts import opts
+from datasets.dataset_factory import get_dataset
+from datasets.image_shards import ImageShardWriter, shard_dir
+
+
+def _decode(path):
+  return cv2.imread(path)
+
+
+def pack(opt, Dataset, split, shard_gb, num_workers):
+  dataset = Dataset(opt, split)
+  file_names = sorted(set(
+    dataset.coco.loadImgs(ids=[img_id])[0]['file_name']
+    for img_id in dataset.images))
+  path = shard_dir(opt, split)
+  writer = ImageShardWriter(path, int(shard_gb * (1 << 30)))
+  paths = [os.path.join(dataset.img_dir, name) for name in file_names]
+  bar = Bar('{} {}'.format(opt.dataset, split), max=len(paths))
+  pool = Pool(num_workers)
+  # imap keeps the order, so the shards follow the sorted file names
+  for name, img in zip(file_names, pool.imap(_decode, paths, chunksize=8)):
+    if img is None:
+      print('\ncannot read {}, skipped'.format(name))
+    else:
+      writer.add(name, img)
+    bar.next()
+  pool.close()
+  bar.finish()
+  writer.close()
+  print('{} images in {} shards at {}'.format(
+    len(writer.images), len(writer.shards), path))
+
+
+def main(opt, args):
+  Dataset = get_dataset(opt.dataset, opt.task)
+  opt = opts().update_dataset_info_and_set_heads(opt, Dataset)
+  for split in args.splits.split(','):
+    pack(opt, Dataset, split, args.shard_gb, args.workers)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument('--splits', default='train,val')
+  parser.add_argument('--shard_gb', type=float, default=1.)
+  parser.add_argument('--workers', type=int, default=8)
+  args, rest = parser.parse_known_args()
+  main(opts().parse(rest), args)
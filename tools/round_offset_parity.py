@@ -0,0 +1,107 @@
+'''
+Parity report for --round_offset: runs the first --num_images validation
+images through the float-offset and the integer-offset model and compares
+the raw head outputs, the detections and the network time.
+
+  python tools/round_offset_parity.py ctdet --arch shufflenetv2_dcn \
+    --load_model ../models/model_best.pth --num_images 200
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _init_paths
+
+import os
+import argparse
+import numpy as np
+import torch
+
+from opts import opts
+from datasets.dataset_factory import dataset_factory
+from detectors.detector_factory import detector_factory
+from models.external.modules.dcn_deform_conv import set_round_offset
+
+
+def box_iou(a, b):
+  lt = np.maximum(a[:, None, :2], b[None, :, :2])
+  rb = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+  inter = np.clip(rb - lt, 0, None).prod(axis=2)
+  area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+  area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+  return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def matched(src, dst, thresh, iou_thresh=0.5):
+  '''(reproduced by dst, total) for the detections in src above thresh.'''
+  count = np.zeros(2)
+  for j in src:
+    a = src[j][src[j][:, 4] >= thresh]
+    b = dst[j][dst[j][:, 4] >= thresh]
+    count[1] += len(a)
+    if len(a) and len(b):
+      count[0] += (box_iou(a, b).max(axis=1) >= iou_thresh).sum()
+  return count
+
+
+def main(opt, num_images):
+  os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpus_str
+  Dataset = dataset_factory[opt.dataset]
+  opt = opts().update_dataset_info_and_set_heads(opt, Dataset)
+  opt.round_offset = False
+  dataset = Dataset(opt, 'val')
+  detector = detector_factory[opt.task](opt)
+
+  num_images = min(num_images, len(dataset))
+  head_diff = {head: [] for head in opt.heads}
+  net_time = {False: 0., True: 0.}
+  kept, found = np.zeros(2), np.zeros(2)
+  for ind in range(num_images):
+    img_id = dataset.images[ind]
+    img_info = dataset.coco.loadImgs(ids=[img_id])[0]
+    image = detector._load_image(
+      os.path.join(dataset.img_dir, img_info['file_name']))
+    images, _ = detector.pre_process(image, 1)
+    images = detector._to_device(images)
+
+    outputs, results = {}, {}
+    for rounded in (False, True):
+      set_round_offset(detector.model, rounded)
+      with torch.no_grad():
+        outputs[rounded] = detector.model(images)[-1]
+      if opt.task == 'ddd':
+        ret = detector.run(image, img_info['calib'])
+      else:
+        ret = detector.run(image)
+      results[rounded] = ret['results']
+      net_time[rounded] += ret['net']
+    set_round_offset(detector.model, False)
+
+    for head in opt.heads:
+      diff = (outputs[True][head] - outputs[False][head]).abs()
+      head_diff[head].append([diff.mean().item(), diff.max().item()])
+    if opt.task != 'ddd':
+      kept += matched(results[False], results[True], opt.vis_thresh)
+      found += matched(results[True], results[False], opt.vis_thresh)
+
+  print('round_offset parity on {} {} images'.format(num_images, opt.dataset))
+  for head in opt.heads:
+    diff = np.array(head_diff[head])
+    print('  {:8s} mean abs diff {:.4e}  max abs diff {:.4e}'.format(
+      head, diff[:, 0].mean(), diff[:, 1].max()))
+  if opt.task != 'ddd':
+    print('  float dets (score >= {}) kept by rounded: {}/{} ({:.2%})'.format(
+      opt.vis_thresh, int(kept[0]), int(kept[1]), kept[0] / max(kept[1], 1)))
+    print('  rounded dets (score >= {}) found by float: {}/{} ({:.2%})'.format(
+      opt.vis_thresh, int(found[0]), int(found[1]),
+      found[0] / max(found[1], 1)))
+  print('  net time float {:.4f}s  rounded {:.4f}s per image'.format(
+    net_time[False] / num_images, net_time[True] / num_images))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument('--num_images', type=int, default=100)
+  args, rest = parser.parse_known_args()
+  main(opts().parse(rest), args.num_images)